@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Non-blocking interface to Client operations.
+
+AsyncClient returns a workers.Future for every operation instead of
+blocking the caller. The operations of all callers share one WorkerPool,
+so the number of concurrent requests is bounded by max_concurrency
+however many operations are started:
+
+    async_client = AsyncClient(client, max_concurrency=16)
+    futures = [async_client.store_data(vault_id, key, data) for key, data in items]
+    for future in futures:
+        future.result()
+
+Results are collected with Future.result() or Future.add_done_callback().
+
+"""
+import collections
+
+from .dataitem import DataItem
+from .workers import WorkerPool
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_QUEUED = 1024
+DEFAULT_WINDOW = 4
+
+
+class AsyncClient(object):
+    """AsyncClient runs Client operations on a bounded WorkerPool.
+
+    At most max_concurrency operations run at a time and at most max_queued
+    wait for a worker, starting more blocks the caller until one finishes.
+
+    """
+    def __init__(self, client, max_concurrency=DEFAULT_CONCURRENCY, max_queued=DEFAULT_QUEUED):
+        """Initializer for AsyncClient
+
+        :param client: Client the operations are run with
+        :param max_concurrency: largest number of operations running at a time
+        :param max_queued: largest number of operations waiting for a worker
+
+        """
+        self.client = client
+        self._pool = WorkerPool(max_concurrency, max_concurrency + max_queued)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Lets started operations finish and stops the workers"""
+        self._pool.shutdown()
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the pool and returns its Future"""
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def auth(self):
+        """Authenticates the Client, see Client.auth"""
+        return self.submit(self.client.auth)
+
+    def list_vaults(self, vault_type=None, id_=None, role=None):
+        """Future of Client.list_vaults"""
+        return self.submit(self.client.list_vaults, vault_type, id_, role)
+
+    def list_clusters(self, parent_id):
+        """Future of Client.list_clusters"""
+        return self.submit(self.client.list_clusters, parent_id)
+
+    def list_dataitems(self, parent_id):
+        """Future of Client.list_dataitems"""
+        return self.submit(self.client.list_dataitems, parent_id)
+
+    def get_dataitem(self, parent_id, key):
+        """Future of Client.get_dataitem"""
+        return self.submit(self.client.get_dataitem, parent_id, key)
+
+    def store_data(self, parent_id, key, p_data, method="new", offset=None):
+        """Future of Client.store_data"""
+        return self.submit(self.client.store_data, parent_id, key, p_data, method, offset)
+
+    def fetch_data(self, parent_id, key):
+        """Future of a dict with the whole 'data' of the DataItem and its 'checksum'.
+
+        For large items use iter_chunks, which does not hold a worker for
+        the whole transfer.
+
+        """
+        return self.submit(self._fetch_data, parent_id, key)
+
+    def iter_chunks(self, parent_id, key, chunk_size=None, window=DEFAULT_WINDOW):
+        """Returns a ChunkStream over the DataItem's content
+
+        :param chunk_size: plaintext bytes per chunk, the Client's request size by default
+        :param window: largest number of chunks fetched ahead of the consumer
+
+        """
+        return ChunkStream(self, DataItem(self.client, parent_id, key), chunk_size or self.client._request_size,
+                           window)
+
+    def _fetch_data(self, parent_id, key):
+        response = self.client.fetch_data(parent_id, key)
+        return {'data': ''.join(response['data']), 'checksum': response['checksum']}
+
+
+class ChunkStream(object):
+    """ChunkStream iterates over Futures of consecutive chunks of a DataItem.
+
+    Every chunk is a ranged fetch run as its own task on the AsyncClient's
+    pool, at most window of them ahead of the consumer. Iterating only
+    waits for the item's length, the chunk Futures are handed out before
+    their data has arrived. Chunks are decrypted in the Client's
+    encryption mode.
+
+    """
+    def __init__(self, async_client, dataitem, chunk_size, window=DEFAULT_WINDOW):
+        """Initializer for ChunkStream
+
+        :param async_client: AsyncClient running the fetches
+        :param dataitem: DataItem to be read
+        :param chunk_size: plaintext bytes per chunk
+        :param window: largest number of chunks fetched ahead of the consumer
+
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self._async_client = async_client
+        self.dataitem = dataitem
+        self.chunk_size = chunk_size
+        self.window = max(1, window)
+        self.info = async_client.submit(dataitem._content_layout)
+
+    def __iter__(self):
+        stored_length, header, length = self.info.result()
+        futures = collections.deque()
+        for start in range(0, length, self.chunk_size):
+            if len(futures) >= self.window:
+                yield futures.popleft()
+            futures.append(self._async_client.submit(self.dataitem._read_range, start,
+                                                     start + self.chunk_size - 1, stored_length, header))
+        while futures:
+            yield futures.popleft()
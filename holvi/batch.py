@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import sys
+
+from .container import Cluster, Vault
+from .dataitem import DataItem
+from .workers import Future
+from .connection import DEFAULT_BATCH_SIZE
+
+
+class Batch(object):
+    """Batch collects JSON RPC calls and sends them in batched requests.
+
+    The methods mirror the Client's container and dataitem operations but
+    return a workers.Future right away. The calls are sent when the batch
+    is executed, at the end of a with block unless the block raised:
+
+        with client.batch() as batch:
+            clusters = [batch.add_cluster(name, vault_id) for name in names]
+        ids = [future.result().id for future in clusters]
+
+    Future.result() returns the same value as the Client method or raises
+    the exception of the failed call. A failed call does not stop the
+    other calls of the batch.
+
+    """
+    def __init__(self, client, max_batch=DEFAULT_BATCH_SIZE):
+        """Initializer for Batch
+
+        :param client: Client the calls are sent with
+        :param max_batch: largest number of calls sent in one request
+
+        """
+        self._client = client
+        self.max_batch = max_batch
+        self._calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def call(self, method, params, convert=None, invalidate=None):
+        """Adds a JSON RPC call and returns its Future
+
+        :param method: Operation to be performed on server
+        :param params: Parameters for given method
+        :param convert: function(response) returning the result, the response dict by default
+        :param invalidate: function called after the call, for cache invalidation
+
+        """
+        future = Future()
+        self._calls.append((method, params, convert, invalidate, future))
+        return future
+
+    def execute(self):
+        """Sends the collected calls and returns their results in order.
+
+        A failed call has its exception in place of the result. If a
+        request fails as a whole, the futures of all calls get its exception
+        and it is raised.
+
+        """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return []
+        try:
+            responses = self._client.connection.make_batch_request(
+                [(method, params) for method, params, convert, invalidate, future in calls], self.max_batch)
+        except Exception:
+            exc_info = sys.exc_info()
+            for method, params, convert, invalidate, future in calls:
+                if invalidate is not None:
+                    invalidate()
+                future._set_exc_info(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        results = []
+        for (method, params, convert, invalidate, future), response in zip(calls, responses):
+            if invalidate is not None:
+                invalidate()
+            if isinstance(response, Exception):
+                future._set_exc_info((type(response), response, None))
+                results.append(response)
+                continue
+            result = convert(response) if convert is not None else response
+            future._set_result(result)
+            results.append(result)
+        return results
+
+    def list_vaults(self, vault_type=None, id_=None, role=None):
+        """Adds a list_vaults call, see Client.list_vaults"""
+        params = {"vault_type": vault_type, "id_": id_, "role": role}
+        return self.call("list_vaults", params,
+                         lambda response: [Vault(self._client, **item) for item in response['vaults']])
+
+    def list_clusters(self, parent_id):
+        """Adds a list_clusters call, see Client.list_clusters"""
+        return self.call("list_clusters", {"parent_id": parent_id},
+                         lambda response: [Cluster(self._client, **item) for item in response['clusters']])
+
+    def list_dataitems(self, parent_id):
+        """Adds a list_dataitems call, see Client.list_dataitems"""
+        return self.call("list_dataitems", {"cluster_id": parent_id},
+                         lambda response: [DataItem(self._client, parent_id, item) for item in response['dataitems']])
+
+    def add_vault(self, vault_type, name):
+        """Adds an add_vault call, see Client.add_vault"""
+        return self.call("add_vault", {"vault_type": vault_type, "name": name},
+                         lambda response: Vault(self._client, **response['vault']))
+
+    def add_cluster(self, name, parent_id):
+        """Adds an add_cluster call, see Client.add_cluster"""
+        return self.call("add_cluster", {"parent_id": parent_id, "name": name},
+                         lambda response: Cluster(self._client, **response['cluster']),
+                         lambda: self._client._invalidate_cluster(parent_id))
+
+    def remove_cluster(self, cluster_id):
+        """Adds a remove_cluster call, see Client.remove_cluster"""
+        return self.call("remove_cluster", {"cluster_id": cluster_id}, lambda response: None,
+                         lambda: self._client._invalidate_cluster(cluster_id))
+
+    def remove_vault(self, vault_id):
+        """Adds a remove_vault call, see Client.remove_vault"""
+        return self.call("remove_vault", {"vault_id": vault_id}, lambda response: None,
+                         lambda: self._client._invalidate_cluster(vault_id))
+
+    def remove_dataitem(self, parent_id, key):
+        """Adds a remove_dataitem call, see Client.remove_dataitem"""
+        def invalidate():
+            self._client._invalidate_metadata(parent_id, key)
+            self._client._invalidate_listing(parent_id, 'dataitems')
+        return self.call("remove_dataitem", {"cluster_id": parent_id, "key": key}, lambda response: None,
+                         invalidate)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmarks against the local stand-in server.
+
+Measures store and fetch throughput over object sizes, request sizes,
+encryption modes and concurrency levels, list_dataitems and children
+latency of wide clusters and get_dataitem (HEAD) throughput. Results are
+written as JSON and can be compared against a stored baseline:
+
+    python -m holvi.benchmark --output results.json --baseline baseline.json
+
+A running server is benchmarked with --server. Its credentials are taken
+from --user, --password and --apikey, or from the HOLVI_USER,
+HOLVI_PASSWORD and HOLVI_APIKEY environment variables. The local server
+accepts any credentials.
+
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import StringIO
+
+import utils
+from .client import Client
+from .server import LocalServer, ServerProcess
+
+DEFAULT_SIZES = [65536, 1048576, 16777216]
+DEFAULT_REQUEST_SIZES = [262144, 2097152]
+DEFAULT_MODES = [utils.ENC_NONE, utils.ENC_AES256, utils.ENC_AES256_CHUNKED]
+DEFAULT_WORKERS = [1, 4]
+DEFAULT_WIDTHS = [10, 100]
+DEFAULT_THRESHOLD = 0.1
+BENCH_KEY = "12345678901234561234567890123456"
+BENCH_USER = "benchmark"
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _result(name, params, unit, samples, higher_is_better, scale=1.0):
+    """Returns a result dict from timing samples in seconds.
+
+    The value is scale divided by the median time, or the median time in
+    milliseconds when scale is None.
+
+    """
+    seconds = _median(samples)
+    if scale is None:
+        value = seconds * 1000.0
+    else:
+        value = scale / max(seconds, 1e-9)
+    label = ' '.join('{0}={1}'.format(key, params[key]) for key in sorted(params))
+    return {'id': '{0} {1}'.format(name, label).strip(),
+            'name': name,
+            'params': params,
+            'unit': unit,
+            'value': value,
+            'higher_is_better': higher_is_better,
+            'samples': samples}
+
+
+def _client(server_url, user, password, apikey):
+    client = Client(user, password, apikey=apikey, server_url=server_url)
+    client.set_encryption_key(BENCH_KEY)
+    return client
+
+
+def bench_transfer(client, parent_id, size, request_size, mode, workers, repeat=3):
+    """Measures store and fetch throughput of one configuration.
+
+    :param client: Client connected to the server
+    :param parent_id: vault or cluster the items are stored to
+    :param size: object size in bytes
+    :param request_size: client request size
+    :param mode: encryption mode
+    :param workers: number of concurrent chunk transfers
+    :param repeat: number of timed runs
+
+    Returns [store result, fetch result] in MB/s.
+
+    """
+    client.encryption_mode = mode
+    client.set_request_size(request_size)
+    data = os.urandom(size)
+    params = {'size': size, 'request_size': request_size, 'mode': mode, 'workers': workers}
+    store_samples = []
+    fetch_samples = []
+    for run in range(repeat):
+        key = 'transfer-{0}-{1}-{2}-{3}-{4}'.format(size, request_size, mode, workers, run)
+        start = time.time()
+        client.store_data(parent_id, key, StringIO.StringIO(data), workers=workers if workers > 1 else None)
+        store_samples.append(time.time() - start)
+
+        start = time.time()
+        response = client.fetch_data(parent_id, key, workers=workers)
+        fetched = 0
+        for chunk in response['data']:
+            fetched += len(chunk)
+        fetch_samples.append(time.time() - start)
+        if fetched != size:
+            raise RuntimeError("Fetched {0} bytes of {1}".format(fetched, size))
+        client.remove_dataitem(parent_id, key)
+    megabytes = size / 1048576.0
+    return [_result('store', params, 'MB/s', store_samples, True, megabytes),
+            _result('fetch', params, 'MB/s', fetch_samples, True, megabytes)]
+
+
+def bench_listing(client, vault_id, width, repeat=5):
+    """Measures list_dataitems and children latency of a wide cluster.
+
+    :param client: Client connected to the server
+    :param vault_id: vault the cluster is created in
+    :param width: number of data items and child clusters in the cluster
+    :param repeat: number of timed runs
+
+    Returns [list_dataitems result, children result] in milliseconds.
+
+    """
+    client.encryption_mode = utils.ENC_NONE
+    cluster = client.add_cluster('wide-{0}'.format(width), vault_id)
+    for index in range(width):
+        client.store_data(cluster.id, 'item-{0}'.format(index), StringIO.StringIO('x'))
+        client.add_cluster('child-{0}'.format(index), cluster.id)
+
+    results = []
+    for name, func in (('list_dataitems', lambda: client.list_dataitems(cluster.id)),
+                       ('children', lambda: client.list_clusters(cluster.id))):
+        samples = []
+        for run in range(repeat):
+            start = time.time()
+            if len(func()) != width:
+                raise RuntimeError("Listing returned a wrong number of entries")
+            samples.append(time.time() - start)
+        results.append(_result(name, {'width': width}, 'ms', samples, False, None))
+    client.remove_cluster(cluster.id)
+    return results
+
+
+def bench_head(client, parent_id, count=200, repeat=3):
+    """Measures get_dataitem (HEAD request) throughput.
+
+    :param client: Client connected to the server
+    :param parent_id: vault or cluster the item is stored to
+    :param count: number of requests per timed run
+    :param repeat: number of timed runs
+
+    Returns a result in requests per second.
+
+    """
+    client.encryption_mode = utils.ENC_NONE
+    client.store_data(parent_id, 'head', StringIO.StringIO('x' * 1024))
+    samples = []
+    for run in range(repeat):
+        start = time.time()
+        for index in range(count):
+            client.get_dataitem(parent_id, 'head')
+        samples.append(time.time() - start)
+    client.remove_dataitem(parent_id, 'head')
+    return _result('get_dataitem', {'count': count}, 'req/s', samples, True, count)
+
+
+def run_suite(server_url, sizes=DEFAULT_SIZES, request_sizes=DEFAULT_REQUEST_SIZES, modes=DEFAULT_MODES,
+              workers=DEFAULT_WORKERS, widths=DEFAULT_WIDTHS, head_count=200, repeat=3, progress=None,
+              user=BENCH_USER, password=BENCH_USER, apikey=None):
+    """Runs all benchmarks against server_url and returns the report dict
+
+    :param progress: function called with each result as it is ready
+    :param user: username used for authentication
+    :param password: password used for authentication
+    :param apikey: client's API-key
+
+    """
+    client = _client(server_url, user, password, apikey)
+    vault = client.add_vault('benchmark', 'benchmark-{0}'.format(int(time.time())))
+    results = []
+
+    def add(new_results):
+        for result in new_results:
+            results.append(result)
+            if progress is not None:
+                progress(result)
+
+    try:
+        for size in sizes:
+            for request_size in request_sizes:
+                if request_size > size and request_size != min(request_sizes):
+                    continue
+                for mode in modes:
+                    for worker_count in workers:
+                        add(bench_transfer(client, vault.id, size, request_size, mode, worker_count, repeat))
+        for width in widths:
+            add(bench_listing(client, vault.id, width, repeat))
+        if head_count:
+            add([bench_head(client, vault.id, head_count, repeat)])
+    finally:
+        client.remove_vault(vault.id)
+        client.connection.close()
+
+    return {'meta': {'time': time.time(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'server': server_url},
+            'results': results}
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """Compares a report against a baseline report.
+
+    :param report: report from run_suite
+    :param baseline: earlier report
+    :param threshold: relative change treated as significant
+
+    Returns a list of dicts with keys 'id', 'baseline', 'value', 'change'
+    and 'status' ('better', 'worse' or 'same') for results present in both.
+    change is relative, positive when the result got better.
+
+    """
+    old_results = dict((result['id'], result) for result in baseline.get('results', []))
+    comparison = []
+    for result in report['results']:
+        old = old_results.get(result['id'])
+        if old is None or not old['value']:
+            continue
+        change = (result['value'] - old['value']) / float(old['value'])
+        if not result['higher_is_better']:
+            change = -change
+        if change > threshold:
+            status = 'better'
+        elif change < -threshold:
+            status = 'worse'
+        else:
+            status = 'same'
+        comparison.append({'id': result['id'],
+                           'baseline': old['value'],
+                           'value': result['value'],
+                           'change': change,
+                           'status': status})
+    return comparison
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Holvi client end-to-end benchmarks")
+    parser.add_argument('--sizes', type=_int_list, default=DEFAULT_SIZES, help="comma separated object sizes")
+    parser.add_argument('--request-sizes', type=_int_list, default=DEFAULT_REQUEST_SIZES, help="comma separated request sizes")
+    parser.add_argument('--modes', default=','.join(DEFAULT_MODES), help="comma separated encryption modes")
+    parser.add_argument('--workers', type=_int_list, default=DEFAULT_WORKERS, help="comma separated concurrency levels")
+    parser.add_argument('--widths', type=_int_list, default=DEFAULT_WIDTHS, help="comma separated cluster widths for listing")
+    parser.add_argument('--head-count', type=int, default=200, help="HEAD requests per run, 0 skips")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument('--server', default=None, help="benchmark a running server instead of starting one")
+    parser.add_argument('--user', '-u', default=os.environ.get('HOLVI_USER', BENCH_USER),
+                        help="username used for authentication, $HOLVI_USER by default")
+    parser.add_argument('--password', '-p', default=os.environ.get('HOLVI_PASSWORD', BENCH_USER),
+                        help="password used for authentication, $HOLVI_PASSWORD by default")
+    parser.add_argument('--apikey', '-k', default=os.environ.get('HOLVI_APIKEY'),
+                        help="client's API-key, $HOLVI_APIKEY by default")
+    parser.add_argument('--subprocess', action="store_true", default=False, help="run the local server in a subprocess")
+    parser.add_argument('--directory', default=None, help="keep the local server's data on disk in this directory")
+    parser.add_argument('--output', '-o', default=None, help="write the JSON report to this file")
+    parser.add_argument('--baseline', '-b', default=None, help="compare against this JSON report")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="relative change reported as better/worse")
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    for mode in modes:
+        utils.validate_encryption_mode(mode)
+
+    def progress(result):
+        print >> sys.stderr, "{0}: {1:.2f} {2}".format(result['id'], result['value'], result['unit'])
+
+    kwargs = dict(sizes=args.sizes, request_sizes=args.request_sizes, modes=modes, workers=args.workers,
+                  widths=args.widths, head_count=args.head_count, repeat=args.repeat, progress=progress,
+                  user=args.user, password=args.password, apikey=args.apikey)
+    if args.server:
+        report = run_suite(args.server, **kwargs)
+    elif args.subprocess:
+        with ServerProcess(args.directory) as server:
+            report = run_suite(server.url, **kwargs)
+    else:
+        with LocalServer(args.directory) as server:
+            report = run_suite(server.url, **kwargs)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print >> sys.stdout
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare(report, json.load(baseline_file), args.threshold)
+        for entry in comparison:
+            print >> sys.stderr, "{0}: {1:+.1%} {2}".format(entry['id'], entry['change'], entry['status'])
+        if any(entry['status'] == 'worse' for entry in comparison):
+            sys.exit(1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import collections
+
+
+class TTLCache(object):
+    """TTLCache keeps values for a limited time.
+
+    Entries expire ttl seconds after they were stored. At most max_entries
+    are kept, and at most max_size in total when entries are given a size.
+    The least recently used entry is dropped first. Hits, misses and
+    evictions are counted in stats.
+
+    """
+    def __init__(self, ttl, max_entries, max_size=None):
+        """Initializer for TTLCache
+
+        :param ttl: seconds an entry is valid
+        :param max_entries: largest number of entries kept
+        :param max_size: largest total size of the entries kept, None for no limit
+
+        """
+        if ttl <= 0 or max_entries <= 0:
+            raise ValueError("ttl and max_entries must be positive")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for key, None if missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self.size -= entry[2]
+                self.stats['misses'] += 1
+                return None
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value, ttl=None, size=1):
+        """Stores value for key
+
+        :param ttl: seconds the entry is valid, the cache's ttl by default
+        :param size: size of the entry counted against max_size
+
+        """
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.time() + (ttl or self.ttl), value, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_size is not None and self.size > self.max_size and self._entries):
+                self.size -= self._entries.popitem(last=False)[1][2]
+                self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """Drops the entry of key"""
+        with self._lock:
+            self._drop(key)
+
+    def invalidate_matching(self, predicate):
+        """Drops the entries for which predicate(key, value) is true"""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if predicate(key, entry[1]):
+                    self._drop(key)
+
+    def clear(self):
+        """Drops all entries"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class MetadataCache(TTLCache):
+    """MetadataCache keeps DataItem information for a limited time.
+
+    Entries are keyed by (server url, parent id, key), see TTLCache.
+
+    """
+    def __init__(self, ttl=60.0, max_entries=1024, max_size=None):
+        """Initializer for MetadataCache
+
+        :param ttl: seconds an entry is valid
+        :param max_entries: largest number of entries kept
+        :param max_size: largest total size of the entries kept, None for no limit
+
+        """
+        super(MetadataCache, self).__init__(ttl, max_entries, max_size)
+
+
+class ListingCache(TTLCache):
+    """ListingCache keeps the contents of Vaults and Clusters for a limited time.
+
+    Entries are keyed by (server url, listing, parent id) where listing is
+    'clusters' or 'dataitems'. The size of an entry is the number of listed
+    items, max_size bounds the items kept in all entries.
+
+    """
+    def __init__(self, ttl=30.0, max_entries=256, max_size=100000):
+        """Initializer for ListingCache
+
+        :param ttl: seconds an entry is valid
+        :param max_entries: largest number of listings kept
+        :param max_size: largest total number of listed items kept
+
+        """
+        super(ListingCache, self).__init__(ttl, max_entries, max_size)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
+import os
 import argparse
 import io
 import StringIO
@@ -17,6 +18,9 @@ def main(argv=sys.argv):
     auth_group.add_argument('--user', '-u', action="store", required=True, help="username to be used for authentication")
     auth_group.add_argument('--password', '-p', action="store", required=True, help="password to be used for authentication")
     auth_group.add_argument('--apikey', '-k', action="store", required=True, help="client's API-key")
+    auth_group.add_argument('--session-cache', action="store_true", default=False, help="reuse the authenticated session of earlier runs")
+    auth_group.add_argument('--session-file', default=holvi.session.DEFAULT_SESSION_PATH, help="file of the session cache (default: ~/.holvi/sessions.json)")
+    auth_group.add_argument('--session-max-age', type=int, default=holvi.session.DEFAULT_MAX_AGE, help="seconds a cached session is reused (default: 86400)")
     auth_group.add_argument('--server', '-s', action="store", default=holvi.utils.SERVER_DEFAULT, help="server to be used (default: https://my.holvi.org/)")
 
     cmd_parsers = parser.add_subparsers(title='available actions')
@@ -65,10 +69,14 @@ def main(argv=sys.argv):
     store_data_parser.add_argument('--method', '-m', choices=('new', 'replace', 'append', 'patch'), default='new', help="storing method")
     store_data_parser.add_argument('--file', '-f', type=argparse.FileType('rb'), help="file containing the data to be stored")
     store_data_parser.add_argument('--offset', '-o', type=int, help="byte offset")
+    store_data_parser.add_argument('--workers', '-w', type=int, default=None, help="number of chunks uploaded concurrently")
+    store_data_parser.add_argument('--pipelined', action="store_true", default=False, help="read and encrypt ahead while sending")
+    store_data_parser.add_argument('--resume', action="store_true", default=False, help="continue an interrupted upload of the same file")
     encryption_group = store_data_parser.add_mutually_exclusive_group(required=True)
     encryption_group.add_argument('--cryptkey', '-ck', type=argparse.FileType('rb'), help="path to cipher key file (filesize of 32 bytes required for AES256)")
     encryption_group.add_argument('--no-encryption', '-nocrypt', action="store_true", default=False, help="disable encryption")
     store_data_parser.add_argument('--initvector', '-iv', type=argparse.FileType('rb'), default=None, help="path to initialization vector file (filesize of 16 bytes required for AES256), IV defaults to a value of 0x31323334353637383930313233343536.")
+    store_data_parser.add_argument('--chunked', action="store_true", default=False, help="encrypt in independently authenticated segments (ENC:AES256-CHUNKED)")
     store_data_parser.set_defaults(func=store_data)
 
     fetch_data_parser = cmd_parsers.add_parser('fetch', help='fetch data item')
@@ -76,16 +84,28 @@ def main(argv=sys.argv):
     fetch_data_parser.add_argument('--name', '-n', required=True, help="data item name")
     fetch_data_parser.add_argument('--file', '-f', type=argparse.FileType('wb', 0), help="file to write the retrieved data into")
     fetch_data_parser.add_argument('--cryptkey', '-ck', type=argparse.FileType('rb'), help="path to cipher key file (filesize of 32 bytes required for AES256)")
+    fetch_data_parser.add_argument('--workers', '-w', type=int, default=None, help="number of byte ranges fetched concurrently")
+    fetch_data_parser.add_argument('--pipelined', action="store_true", default=False, help="receive, decrypt and write on separate threads")
+    fetch_data_parser.add_argument('--resume', metavar='PATH', default=None, help="fetch into PATH, continuing an interrupted fetch of it")
     fetch_data_parser.add_argument('--info', '-i', action="store_true", default=False, help="retrieve data item information only")
     fetch_data_parser.add_argument('--initvector', '-iv', type=argparse.FileType('rb'), default=None, help="path to initialization vector file (filesize of 16 bytes required for AES256), IV defaults to a value of 0x31323334353637383930313233343536.")
+    fetch_data_parser.add_argument('--chunked', action="store_true", default=False, help="data item is encrypted in segments (ENC:AES256-CHUNKED)")
     fetch_data_parser.set_defaults(func=fetch_data)
 
     param_group = parser.add_argument_group('parameters')
     param_group.add_argument('--verbose', '-v', action="store_true", default=False, help="enable progress printing")
+    param_group.add_argument('--auto-request-size', action="store_true", default=False, help="tune the request size from measured transfer speed")
+    param_group.add_argument('--crypt-workers', type=int, default=None, help="number of processes used for encryption/decryption")
 
     args = parser.parse_args()
 
     client = holvi.Client(username=args.user, auth_data=args.password, apikey=args.apikey, server_url=args.server)
+    if args.crypt_workers:
+        client.set_crypt_workers(args.crypt_workers, processes=True)
+    if args.auto_request_size:
+        client.set_auto_request_size()
+    if args.session_cache:
+        client.set_session_store(args.session_file, args.session_max_age)
 
     try:
         args.func(args, client)
@@ -151,7 +171,7 @@ def store_data(args, client):
             iv = args.initvector.read()
         else:
             iv = holvi.utils.IV_DEFAULT
-        enc_mode = holvi.utils.ENC_AES256
+        enc_mode = holvi.utils.ENC_AES256_CHUNKED if args.chunked else holvi.utils.ENC_AES256
     else:
         cryptkey = None
         iv = holvi.utils.IV_DEFAULT
@@ -168,15 +188,18 @@ def store_data(args, client):
         data = sys.stdin
     if args.verbose:
         print >> sys.stdout, "Sending data"
-    response = client.store_data(parent_id=args.id, key=args.name, method=args.method, p_data=data, offset=args.offset)
+    response = client.store_data(parent_id=args.id, key=args.name, method=args.method, p_data=data, offset=args.offset, workers=args.workers, pipelined=args.pipelined, resume=args.resume)
     if args.verbose:
         print >> sys.stdout, response
+        if client.pipeline_stats:
+            for name, stats in sorted(client.pipeline_stats.items()):
+                print >> sys.stdout, "{0}: {1:.3f}s {2} chunks {3} bytes".format(name, stats['seconds'], stats['items'], stats['bytes'])
     data.close()
 
 def fetch_data(args, client):
     if args.cryptkey:
         cryptkey = bytearray(args.cryptkey.read())
-        enc_mode = holvi.utils.ENC_AES256
+        enc_mode = holvi.utils.ENC_AES256_CHUNKED if args.chunked else holvi.utils.ENC_AES256
     else:
         cryptkey = None
         enc_mode = holvi.utils.ENC_NONE
@@ -194,9 +217,32 @@ def fetch_data(args, client):
     response = None
     if args.verbose:
         print >> sys.stdout, "Fetching data"
-    if not args.info:
+    if args.resume and not args.info:
+        result = client.fetch_resumable(parent_id=args.id, key=args.name, path=args.resume)
+        if args.verbose:
+            if result['resumed_from']:
+                print >> sys.stdout, "Resumed from byte", result['resumed_from']
+            print >> sys.stdout, "OK"
+    elif args.pipelined and not args.info:
+        try:
+            stats = client.fetch_to_file(parent_id=args.id, key=args.name, path=args.file or sys.stdout)
+        finally:
+            if args.file:
+                args.file.close()
+        if args.verbose:
+            report = sys.stdout if args.file else sys.stderr
+            print >> report, "OK"
+            for name, stage in sorted(stats.items()):
+                print >> report, "{0}: {1:.3f}s {2} chunks {3} bytes".format(name, stage['seconds'], stage['items'], stage['bytes'])
+    elif args.file and args.file is not sys.stdout and os.path.isfile(args.file.name) and not args.info:
+        # Positional writes need a regular file, others are written in order below
+        args.file.close()
+        client.fetch_to_path(parent_id=args.id, key=args.name, path=args.file.name, workers=args.workers)
+        if args.verbose:
+            print >> sys.stdout, "OK"
+    elif not args.info:
         try:
-            response = client.fetch_data(parent_id=args.id, key=args.name)
+            response = client.fetch_data(parent_id=args.id, key=args.name, workers=args.workers)
         except:
             args.file.close()
     else:
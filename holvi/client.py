@@ -1,28 +1,102 @@
 # -*- coding: utf-8 -*-
 import os
+import copy
+import urllib2
+import sys
+import Queue
+import collections
 from decorator import decorator
 
 import utils
 import filecrypt
+import pipeline
+import tuning
+import journal
+import cache
+import batch
+import session
 from .container import Cluster, Vault
 from .dataitem import DataItem
-from .connection import Connection
-from holvi.exceptions import HolviAPIException
+from .connection import Connection, DEFAULT_BATCH_SIZE
+from .workers import WorkerPool
+from holvi.exceptions import HolviAPIException, HolviAuthException
+
+WALK_ORDERS = ('completion', 'breadth')
+# Operations sent again when the server rejects a restored session
+REPLAY_OPERATIONS = ('list_vaults', 'list_clusters', 'list_dataitems', 'get_dataitem', 'fetch_data',
+                     'fetch_to_file', 'fetch_to_path', 'fetch_resumable')
 
 @decorator
 def require_auth(fn, cls, *args, **kwargs):
     """If Client is not yet authenticated, authenticates Client before
     doing requested operation.
 
+    Threads sharing the Connection wait for one authentication instead of
+    each sending their own.
+
+    A session restored from the Client's session store is used without
+    checking it first. If the server rejects it, the saved session is
+    dropped, the Client authenticates again and the operation is sent once
+    more if it can be: REPLAY_OPERATIONS and store_data of data that can be
+    rewound with seek. Other operations raise the rejection.
+
     """
-    if not cls.connection._is_authed:
-        cls.auth()
+    connection = cls.connection
+    if not connection._is_authed:
+        with connection._auth_lock:
+            if not connection._is_authed:
+                if not cls._restore_session():
+                    cls.auth()
+    if not connection._session_restored:
+        return fn(cls, *args, **kwargs)
+    rewind = _replay_point(fn.__name__, args, kwargs)
+    try:
+        result = fn(cls, *args, **kwargs)
+    except (HolviAuthException, urllib2.HTTPError) as e:
+        if isinstance(e, urllib2.HTTPError) and e.code not in (401, 403):
+            raise
+        rejected = sys.exc_info()
+    else:
+        connection._session_restored = False
+        return result
+    cls._drop_session()
+    if rewind is None:
+        raise rejected[0], rejected[1], rejected[2]
+    rewind()
     return fn(cls, *args, **kwargs)
 
+def _replay_point(name, args, kwargs):
+    """Returns a function preparing operation name for being sent again,
+    None if it can not be.
+
+    """
+    if name in REPLAY_OPERATIONS:
+        return lambda: None
+    if name != 'store_data':
+        return None
+    data = kwargs['p_data'] if 'p_data' in kwargs else args[2]
+    try:
+        position = data.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+    return lambda: data.seek(position)
+
 class Client(object):
     """Client provides interface for performing Holvi server operations.
     Client's Connection is used by Vault/Cluster and DataItem objects.
 
+    One authenticated Client can be shared by many threads: authentication
+    is done once for all of them, the Connection's connection pools and
+    cookie jar are locked and the metadata and listing caches lock their
+    entries. With set_auto_request_size, concurrent transfers record their
+    chunk times and have their chunk size updated under the tuner's lock.
+    The tuned size is copied to the Client's request size without a lock,
+    so a transfer starting meanwhile may use the previous size. The
+    settings (encryption, request size, caches) are shared by all threads
+    and should not be changed while other threads use the Client. Threads
+    needing their own encryption parameters use with_encryption, which
+    returns a Client sharing the Connection.
+
     """
     __META_VERSION__ = 1
 
@@ -47,7 +121,16 @@ class Client(object):
         self._request_size = 2097152
         self.encryption_mode = enc_mode
         self.crypt = filecrypt.FileCrypt(enc_key, iv)
+        self._crypt_workers = None
+        self._crypt_processes = False
         self.connection = Connection(server_url)
+        self.pipeline_stats = None
+        self._tuner = None
+        self._tuning_store = None
+        self.journal_dir = journal.DEFAULT_JOURNAL_DIR
+        self.metadata_cache = None
+        self.listing_cache = None
+        self.session_store = None
 
     @property
     def apikey(self):
@@ -105,7 +188,7 @@ class Client(object):
         :param value: new encryption key.
 
         """
-        self.crypt._crypt_key = value
+        self.crypt = filecrypt.FileCrypt(value, self.crypt._crypt_iv)
 
     def set_iv(self, value):
         """Sets initialization vector.
@@ -113,7 +196,42 @@ class Client(object):
         :param value: new initialization vector
 
         """
-        self.crypt._crypt_iv = value
+        self.crypt = filecrypt.FileCrypt(self.crypt._crypt_key, value)
+
+    def with_encryption(self, enc_mode=None, enc_key=None, iv=None):
+        """Returns a Client with its own encryption parameters.
+
+        :param enc_mode: encryption mode, this Client's mode by default.
+        :param enc_key: encryption key, this Client's key by default.
+        :param iv: initialization vector, this Client's iv by default.
+
+        The returned Client shares this Client's Connection, authentication,
+        caches and tuning, so per-call encryption parameters need neither a
+        new login nor changes to the shared Client:
+
+            client.with_encryption(enc_key=user_key).store_data(parent_id, key, data)
+
+        """
+        other = copy.copy(self)
+        if enc_mode is not None:
+            other.encryption_mode = enc_mode
+        other.crypt = filecrypt.FileCrypt(self.crypt._crypt_key if enc_key is None else enc_key,
+                                          self.crypt._crypt_iv if iv is None else iv)
+        other.pipeline_stats = None
+        return other
+
+    def set_crypt_workers(self, value, processes=False):
+        """Sets the number of segments encrypted/decrypted in parallel.
+
+        :param value: number of workers, None processes segments in the calling thread.
+        :param processes: use worker processes instead of threads.
+
+        Used when encrypting and decrypting ENC:AES256-CHUNKED data and when
+        decrypting ENC:AES256 data.
+
+        """
+        self._crypt_workers = value
+        self._crypt_processes = processes
 
     def set_password(self, value):
         """Sets password for Client.
@@ -157,6 +275,78 @@ class Client(object):
         if value <= 0:
             raise HolviAPIException(600, "Request size must be larger than 0")
         self._request_size = value
+        self._tuner = None
+
+    def set_metadata_cache(self, ttl=60.0, max_entries=1024):
+        """Keeps DataItem information from get_dataitem and DataItem properties
+        in a cache.metadata_cache for ttl seconds.
+
+        :param ttl: seconds an entry is valid, None disables the cache.
+        :param max_entries: largest number of entries kept.
+
+        Entries are invalidated when this Client stores to or removes the item.
+
+        """
+        if ttl is None:
+            self.metadata_cache = None
+            return
+        if ttl <= 0 or max_entries <= 0:
+            raise HolviAPIException(600, "Cache ttl and size must be larger than 0")
+        self.metadata_cache = cache.MetadataCache(ttl, max_entries)
+
+    def set_listing_cache(self, ttl=30.0, max_entries=256, max_items=100000):
+        """Keeps the child Clusters and DataItems listed under Vaults and
+        Clusters in a cache.ListingCache for ttl seconds.
+
+        :param ttl: seconds a listing is valid, None disables the cache.
+        :param max_entries: largest number of listings kept.
+        :param max_items: largest number of listed items kept in all listings.
+
+        Listings of a parent are invalidated when this Client adds or removes
+        a cluster under it, or stores to or removes a DataItem in it.
+
+        """
+        if ttl is None:
+            self.listing_cache = None
+            return
+        if ttl <= 0 or max_entries <= 0 or max_items <= 0:
+            raise HolviAPIException(600, "Cache ttl and size must be larger than 0")
+        self.listing_cache = cache.ListingCache(ttl, max_entries, max_items)
+
+    def set_session_store(self, path=session.DEFAULT_SESSION_PATH, max_age=session.DEFAULT_MAX_AGE):
+        """Keeps the authenticated session in a session.SessionStore file, so
+        later Clients of the same server and username skip authentication.
+
+        :param path: path of the session file, None disables the store.
+        :param max_age: seconds a saved session is used.
+
+        """
+        self.session_store = session.SessionStore(path, max_age) if path else None
+
+    def set_auto_request_size(self, minimum=262144, maximum=67108864, target_seconds=1.0,
+                              state_path=tuning.DEFAULT_STATE_PATH):
+        """Lets the request size be tuned from measured transfers.
+
+        :param minimum: smallest request size used.
+        :param maximum: largest request size used.
+        :param target_seconds: preferred transfer time of one chunk.
+        :param state_path: JSON file the tuned size is kept in per server url,
+                           None does not persist it.
+
+        Chunk throughput and latency of DataItem uploads and downloads are
+        measured and the request size is grown or shrunk within the bounds.
+        A size stored for the server url earlier is used as the starting
+        point. set_request_size turns tuning off.
+
+        """
+        if minimum <= 0 or maximum < minimum:
+            raise HolviAPIException(600, "Request size bounds must be larger than 0")
+        self._tuning_store = tuning.TuningStore(state_path) if state_path else None
+        size = self._request_size
+        if self._tuning_store is not None:
+            size = self._tuning_store.get(self.server_url) or size
+        self._tuner = tuning.ChunkSizeTuner(size, minimum, maximum, target_seconds)
+        self._request_size = self._tuner.size
 
     def auth(self):
         """Authenticates Client connection.
@@ -164,6 +354,35 @@ class Client(object):
         for authenticating Client's connection.
         """
         self.connection.auth(self._username, self._auth_data, self._auth_method, self._apikey)
+        self.connection._session_restored = False
+        if self.session_store is not None:
+            self.session_store.save(self.server_url, self._username, self.connection.get_cookies())
+
+    def _restore_session(self):
+        """Loads a saved session into the Connection, returns True if there was one.
+        The server has not accepted the session yet, see require_auth.
+
+        """
+        if self.session_store is None:
+            return False
+        cookies = self.session_store.load(self.server_url, self._username)
+        if not cookies:
+            return False
+        self.connection.set_cookies(cookies)
+        self.connection._session_restored = True
+        self.connection._is_authed = True
+        return True
+
+    def _drop_session(self):
+        """Removes a restored session the server rejected and authenticates again.
+        Threads rejected at the same time authenticate once.
+
+        """
+        with self.connection._auth_lock:
+            if self.connection._session_restored:
+                if self.session_store is not None:
+                    self.session_store.remove(self.server_url, self._username)
+                self.auth()
 
     @require_auth
     def list_vaults(self, vault_type=None, id_=None, role=None):
@@ -236,7 +455,10 @@ class Client(object):
             "parent_id": parent_id,
             "name": name
             }
-        response = self.connection.make_request(method, params)
+        try:
+            response = self.connection.make_request(method, params)
+        finally:
+            self._invalidate_cluster(parent_id)
 
         cluster_item = response['cluster']
         cluster = Cluster(self, **cluster_item)
@@ -282,7 +504,85 @@ class Client(object):
         return cluster.dataitems
 
     @require_auth
-    def store_data(self, parent_id, key, p_data, method="new", offset=None):
+    def batch(self, max_batch=DEFAULT_BATCH_SIZE):
+        """Returns a batch.Batch sending container and dataitem calls in batched requests.
+
+        :param max_batch: largest number of calls sent in one request.
+
+        Used as a context manager the calls are sent at the end of the block:
+
+            with client.batch() as calls:
+                results = [calls.remove_dataitem(parent_id, key) for key in keys]
+
+        """
+        return batch.Batch(self, max_batch)
+
+    @require_auth
+    def walk(self, root_id, workers=8, max_depth=None, prune=None, order='completion'):
+        """Walks the Clusters under a Cluster/Vault breadth-first.
+
+        :param root_id: id of the Cluster/Vault the walk starts from.
+        :param workers: number of clusters listed concurrently.
+        :param max_depth: deepest level listed, the root is level 0, None lists all levels.
+        :param prune: function(cluster) returning True for clusters to be
+                      left out together with everything under them.
+        :param order: 'completion' yields clusters as their listings finish,
+                      'breadth' yields them level by level in listing order.
+
+        Yields (Cluster, list of DataItems) for the root and every cluster
+        under it while the walk runs. Each cluster's children and dataitems
+        are listed by a WorkerPool with at most workers requests in flight,
+        listings use the listing cache when enabled. An error in a listing
+        stops the walk and is raised to the caller.
+
+        """
+        if order not in WALK_ORDERS:
+            raise HolviAPIException(600, "Unknown walk order '{0}'".format(order))
+
+        def list_cluster(cluster, depth):
+            children = []
+            if max_depth is None or depth < max_depth:
+                children = [child for child in cluster.children if prune is None or not prune(child)]
+            return cluster, depth, children, cluster.dataitems
+
+        pool = WorkerPool(workers, workers * 4)
+        try:
+            root = Cluster(self, id=root_id)
+            if order == 'breadth':
+                pending = collections.deque([pool.submit(list_cluster, root, 0)])
+                while pending:
+                    cluster, depth, children, dataitems = pending.popleft().result()
+                    for child in children:
+                        pending.append(pool.submit(list_cluster, child, depth + 1))
+                    yield cluster, dataitems
+                return
+
+            finished = Queue.Queue()
+
+            def list_and_report(cluster, depth):
+                try:
+                    finished.put((list_cluster(cluster, depth), None))
+                except BaseException:
+                    finished.put((None, sys.exc_info()))
+
+            pool.submit(list_and_report, root, 0)
+            outstanding = 1
+            while outstanding:
+                result, exc_info = finished.get()
+                outstanding -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                cluster, depth, children, dataitems = result
+                for child in children:
+                    pool.submit(list_and_report, child, depth + 1)
+                    outstanding += 1
+                yield cluster, dataitems
+        finally:
+            pool.shutdown()
+
+    @require_auth
+    def store_data(self, parent_id, key, p_data, method="new", offset=None, workers=None, pipelined=False,
+                   resume=False):
         """Stores data to Holvi server.
 
         :param parent_id: id of the parent Cluster/Vault where to store data to.
@@ -290,35 +590,137 @@ class Client(object):
         :param p_data: data to be stored.
         :param method: storing method ['new', 'append', 'replace', 'patch'].
         :param offset: starting byte when using mode 'patch'.
+        :param workers: number of chunks uploaded concurrently, None uploads chunks one by one.
+        :param pipelined: read and encrypt the next chunks on background threads
+                          while the current chunk is being sent.
+        :param resume: keep an upload journal in journal_dir and continue an
+                       interrupted upload of the same file where it stopped.
 
         Creates a DataItem with parent_id and key.
         Creates a iterator for data and calls for DataItem's store_data.
+        Per-stage timing of a pipelined store is left in pipeline_stats.
+        Resuming is only possible for regular files, other data is stored
+        as usual. A resumed upload sends its chunks one by one.
+        Other uploads of regular files read them through a memory map, see
+        filecrypt.MmapFile.
 
         """
         dataitem = DataItem(self, parent_id, key)
 
-        if self.encryption_mode == utils.ENC_NONE:
-            data = filecrypt.FileIterator(p_data, self._request_size)
+        if resume:
+            identity = journal.source_identity(p_data)
+            if identity is not None:
+                return self._store_resumable(dataitem, p_data, method, offset, identity)
+
+        mapped = filecrypt.mmap_source(p_data)
+        if mapped is not None:
+            p_data = mapped
+        try:
+            return self._store_chunks(dataitem, p_data, method, offset, workers, pipelined)
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+    def _store_chunks(self, dataitem, p_data, method, offset, workers, pipelined):
+        """Creates the chunk iterator or pipeline for p_data and stores it with dataitem"""
+        if pipelined:
+            source = filecrypt.FileIterator(p_data, self._request_size, hashed=False)
+            self._attach_tuner(source)
+            stages = []
+            encryptor = self._encryptor()
+            if encryptor is not None:
+                stages.append(('encrypt', encryptor))
+            stages.append(('hash', filecrypt.ChunkHasher()))
+            data = pipeline.Pipeline(source, stages, sink_name='send')
+            try:
+                result = dataitem.store_data(data, method, offset, workers)
+            finally:
+                data.close()
+                self._close_encryptor(encryptor)
+                self._detach_tuner(source)
+                self.pipeline_stats = data.stats
+            return result
+
+        encryptor = self._encryptor()
+        if encryptor is None:
+            data = filecrypt.FileIterator(p_data, self._request_size, hashed=False)
         else:
-            data = self.crypt.encrypt(p_data, self._request_size)
-
-        result = dataitem.store_data(data, method, offset)
+            data = filecrypt.CryptIterator(p_data, encryptor, self._request_size, hashed=False)
+
+        self._attach_tuner(data)
+        try:
+            result = dataitem.store_data(data, method, offset, workers)
+        finally:
+            self._close_encryptor(encryptor)
+            self._detach_tuner(data)
         return result
 
     @require_auth
-    def fetch_data(self, parent_id, key):
+    def fetch_data(self, parent_id, key, workers=None):
         """Retrieves data from Holvi server.
 
         :param parent_id: id of the parent Cluster/Vault where to retrieve data from.
         :param key: name of the dataitem where to retrieve data from.
+        :param workers: number of byte ranges fetched concurrently, None fetches data in one request.
 
         Creates a DataItem with parent_id and key.
         Returns DataItem's data.
 
         """
         dataitem = DataItem(self, parent_id, key)
+        if workers and workers > 1:
+            return dataitem.fetch_parallel(workers)
         return dataitem.data
 
+    @require_auth
+    def fetch_to_file(self, parent_id, key, path):
+        """Retrieves data from Holvi server into a file.
+
+        :param parent_id: id of the parent Cluster/Vault where to retrieve data from.
+        :param key: name of the dataitem where to retrieve data from.
+        :param path: path of the file to be written, or a writable file object.
+
+        Creates a DataItem with parent_id and key.
+        Receives, decrypts and writes the data in a pipeline, per-stage timing
+        is left in pipeline_stats.
+
+        """
+        dataitem = DataItem(self, parent_id, key)
+        self.pipeline_stats = dataitem.fetch_to_file(path)
+        return self.pipeline_stats
+
+    @require_auth
+    def fetch_to_path(self, parent_id, key, path, workers=None):
+        """Retrieves data from Holvi server straight into a file.
+
+        :param parent_id: id of the parent Cluster/Vault where to retrieve data from.
+        :param key: name of the dataitem where to retrieve data from.
+        :param path: path of the file to be written.
+        :param workers: number of byte ranges fetched concurrently.
+
+        Creates a DataItem with parent_id and key and calls for DataItem's
+        fetch_to_path, which preallocates the file, writes each piece at its
+        offset and fsyncs once at the end.
+
+        """
+        dataitem = DataItem(self, parent_id, key)
+        return dataitem.fetch_to_path(path, workers)
+
+    @require_auth
+    def fetch_resumable(self, parent_id, key, path):
+        """Retrieves data from Holvi server into a file, continuing an interrupted fetch.
+
+        :param parent_id: id of the parent Cluster/Vault where to retrieve data from.
+        :param key: name of the dataitem where to retrieve data from.
+        :param path: path of the file to be written.
+
+        Creates a DataItem with parent_id and key and calls for DataItem's
+        fetch_resumable. Progress is kept in a state file next to path.
+
+        """
+        dataitem = DataItem(self, parent_id, key)
+        return dataitem.fetch_resumable(path)
+
     @require_auth
     def get_dataitem(self, parent_id, key):
         """Retrieves dataitem information from HolviServer.
@@ -332,7 +734,7 @@ class Client(object):
 
         """
         dataitem = DataItem(self, parent_id, key)
-        dataitem._get_item_info()
+        dataitem._get_item_info(cached=True)
         return dataitem
 
     @require_auth
@@ -349,3 +751,151 @@ class Client(object):
         dataitem = DataItem(self, parent_id, key)
         return dataitem.remove()
 
+    def _store_resumable(self, dataitem, p_data, method, offset, identity):
+        """Stores a regular file with an UploadJournal
+
+        :param dataitem: DataItem to store to.
+        :param p_data: file object of the data.
+        :param method: storing method.
+        :param offset: starting byte when using mode 'patch'.
+        :param identity: source identity of p_data.
+
+        An ENC:AES256-CHUNKED stream is re-created with the nonce saved in
+        the journal, so the resumed part continues the stored ciphertext.
+
+        """
+        upload_journal = journal.UploadJournal(self.journal_dir, self.server_url,
+                                               dataitem.parent_id, dataitem.name, identity)
+        encryptors = []
+
+        def make_data(resuming):
+            p_data.seek(0)
+            header = {'encryption': self.encryption_mode}
+            nonce = None
+            if self.encryption_mode == utils.ENC_AES256_CHUNKED:
+                if resuming:
+                    nonce = upload_journal.header.get('nonce', '').decode('hex') or None
+                nonce = nonce or os.urandom(8)
+                header['nonce'] = nonce.encode('hex')
+            encryptor = self._encryptor(nonce)
+            if encryptor is None:
+                data = filecrypt.FileIterator(p_data, self._request_size, hashed=False)
+            else:
+                encryptors.append(encryptor)
+                data = filecrypt.CryptIterator(p_data, encryptor, self._request_size, hashed=False)
+            return data, header
+
+        try:
+            return dataitem.store_resumable(make_data, method, offset, upload_journal)
+        finally:
+            for encryptor in encryptors:
+                self._close_encryptor(encryptor)
+
+    def _encryptor(self, nonce=None):
+        """Returns the function encrypting consecutive chunks in Client's
+        encryption mode, None if data is not encrypted.
+
+        :param nonce: stream nonce for ENC:AES256-CHUNKED, random by default.
+
+        """
+        if self.encryption_mode == utils.ENC_AES256:
+            return self.crypt.encryptor()
+        if self.encryption_mode == utils.ENC_AES256_CHUNKED:
+            return self.crypt.chunked_encryptor(self._crypt_workers, self._crypt_processes, nonce=nonce)
+        return None
+
+    def _close_encryptor(self, encryptor):
+        """Stops the worker pool of an encryptor from _encryptor, if it has one.
+        Failed and abandoned uploads never reach the encryptor's final.
+
+        """
+        close = getattr(encryptor, 'close', None)
+        if close is not None:
+            close()
+
+    def _decryptor(self):
+        """Returns the function decrypting consecutive chunks in Client's
+        encryption mode, None if data is not encrypted.
+
+        """
+        if self.encryption_mode == utils.ENC_AES256:
+            if self._crypt_workers and self._crypt_workers > 1:
+                return self.crypt.parallel_decryptor(self._crypt_workers, self._crypt_processes)
+            return self.crypt.decryptor()
+        if self.encryption_mode == utils.ENC_AES256_CHUNKED:
+            return self.crypt.chunked_decryptor(self._crypt_workers, self._crypt_processes)
+        return None
+
+    def _attach_tuner(self, iterator):
+        """Lets the request size tuner resize the chunks read by iterator"""
+        if self._tuner is not None:
+            self._tuner.attach(iterator)
+
+    def _detach_tuner(self, iterator):
+        """Stops resizing the chunks of iterator at the end of its transfer"""
+        if self._tuner is not None:
+            self._tuner.detach(iterator)
+            self._save_request_size()
+
+    def _save_request_size(self):
+        """Persists the tuned request size, once per transfer instead of on every change"""
+        if self._tuner is not None and self._tuning_store is not None:
+            self._tuning_store.put(self.server_url, self._tuner.size)
+
+    def _metadata_key(self, parent_id, key):
+        return (self.server_url, parent_id, key)
+
+    def _invalidate_metadata(self, parent_id, key):
+        """Drops cached information of a DataItem that is changed or removed"""
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(self._metadata_key(parent_id, key))
+
+    def _list(self, method, params, field, parent_id):
+        """Returns the items of a listing request, from the listing cache if enabled
+
+        :param method: 'list_clusters' or 'list_dataitems'.
+        :param params: parameters of the request.
+        :param field: 'clusters' or 'dataitems', the field of the listed items.
+        :param parent_id: id of the listed Cluster/Vault.
+
+        """
+        listing_cache = self.listing_cache
+        if listing_cache is None:
+            return self.connection.make_request(method, params)[field]
+        cache_key = (self.server_url, field, str(parent_id))
+        items = listing_cache.get(cache_key)
+        if items is None:
+            items = self.connection.make_request(method, params)[field]
+            listing_cache.put(cache_key, items, size=len(items) + 1)
+        return items
+
+    def _invalidate_listing(self, parent_id, field):
+        """Drops the cached listing of parent_id's clusters or dataitems"""
+        if self.listing_cache is not None:
+            self.listing_cache.invalidate((self.server_url, field, str(parent_id)))
+
+    def _invalidate_cluster(self, cluster_id):
+        """Drops the cached listings after a cluster is added under cluster_id
+        or a cluster or vault cluster_id is removed.
+
+        The descendant counts in the listings of the ancestors, and after a
+        removal the listings of the removed cluster's descendants, are stale
+        too, so the whole listing cache is cleared.
+
+        """
+        if self.listing_cache is not None:
+            self.listing_cache.clear()
+
+    def _record_chunk(self, nbytes, seconds, failed=False):
+        """Records a chunk transfer for request size tuning.
+
+        :param nbytes: size of the transferred chunk.
+        :param seconds: time the transfer took.
+        :param failed: True if the transfer failed.
+
+        """
+        if self._tuner is None:
+            return
+        size = self._tuner.record(nbytes, seconds, failed)
+        if size != self._request_size:
+            self._request_size = size
@@ -1,27 +1,304 @@
 # -*- coding: utf-8 -*-
+import collections
 import cookielib
+import httplib
+import select
+import socket
+import threading
 import urllib2
+import urlparse
 import json
 
 from exceptions import HolviUnknownException, HolviURLException, HolviCryptException, HolviException, HolviDataItemException
 import holvi.exceptions as exceptions
 
+DEFAULT_POOL_SIZE = 4
+DEFAULT_BATCH_SIZE = 100
+RETRY_METHODS = ('GET', 'HEAD')
+
+
+def _no_status_line(error):
+    """Returns True if error tells the server closed the connection without answering"""
+    if not isinstance(error, httplib.BadStatusLine):
+        return False
+    return error.line in ("''", '""') or error.line.startswith('No status line')
+
+
+class PooledResponse(object):
+    """PooledResponse wraps a httplib response read from a pooled connection.
+
+    The underlying connection is handed back to its pool as soon as the
+    response body has been read to the end. Closing the response before
+    that discards the connection.
+
+    """
+    def __init__(self, pool, conn, response, url):
+        """Initializer for PooledResponse
+
+        :param pool: ConnectionPool the connection was checked out from
+        :param conn: httplib connection the response was read from
+        :param response: httplib response
+        :param url: requested url
+
+        """
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.headers = response.msg
+        self.status = response.status
+        self.reason = response.reason
+        self.url = url
+        self._release_if_done()
+
+    def info(self):
+        """Returns response headers (used by cookielib)"""
+        return self.headers
+
+    def getcode(self):
+        """Returns HTTP status code of the response"""
+        return self.status
+
+    def geturl(self):
+        """Returns the requested url"""
+        return self.url
+
+    def read(self, amt=None):
+        """Reads at most amt bytes from the response body
+
+        :param amt: amount of bytes to read, None reads until the end
+
+        """
+        if self._conn is None and self._response.isclosed():
+            return ''
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        self._release_if_done()
+        return data
+
+    def readinto(self, b):
+        """Reads response body bytes into the writable buffer b
+
+        :param b: bytearray or memoryview to be filled
+
+        httplib responses have no readinto, the bytes are copied from read.
+        Returns the number of bytes read, 0 at the end of the body.
+
+        """
+        view = memoryview(b)
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        """Closes the response.
+
+        If the body has not been fully read the connection can not be
+        reused and is discarded.
+
+        """
+        if self._conn is not None:
+            if self._response.isclosed():
+                self._release_if_done()
+            else:
+                self._response.close()
+                self._pool._discard_conn(self._conn)
+                self._conn = None
+
+    def _release_if_done(self):
+        if self._conn is not None and self._response.isclosed():
+            conn, self._conn = self._conn, None
+            self._pool._put_conn(conn)
+
+
+class ConnectionPool(object):
+    """ConnectionPool keeps persistent HTTP/1.1 connections to one server.
+
+    At most maxsize idle connections are kept open for reuse, connections
+    checked out beyond that are closed when they are returned.
+
+    """
+    def __init__(self, scheme, host, maxsize=DEFAULT_POOL_SIZE, timeout=None):
+        """Initializer for ConnectionPool
+
+        :param scheme: 'http' or 'https'
+        :param host: host[:port] of the server
+        :param maxsize: maximum number of idle connections kept open
+        :param timeout: socket timeout used for new connections
+
+        """
+        if scheme == 'https':
+            self._conn_class = httplib.HTTPSConnection
+        elif scheme == 'http':
+            self._conn_class = httplib.HTTPConnection
+        else:
+            raise HolviURLException(800, "Unsupported url scheme '{0}'".format(scheme))
+        self.scheme = scheme
+        self.host = host
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0}
+
+    def urlopen(self, method, path, body=None, headers=None):
+        """Sends a request over a pooled connection.
+
+        :param method: HTTP method
+        :param path: request path
+        :param body: request body
+        :param headers: request headers
+
+        Idle connections the server has closed are not reused. If a reused
+        connection still fails, the request is sent once more on a fresh
+        connection when it is a GET or HEAD, or when the server closed the
+        connection before answering: sending failed or no status line was
+        received. Other failures of other methods are not retried, the
+        server may already have applied the request. A body that is a file
+        object is never resent. Returns a PooledResponse.
+
+        """
+        headers = headers or {}
+        conn, reused = self._get_conn()
+        sent = False
+        try:
+            self._request(conn, method, path, body, headers)
+            sent = True
+            response = conn.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            self._discard_conn(conn)
+            unanswered = not sent or _no_status_line(e)
+            if not reused or hasattr(body, 'read') or not (method in RETRY_METHODS or unanswered):
+                raise
+            conn = self._new_conn()
+            try:
+                self._request(conn, method, path, body, headers)
+                response = conn.getresponse()
+            except Exception:
+                self._discard_conn(conn)
+                raise
+        url = "{0}://{1}{2}".format(self.scheme, self.host, path)
+        return PooledResponse(self, conn, response, url)
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def _request(self, conn, method, path, body, headers):
+        if conn.sock is None:
+            conn.connect()
+            # Headers and a non-str body are sent separately, do not let
+            # the body wait for the ACK of the headers
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.request(method, path, body, headers)
+
+    def _new_conn(self):
+        with self._lock:
+            self.stats['created'] += 1
+        if self.timeout is None:
+            return self._conn_class(self.host)
+        return self._conn_class(self.host, timeout=self.timeout)
+
+    def _get_conn(self):
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if conn.sock is None:
+                    continue
+                if self._is_dropped(conn):
+                    self.stats['discarded'] += 1
+                    conn.close()
+                    continue
+                self.stats['reused'] += 1
+                return conn, True
+        return self._new_conn(), False
+
+    def _is_dropped(self, conn):
+        """Returns True if the server has closed the idle connection.
+
+        An idle connection has nothing to read until a request is sent, so
+        a readable socket is at EOF or holds bytes no request asked for.
+
+        """
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (socket.error, select.error, ValueError):
+            return True
+
+    def _put_conn(self, conn):
+        with self._lock:
+            if conn.sock is not None and len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        self._discard_conn(conn)
+
+    def _discard_conn(self, conn):
+        with self._lock:
+            self.stats['discarded'] += 1
+        conn.close()
+
+
 class Connection(object):
     """Connection provides methods for communicating with Holvi server
 
+    A Connection can be used from many threads. Authentication is
+    serialized, the cookie jar is used under the Connection's cookie lock
+    and each request checks out its own pooled connection.
+
     """
     __API_VERSION__ = "1.0"
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, pool_size=DEFAULT_POOL_SIZE, timeout=None):
         """Initializer for Connection
 
         :param server_url: Server used for requests
+        :param pool_size: Maximum number of idle keep-alive connections kept per server
+        :param timeout: Socket timeout for new connections
 
         """
         self._server_url = server_url
         self._cookies = cookielib.CookieJar()
-        self._opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self._cookies))
+        self._cookies_lock = threading.Lock()
+        self._auth_lock = threading.RLock()
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._pools = {}
+        self._pools_lock = threading.Lock()
         self._is_authed = False
+        self._session_restored = False
+
+    @property
+    def pool_stats(self):
+        """Returns connection reuse counters summed over all server pools"""
+        stats = {'created': 0, 'reused': 0, 'discarded': 0}
+        for pool in self._pools.values():
+            for key in stats:
+                stats[key] += pool.stats[key]
+        return stats
+
+    def get_cookies(self):
+        """Returns a list of the cookies in the cookie jar"""
+        with self._cookies_lock:
+            return list(self._cookies)
+
+    def set_cookies(self, cookies):
+        """Replaces the cookies in the cookie jar
+
+        :param cookies: cookielib.Cookie objects
+
+        """
+        with self._cookies_lock:
+            self._cookies.clear()
+            for cookie in cookies:
+                self._cookies.set_cookie(cookie)
+
+    def close(self):
+        """Closes all idle pooled connections"""
+        for pool in self._pools.values():
+            pool.close()
 
     def auth(self, username, auth_data, auth_method, apikey):
         """Authenticates connection with given credentials
@@ -39,12 +316,13 @@ class Connection(object):
                     "auth_method": auth_method,
                     "apikey": apikey
                 }
-        response = self.make_request(method, params)
-        if response['result'] == 'success':
-            self._is_authed = True
-        else:
-            self._is_authed = False
-            self._handle_exception(response)
+        with self._auth_lock:
+            response = self.make_request(method, params)
+            if response['result'] == 'success':
+                self._is_authed = True
+            else:
+                self._is_authed = False
+                self._handle_exception(response)
 
     def make_request(self, method, params):
         """Sends request to Holvi server with given method and parameters
@@ -61,13 +339,50 @@ class Connection(object):
                 "method": method,
                 "params": params
                 }
-        response = self._opener.open(url, json.JSONEncoder().encode(json_request))
+        body = json.JSONEncoder().encode(json_request)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        response = self._urlopen('POST', url, headers, body)
         response = json.JSONDecoder().decode(response.read())
         if response['result'] == 'success':
             return response
         else:
             self._handle_exception(response)
 
+    def make_batch_request(self, calls, max_batch=DEFAULT_BATCH_SIZE):
+        """Sends many method calls to Holvi server in batched requests
+
+        :param calls: List of (method, params) pairs
+        :param max_batch: Largest number of calls sent in one request
+
+        The calls are sent as a JSON list of request objects, at most
+        max_batch per POST, and the server answers with a list of response
+        objects in the same order. Returns a list with the response of each
+        successful call and the exception of each failed one, in call order.
+        Errors of the whole request, such as a server without batch
+        support, are raised.
+
+        """
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        url = self._server_url + "/api/" + self.__API_VERSION__ + "/json"
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        results = []
+        for start in range(0, len(calls), max_batch):
+            batch = calls[start:start + max_batch]
+            body = json.JSONEncoder().encode([{"method": method, "params": params} for method, params in batch])
+            response = self._urlopen('POST', url, headers, body)
+            responses = json.JSONDecoder().decode(response.read())
+            if not isinstance(responses, list):
+                self._handle_exception(responses)
+            if len(responses) != len(batch):
+                raise HolviUnknownException()
+            for response in responses:
+                if response.get('result') == 'success':
+                    results.append(response)
+                else:
+                    results.append(self._exception(response))
+        return results
+
     def make_transaction(self, headers, url_suffix, data = None):
         """Creates a transaction (download / upload) to Holvi server.
 
@@ -78,17 +393,16 @@ class Connection(object):
         Sends the request with given headers to Holvi server.
         """
         url = self._server_url + "/api/" + self.__API_VERSION__ + url_suffix
-        request = urllib2.Request(url)
-        self._cookies.add_cookie_header(request)
-        for key in headers:
-            request.add_header(key, headers[key])
-        request.data = data
-        response = urllib2.urlopen(request)
+        if data is None:
+            response = self._urlopen('GET', url, headers)
+        else:
+            response = self._urlopen('POST', url, headers, data)
 
         result = response.headers.get('X-HOLVI-RESULT')
         if result == 'OK':
             return response
         else:
+            response.close()
             err_type, err_id, err_message = result.split(' ', 2)  # Format is 'ERROR: Err# ErrMessage'
             raise HolviDataItemException(err_id, err_message)
 
@@ -102,40 +416,87 @@ class Connection(object):
         Returns response headers if succesful.
         """
         url = self._server_url + "/api/" + self.__API_VERSION__ + url_suffix
-        request = urllib2.Request(url)
-        request.get_method = lambda : 'HEAD'
-        self._cookies.add_cookie_header(request)
-        for key in headers:
-            request.add_header(key, headers[key])
-
-        response = urllib2.urlopen(request)
+        response = self._urlopen('HEAD', url, headers)
+        response.read()
         result = response.headers.get('X-HOLVI-RESULT')
         if result != 'OK':
             err_type, err_id, err_message = result.split(' ', 2)  # Format is 'ERROR: Err# ErrMessage'
             raise HolviDataItemException(err_id, err_message)
         return response.headers
 
+    def _urlopen(self, method, url, headers, data=None):
+        """Sends a request over the pooled connection of the url's server
+
+        :param method: HTTP method
+        :param url: full request url
+        :param headers: headers to be added to the request
+        :param data: request body
+
+        Adds and extracts cookies using Connection's cookie jar.
+        Raises urllib2.HTTPError on HTTP error statuses and urllib2.URLError
+        on socket errors, the same way urllib2.urlopen does.
+
+        """
+        request = urllib2.Request(url)
+        for key in headers:
+            request.add_header(key, headers[key])
+        with self._cookies_lock:
+            self._cookies.add_cookie_header(request)
+        request_headers = dict(request.header_items())
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+
+        try:
+            response = self._get_pool(scheme, host).urlopen(method, path or '/', data, request_headers)
+        except (socket.error, httplib.HTTPException) as e:
+            raise urllib2.URLError(e)
+
+        with self._cookies_lock:
+            self._cookies.extract_cookies(response, request)
+        if response.status >= 400:
+            response.close()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.headers, None)
+        return response
+
+    def _get_pool(self, scheme, host):
+        """Returns the ConnectionPool for given server, creating it when needed"""
+        with self._pools_lock:
+            pool = self._pools.get((scheme, host))
+            if pool is None:
+                pool = ConnectionPool(scheme, host, self._pool_size, self._timeout)
+                self._pools[(scheme, host)] = pool
+            return pool
+
     def _handle_exception(self, response):
         """Handles the exceptions in request responses
 
         :param response: The response to be parsed for exceptions
 
         Parses the exception from response and raises correct exception.
+        """
+        raise self._exception(response)
+
+    def _exception(self, response):
+        """Returns the exception described by an error response
+
+        :param response: The response to be parsed for exceptions
+
         """
         exception = response.get('exception')
         if not exception:
             print response
-            raise HolviUnknownException()
+            return HolviUnknownException()
 
         message = exception.get('message')
         id_ = exception.get('id')
         type_ = exception.get('type')
 
         if hasattr(exceptions, type_):
-            raise getattr(exceptions, type_)(id_, message)
+            return getattr(exceptions, type_)(id_, message)
         else:
             print response
-            raise HolviUnknownException()
+            return HolviUnknownException()
 
 #   def _handle_transaction_exception(self, exception):
 #       """Handles the exceptions occured during transactions
@@ -27,7 +27,10 @@ class Cluster(object):
         params = {
             "cluster_id": self.id
             }
-        response = self._client.connection.make_request(method, params)
+        try:
+            response = self._client.connection.make_request(method, params)
+        finally:
+            self._client._invalidate_cluster(self.id)
         return
 
     @property
@@ -41,10 +44,8 @@ class Cluster(object):
         params = {
             "parent_id": self.id
             }
-        response = self._client.connection.make_request(method, params)
-
         clusters = []
-        for item in response['clusters']:
+        for item in self._client._list(method, params, 'clusters', self.id):
             clusters.append(Cluster(self._client, **item))
         return clusters
 
@@ -59,10 +60,8 @@ class Cluster(object):
         params = {
             "cluster_id": self.id
             }
-        response = self._client.connection.make_request(method, params)
-
         data_items = []
-        for item in response['dataitems']:
+        for item in self._client._list(method, params, 'dataitems', self.id):
             data_items.append(DataItem(self._client, self.id, item))
         return data_items
 
@@ -94,7 +93,10 @@ class Vault(Cluster):
         params = {
             "vault_id": self.id
             }
-        self._client.connection.make_request(method, params)
+        try:
+            self._client.connection.make_request(method, params)
+        finally:
+            self._client._invalidate_cluster(self.id)
         return
 
     @property
@@ -2,9 +2,21 @@
 
 import utils
 import filecrypt
+import pipeline
 import hashlib
-from holvi.exceptions import HolviDataItemException
-
+import os
+import time
+import itertools
+import threading
+import json
+import Queue
+import tuning
+import itemio
+from holvi.exceptions import HolviDataItemException, HolviCryptException
+from holvi.workers import WorkerPool
+
+FETCH_STATE_SUFFIX = '.holvi-fetch'
+AES_BLOCK = 16
 
 class DataItem(object):
     """DataItem provides methods for handling data.
@@ -45,69 +57,812 @@ class DataItem(object):
         response = self._client.connection.make_transaction(headers, url_suffix)
 
         checksum = response.headers.get('X-HOLVI-HASH')
-        if self._client.encryption_mode == utils.ENC_AES256:
-            self.key_data = self._client.crypt.decrypt(response, self._client._request_size)
+        if self._client._tuner is not None:
+            response = tuning.MeasuredReader(response, self._client._record_chunk,
+                                             self._client._save_request_size)
+        decryptor = self._client._decryptor()
+        if decryptor is not None:
+            self.key_data = filecrypt.CryptIterator(response, decryptor, self._client._request_size)
         else:
             self.key_data = filecrypt.FileIterator(response, self._client._request_size)
+        self._client._attach_tuner(self.key_data)
 
         return {'data': self.key_data,
                 'checksum': checksum}
 
-    def store_data(self, data, method, offset):
+    def fetch_to_file(self, target, depth=2):
+        """Fetches DataItem data into a file through a pipeline.
+
+        :param target: Path of the file to be written, or a writable file object.
+        :param depth: Maximum number of chunks buffered between the stages.
+
+        Network reads and decryption run on their own threads while the
+        calling thread writes, connected by bounded queues. The fetched data
+        is verified against the item checksum, returns the pipeline stats.
+
+        """
+        headers = {}
+        headers['X-HOLVI-KEY'] = self.name
+        headers['X-HOLVI-PARENT'] = self.parent_id
+        response = self._client.connection.make_transaction(headers, "/fetch")
+        checksum = response.headers.get('X-HOLVI-HASH')
+
+        source = filecrypt.FileIterator(response, self._client._request_size)
+        stages = []
+        decryptor = self._client._decryptor()
+        if decryptor is not None:
+            stages.append(('decrypt', decryptor))
+        data = pipeline.Pipeline(source, stages, depth, source_name='receive', sink_name='write')
+
+        if hasattr(target, 'write'):
+            output = target
+        else:
+            output = open(target, 'wb')
+        try:
+            for chunk in data:
+                output.write(chunk)
+        finally:
+            data.close()
+            if output is not target:
+                output.close()
+
+        if checksum and source._md5.hexdigest() != checksum:
+            raise HolviDataItemException(702, "Checksum mismatch")
+        return data.stats
+
+    def fetch_resumable(self, path, state_path=None):
+        """Fetches DataItem data into a file, continuing an interrupted fetch.
+
+        :param path: Path of the file to be written.
+        :param state_path: Path of the sidecar state file, defaults to path
+                           with FETCH_STATE_SUFFIX appended.
+
+        Progress is saved to the state file after every chunk. If the state
+        file matches the stored item, only the remaining byte range is
+        requested and ENC:AES256 decryption continues from the last 16
+        ciphertext bytes saved in it. The written part is checked by
+        hashing it (re-encrypted when needed) once. ENC:AES256-CHUNKED items
+        are always fetched from the beginning. The complete data is
+        verified against the item checksum and the state file is removed.
+        Returns a dict with keys 'checksum', 'length' and 'resumed_from'.
+
+        """
+        if state_path is None:
+            state_path = path + FETCH_STATE_SUFFIX
+        self._info_retrieved = False
+        self._get_item_info()
+        mode = self._client.encryption_mode
+        state = {'length': self.key_length,
+                 'checksum': self.key_hash,
+                 'last_modified': self.key_last_modified,
+                 'encryption': mode}
+        resumable = mode != utils.ENC_AES256_CHUNKED
+        if resumable:
+            received, md5, preceding = self._fetch_resume_point(path, state_path, state)
+        else:
+            received, md5, preceding = 0, hashlib.md5(), ''
+        start = received
+        length = int(self.key_length or 0)
+
+        output = open(path, 'r+b' if received else 'wb')
+        try:
+            output.seek(received)
+            output.truncate()
+            if received < length:
+                headers = {}
+                headers['X-HOLVI-KEY'] = self.name
+                headers['X-HOLVI-PARENT'] = self.parent_id
+                if received:
+                    headers['Range'] = 'bytes={0}-'.format(received)
+                response = self._client.connection.make_transaction(headers, "/fetch")
+                if received and response.status != 206:
+                    # Server ignored the range, start over
+                    received, md5, preceding = 0, hashlib.md5(), ''
+                    output.seek(0)
+                    output.truncate()
+                if mode == utils.ENC_AES256:
+                    decryptor = self._client.crypt.decryptor_at(received, preceding)
+                else:
+                    decryptor = self._client._decryptor()
+                for chunk in filecrypt.FileIterator(response, self._client._request_size, hashed=False):
+                    md5.update(chunk)
+                    preceding = (preceding + chunk)[-16:]
+                    received += len(chunk)
+                    output.write(decryptor(chunk) if decryptor is not None else chunk)
+                    if resumable:
+                        output.flush()
+                        state['received'] = received
+                        state['preceding'] = preceding.encode('hex')
+                        self._save_fetch_state(state_path, state)
+                if hasattr(decryptor, 'final'):
+                    output.write(decryptor.final())
+        finally:
+            output.close()
+
+        if received != length:
+            raise HolviDataItemException(704, "Incomplete range")
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        if self.key_hash and md5.hexdigest() != self.key_hash:
+            raise HolviDataItemException(702, "Checksum mismatch")
+        return {'checksum': self.key_hash,
+                'length': received,
+                'resumed_from': start}
+
+    def _fetch_resume_point(self, path, state_path, expected):
+        """Returns (received, md5, preceding) of an interrupted fetch.
+
+        :param path: Path of the partially written file.
+        :param state_path: Path of the sidecar state file.
+        :param expected: State values of the stored item.
+
+        received is the number of ciphertext bytes already written, md5 the
+        hash of them and preceding their last 16 bytes. A state that does not
+        match the item or the written file gives (0, md5(), '').
+
+        """
+        nothing = (0, hashlib.md5(), '')
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            received = int(state['received'])
+            preceding = state['preceding'].decode('hex')
+        except (IOError, ValueError, KeyError, TypeError):
+            return nothing
+        if any(state.get(key) != value for key, value in expected.items()):
+            return nothing
+        if not os.path.isfile(path) or os.path.getsize(path) < received:
+            return nothing
+
+        md5 = hashlib.md5()
+        encryptor = self._client._encryptor()
+        tail = ''
+        with open(path, 'rb') as written:
+            remaining = received
+            while remaining > 0:
+                chunk = written.read(min(remaining, self._client._request_size))
+                if not chunk:
+                    return nothing
+                remaining -= len(chunk)
+                if encryptor is not None:
+                    chunk = encryptor(chunk)
+                md5.update(chunk)
+                tail = (tail + chunk)[-16:]
+        if tail != preceding:
+            return nothing
+        return received, md5, preceding
+
+    def _save_fetch_state(self, state_path, state):
+        temp_path = '{0}.{1}.tmp'.format(state_path, os.getpid())
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temp_path, state_path)
+
+    def fetch_parallel(self, workers=4):
+        """Returns a dict that contains DataItem checksum and data, fetching
+        the data as concurrent byte ranges.
+
+        :param workers: Number of ranges downloaded concurrently.
+
+        The item is split into ranges of the client's request size using its
+        Content-Length. Ranges are yielded (and decrypted) in order, so the
+        'data' iterator's md5 can be compared to 'checksum' as with data.
+
+        """
+        self._get_item_info()
+        ranges = utils.split_ranges(int(self.key_length or 0), self._client._request_size)
+        func = self._client._decryptor()
+        self.key_data = filecrypt.ChunkIterator(self._fetch_ranges(ranges, workers), func)
+        return {'data': self.key_data,
+                'checksum': self.key_hash}
+
+    def fetch_parallel_to_file(self, path, workers=4):
+        """Fetches DataItem data into a file downloading byte ranges concurrently.
+
+        :param path: Path of the file to be written.
+        :param workers: Number of ranges downloaded concurrently.
+
+        Same as fetch_to_path without the final fsync, returns the checksum.
+
+        """
+        return self.fetch_to_path(path, workers, fsync=False)
+
+    def fetch_to_path(self, path, workers=None, fsync=True):
+        """Fetches DataItem data straight into a file with positional writes.
+
+        :param path: Path of the file to be written.
+        :param workers: Number of ranges downloaded concurrently, None
+                        downloads the item in one request.
+        :param fsync: Flush the file to disk once at the end.
+
+        The path must be a regular file. It is preallocated to the item's
+        Content-Length and every piece is written at its own offset, so
+        concurrent ranges land directly. Each request reads the body into
+        one buffer that is reused for every chunk. ENC:AES256-CHUNKED
+        items are always fetched in one request. The fetched data is
+        verified against the item checksum, returns the checksum.
+
+        """
+        self._info_retrieved = False
+        self._get_item_info()
+        length = int(self.key_length or 0)
+        mode = self._client.encryption_mode
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            utils.preallocate(fd, length)
+            if workers and workers > 1 and mode != utils.ENC_AES256_CHUNKED:
+                md5, written = self._fetch_ranges_to_fd(fd, length, workers)
+            else:
+                md5, written = self._fetch_to_fd(fd)
+            if written != length:
+                os.ftruncate(fd, written)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if self.key_hash and md5.hexdigest() != self.key_hash:
+            raise HolviDataItemException(702, "Checksum mismatch")
+        return self.key_hash
+
+    def _fetch_to_fd(self, fd):
+        """Fetches the item in one request into fd, returns (md5, bytes written)"""
+        headers = {}
+        headers['X-HOLVI-KEY'] = self.name
+        headers['X-HOLVI-PARENT'] = self.parent_id
+        response = self._client.connection.make_transaction(headers, "/fetch")
+        decrypt = self._client._decryptor()
+
+        md5 = hashlib.md5()
+        receive = bytearray(self._client._request_size)
+        written = 0
+        while True:
+            received = self._readinto(response, receive, 0, len(receive))
+            if not received:
+                break
+            chunk = buffer(receive, 0, received)
+            md5.update(chunk)
+            if decrypt is None:
+                utils.pwrite(fd, receive, written, received)
+                written += received
+                continue
+            # Decryptors with a final method may keep the chunk, they get a copy
+            plaintext = decrypt(str(chunk) if hasattr(decrypt, 'final') else chunk)
+            utils.pwrite(fd, plaintext, written)
+            written += len(plaintext)
+        if hasattr(decrypt, 'final'):
+            plaintext = decrypt.final()
+            utils.pwrite(fd, plaintext, written)
+            written += len(plaintext)
+        return md5, written
+
+    def _fetch_ranges_to_fd(self, fd, length, workers):
+        """Fetches concurrent ranges into fd, returns (md5, bytes written)
+
+        Each worker receives its range into a buffer taken from a free list,
+        decrypts and writes it at its offset. The buffers come back in order
+        for hashing and are then reused.
+
+        """
+        size = self._client._request_size
+        crypt = self._client.crypt if self._client.encryption_mode == utils.ENC_AES256 else None
+        free = Queue.Queue()
+
+        def fetch(byte_range):
+            start, end = byte_range
+            try:
+                receive = free.get_nowait()
+            except Queue.Empty:
+                receive = bytearray(size + AES_BLOCK)
+            # ENC:AES256 ranges need the 16 preceding ciphertext bytes
+            pre = min(start, AES_BLOCK) if crypt is not None else 0
+            self._fetch_range_into(start - pre, end, receive)
+            count = end - start + 1
+            chunk = buffer(receive, pre, count)
+            if crypt is None:
+                utils.pwrite(fd, receive, start, count)
+            else:
+                utils.pwrite(fd, crypt.decrypt_at(chunk, start, str(receive[:pre])), start)
+            return receive, pre, count
+
+        md5 = hashlib.md5()
+        pool = WorkerPool(workers, workers * 2)
+        try:
+            for receive, pre, count in pool.map(fetch, utils.split_ranges(length, size), workers * 2):
+                md5.update(buffer(receive, pre, count))
+                free.put(receive)
+        finally:
+            pool.shutdown()
+        return md5, length
+
+    def _fetch_range_into(self, start, end, receive):
+        """Downloads bytes start..end (inclusive) into the beginning of receive"""
+        headers = {}
+        headers['X-HOLVI-KEY'] = self.name
+        headers['X-HOLVI-PARENT'] = self.parent_id
+        headers['Range'] = 'bytes={0}-{1}'.format(start, end)
+        response = self._client.connection.make_transaction(headers, "/fetch")
+        if response.status != 206:
+            response.close()
+            raise HolviDataItemException(703, "Ranged fetch not supported")
+        count = end - start + 1
+        if self._readinto(response, receive, 0, count) != count:
+            raise HolviDataItemException(704, "Incomplete range")
+        response.close()
+
+    def _readinto(self, response, receive, start, end):
+        """Reads the response body into receive[start:end] until it is full
+        or the body ends, returns the number of bytes read.
+
+        """
+        view = memoryview(receive)
+        readinto = getattr(response, 'readinto', None)
+        position = start
+        while position < end:
+            if readinto is not None:
+                received = readinto(view[position:end])
+            else:
+                data = response.read(end - position)
+                received = len(data)
+                view[position:position + received] = data
+            if not received:
+                break
+            position += received
+        return position - start
+
+    def open(self, mode='rb', **kwargs):
+        """Returns a file object for the DataItem's content.
+
+        :param mode: 'rb' opens a seekable, read-only itemio.DataItemReader,
+                     'wb' an itemio.DataItemWriter storing a new item and
+                     'ab' one appending to the item.
+
+        Other keyword arguments are passed to the file object, see
+        itemio.DataItemReader for block_size, readahead and cache_blocks
+        and itemio.DataItemWriter for background and max_pending.
+
+        """
+        if mode in ('r', 'rb'):
+            return itemio.DataItemReader(self, **kwargs)
+        if mode in ('w', 'wb', 'a', 'ab'):
+            return itemio.DataItemWriter(self, append=mode.startswith('a'), **kwargs)
+        raise ValueError("Unsupported mode '{0}'".format(mode))
+
+    def read_range(self, start, end):
+        """Returns bytes start..end (inclusive) of the DataItem's content.
+
+        :param start: First byte to be read.
+        :param end: Last byte to be read, reads are cut at the end of the content.
+
+        Only the part of the item covering the range is fetched. For
+        ENC:AES256 items the 16 ciphertext bytes before the range are fetched
+        too to restore the CFB state. For ENC:AES256-CHUNKED items the
+        covering segments are fetched, authenticated and decrypted.
+
+        """
+        length, header, plaintext_length = self._content_layout()
+        return self._read_range(start, end, length, header)
+
+    def _content_layout(self):
+        """Returns (stored length, chunked header, plaintext length) of the item.
+
+        The item information is queried from the server. The header is the
+        (segment size, nonce) of an ENC:AES256-CHUNKED item, None otherwise.
+
+        """
+        self._get_item_info()
+        length = int(self.key_length or 0)
+        header = None
+        if self._client.encryption_mode == utils.ENC_AES256_CHUNKED and length:
+            header = self._fetch_chunked_header()
+        return length, header, self._content_length(length, header)
+
+    def _fetch_chunked_header(self):
+        """Fetches and returns (segment size, nonce) of an ENC:AES256-CHUNKED item.
+
+        """
+        return filecrypt.parse_chunked_header(self._fetch_range(0, filecrypt.CHUNKED_HEADER_SIZE - 1))
+
+    def _content_length(self, length, header=None):
+        """Returns the plaintext length of an item of length stored bytes.
+
+        :param length: Stored length of the item.
+        :param header: (segment size, nonce) of an ENC:AES256-CHUNKED item.
+
+        """
+        if header is None:
+            return length
+        return filecrypt.chunked_plaintext_length(length, header[0])
+
+    def _read_range(self, start, end, length, header=None):
+        """Returns plaintext bytes start..end (inclusive) of an item of length stored bytes.
+
+        :param header: (segment size, nonce) of an ENC:AES256-CHUNKED item,
+                       see _fetch_chunked_header.
+
+        """
+        mode = self._client.encryption_mode
+        if mode in (utils.ENC_NONE, utils.ENC_AES256):
+            end = min(end, length - 1)
+            if end < start:
+                return ''
+            if mode == utils.ENC_NONE:
+                return self._fetch_range(start, end)
+            pre = min(start, 16)
+            data = self._fetch_range(start - pre, end)
+            return self._client.crypt.decrypt_at(data[pre:], start, data[:pre])
+        if mode != utils.ENC_AES256_CHUNKED:
+            raise HolviCryptException(904, 'Ranged reads are not supported for encryption mode ' + mode)
+
+        segment_size, nonce = header
+        end = min(end, filecrypt.chunked_plaintext_length(length, segment_size) - 1)
+        if end < start:
+            return ''
+        record = segment_size + filecrypt.CHUNKED_TAG_SIZE
+        first, last = start // segment_size, end // segment_size
+        cipher_start = filecrypt.CHUNKED_HEADER_SIZE + first * record
+        cipher_end = min(filecrypt.CHUNKED_HEADER_SIZE + (last + 1) * record, length) - 1
+        records = self._fetch_range(cipher_start, cipher_end)
+        plaintext = self._client.crypt.open_chunked_records(records, nonce, segment_size, first,
+                                                            cipher_end == length - 1)
+        offset = start - first * segment_size
+        return plaintext[offset:offset + end - start + 1]
+
+    def _fetch_ranges(self, ranges, workers):
+        """Downloads byte ranges concurrently and yields them in order.
+
+        :param ranges: List of inclusive (start, end) byte ranges.
+        :param workers: Number of ranges downloaded concurrently.
+
+        """
+        pool = WorkerPool(workers, workers * 2)
+        try:
+            for data in pool.map(lambda byte_range: self._fetch_range(*byte_range), ranges, workers * 2):
+                yield data
+        finally:
+            pool.shutdown()
+
+    def _fetch_range(self, start, end):
+        """Downloads bytes start..end (inclusive) of the DataItem.
+
+        """
+        headers = {}
+        headers['X-HOLVI-KEY'] = self.name
+        headers['X-HOLVI-PARENT'] = self.parent_id
+        headers['Range'] = 'bytes={0}-{1}'.format(start, end)
+        response = self._client.connection.make_transaction(headers, "/fetch")
+        if response.status != 206:
+            response.close()
+            raise HolviDataItemException(703, "Ranged fetch not supported")
+        data = response.read()
+        if len(data) != end - start + 1:
+            raise HolviDataItemException(704, "Incomplete range")
+        return data
+
+    def store_data(self, data, method, offset, workers=None):
         """Stores data to Holvi server.
 
         :param data: File-like object to be stored.
         :param method: Storing method ['new', 'replace', 'patch', 'append'].
         :param offset: Starting byte when using method 'patch'.
+        :param workers: Number of chunks uploaded concurrently, None uploads chunks one by one.
+
+        Data of more than one chunk is hashed on a background thread while
+        the earlier chunks are sent, unless data is a Pipeline that already
+        has a 'hash' stage. A single chunk is hashed without starting a
+        thread.
 
         """
-        headers = {}
-        headers['X-HOLVI-STORE-MODE'] = method
-        headers['X-HOLVI-KEY'] = self.name
-        headers['X-HOLVI-PARENT'] = self.parent_id
-        headers['X-HOLVI-META'] = 'v{meta_version}:{enc}::'.format(meta_version=str(self._client.__META_VERSION__),
-                                                                       enc=self._client._encryption_mode)
+        self._check_store_method(method)
+        if isinstance(data, pipeline.Pipeline) and data.has_stage('hash'):
+            chunks, hasher = data, data.stage('hash')
+        else:
+            hasher = filecrypt.ChunkHasher()
+            chunks = self._hashed_chunks(data, hasher)
+        try:
+            if workers and workers > 1:
+                return self._store_parallel(chunks, hasher, method, offset, workers)
+            return self._store_sequential(chunks, method, offset)
+        finally:
+            if isinstance(chunks, pipeline.Pipeline):
+                chunks.close()
 
-        if method == 'patch':
-            headers['X-HOLVI-OFFSET'] = offset
+    def _check_store_method(self, method):
+        """Raises HolviCryptException if method can not be used in the Client's encryption mode.
 
-        headers['Content-Type'] = 'application/octet-stream'
+        An ENC:AES256-CHUNKED item is one stream with a single header and
+        numbered segments, data appended or patched into it as a new stream
+        would make the whole item fail authentication.
+
+        """
+        if method in ('append', 'patch') and self._client.encryption_mode == utils.ENC_AES256_CHUNKED:
+            raise HolviCryptException(905, "Store method '{0}' is not supported for encryption mode {1}".format(
+                method, utils.ENC_AES256_CHUNKED))
+
+    def _hashed_chunks(self, data, hasher):
+        """Returns an iterator of (data chunk, md5 hexdigest) pairs of data.
 
-        url_suffix = "/store"
-        respone = None
-        result = None
+        Pipelines and data of more than one chunk are hashed with hasher in
+        a 'hash' stage of a Pipeline, a single chunk is hashed right away.
 
+        """
+        if not isinstance(data, pipeline.Pipeline):
+            data = iter(data)
+            first = list(itertools.islice(data, 2))
+            if len(first) < 2:
+                return iter([hasher(data_chunk) for data_chunk in first])
+            data = itertools.chain(first, data)
+        return pipeline.Pipeline(data, [('hash', hasher)], sink_name='send')
+
+    def store_resumable(self, make_data, method, offset, journal):
+        """Stores data to Holvi server recording progress in an UploadJournal.
+
+        :param make_data: Function(resuming) returning (iterator over the data
+                          chunks from the beginning, journal header values).
+        :param method: Storing method ['new', 'replace', 'patch', 'append'].
+        :param offset: Starting byte when using method 'patch'.
+        :param journal: UploadJournal of the upload.
+
+        If the journal holds acknowledged chunks of an earlier attempt, the
+        stored length and checksum of the item are checked against the
+        journal and the data, and the upload continues with 'append' (or
+        'patch') from the last confirmed byte. Otherwise the data is stored
+        from the beginning. The journal is removed once all data is stored.
+
+        """
+        self._check_store_method(method)
+        start = 0
+        data = None
+        if journal.matches(method=method, offset=offset, encryption=self._client.encryption_mode):
+            data, header = make_data(True)
+            resumed = self._resume_point(data, method, journal)
+            if resumed is not None:
+                start, data = resumed
+                base = journal.header['base']
+        if start == 0:
+            data, header = make_data(False)
+            if method == 'patch':
+                base = offset
+            elif method == 'append':
+                self._info_retrieved = False
+                self._get_item_info()
+                base = int(self.key_length or 0)
+            else:
+                base = 0
+            journal.start(method=method, offset=offset, base=base, **header)
+
+        hasher = filecrypt.ChunkHasher()
+        position = start
+        for data_chunk in data:
+            data_chunk, digest = hasher(data_chunk)
+            headers = self._store_headers()
+            if position == 0:
+                headers['X-HOLVI-STORE-MODE'] = method
+            elif method == 'patch':
+                headers['X-HOLVI-STORE-MODE'] = 'patch'
+            else:
+                headers['X-HOLVI-STORE-MODE'] = 'append'
+            if headers['X-HOLVI-STORE-MODE'] == 'patch':
+                headers['X-HOLVI-OFFSET'] = base + position
+            journal.record_pending(position, len(data_chunk), digest)
+            self._send_chunk(headers, data_chunk, digest)
+            journal.record_acknowledged(position, len(data_chunk), digest)
+            position += len(data_chunk)
+
+        journal.remove()
+        if position == 0:
+            raise HolviDataItemException(700, "Empty content")
+        return "OK"
+
+    def _resume_point(self, data, method, journal):
+        """Finds where an interrupted upload can continue.
+
+        :param data: Iterator over the data chunks from the beginning.
+        :param method: Storing method of the upload.
+        :param journal: UploadJournal of the earlier attempt.
+
+        The data is read up to the end of the last chunk the journal saw
+        being sent. Its md5 at the acknowledged and at the pending end is
+        compared with the stored item. Returns (position, iterator over the
+        rest of the data) or None if the upload has to start over.
+
+        """
+        acknowledged = journal.acknowledged
+        sent = acknowledged + journal.pending
+        if sent == 0:
+            return None
         try:
-            data_chunk = data.next()
-            md5 = hashlib.md5()
-            md5.update(data_chunk)
-            headers['X-HOLVI-HASH'] = md5.hexdigest()
-            headers['Content-Length'] = len(data_chunk)
-            self._client.connection.make_transaction(headers, url_suffix, data_chunk)
+            self._info_retrieved = False
+            self._get_item_info()
+        except HolviDataItemException:
+            return None
+        remote_length = int(self.key_length or 0)
+        base = journal.header['base']
+
+        md5 = hashlib.md5()
+        digests = {}
+        extra = []
+        consumed = 0
+        tail = ''
+        for chunk in data:
+            while chunk and consumed < sent:
+                stop = acknowledged if consumed < acknowledged else sent
+                part, chunk = chunk[:stop - consumed], chunk[stop - consumed:]
+                md5.update(part)
+                if consumed >= acknowledged:
+                    extra.append(part)
+                consumed += len(part)
+                if consumed in (acknowledged, sent):
+                    digests[consumed] = md5.hexdigest()
+            if consumed >= sent:
+                tail = chunk
+                break
+        if consumed < sent:
+            return None
+
+        candidates = [acknowledged] if method == 'patch' else [sent, acknowledged]
+        for position in candidates:
+            if position == 0:
+                continue
+            if method == 'patch':
+                valid = remote_length >= base + position
+            else:
+                valid = remote_length == base + position
+                if method != 'append' and self.key_hash and self.key_hash != digests[position]:
+                    valid = False
+            if valid:
+                rest = tail if position == sent else ''.join(extra) + tail
+                return position, itertools.chain([rest] if rest else [], data)
+        return None
+
+    def _store_sequential(self, chunks, method, offset):
+        """Stores data to Holvi server sending chunks one by one.
+
+        :param chunks: Iterator of (data chunk, md5 hexdigest) pairs.
+        :param method: Storing method ['new', 'replace', 'patch', 'append'].
+        :param offset: Starting byte when using method 'patch'.
+
+        """
+        headers = self._store_headers()
+        headers['X-HOLVI-STORE-MODE'] = method
+        if method == 'patch':
+            headers['X-HOLVI-OFFSET'] = offset
+
+        try:
+            data_chunk, digest = chunks.next()
         except StopIteration:
             raise HolviDataItemException(700, "Empty content")
+        self._send_chunk(headers, data_chunk, digest)
 
-        for data_chunk in data:
-            md5 = hashlib.md5()
-            md5.update(data_chunk)
-            headers['X-HOLVI-HASH'] = md5.hexdigest()
-            headers['Content-Length'] = len(data_chunk)
+        for data_chunk, digest in chunks:
             if method != 'patch':
                 headers['X-HOLVI-STORE-MODE'] = 'append'
             elif method == 'patch':
                 offset += len(data_chunk)
                 headers['X-HOLVI-OFFSET'] = offset
-            self._client.connection.make_transaction(headers, url_suffix, data_chunk)
+            self._send_chunk(headers, data_chunk, digest)
 
         return "OK"
 
+    def _store_parallel(self, chunks, hasher, method, offset, workers):
+        """Stores data to Holvi server uploading chunks concurrently.
+
+        :param chunks: Iterator of (data chunk, md5 hexdigest) pairs.
+        :param hasher: ChunkHasher that hashed the chunks, for the object md5.
+        :param method: Storing method ['new', 'replace', 'patch', 'append'].
+        :param offset: Starting byte when using method 'patch'.
+        :param workers: Number of chunks in flight at a time.
+
+        The first chunk is sent with the requested method, it creates the item.
+        The remaining chunks are sent concurrently in 'patch' mode at their
+        absolute offsets. If uploads fail the error of the chunk with the
+        lowest offset is raised. After the upload the stored size, and for
+        'new' and 'replace' the checksum, are verified against the server.
+
+        """
+        headers = self._store_headers()
+        if method == 'patch':
+            base = offset
+        elif method == 'append':
+            self._get_item_info()
+            base = int(self.key_length or 0)
+        else:
+            base = 0
+
+        try:
+            data_chunk, digest = chunks.next()
+        except StopIteration:
+            raise HolviDataItemException(700, "Empty content")
+
+        first_headers = dict(headers)
+        first_headers['X-HOLVI-STORE-MODE'] = method
+        if method == 'patch':
+            first_headers['X-HOLVI-OFFSET'] = base
+        self._send_chunk(first_headers, data_chunk, digest)
+        position = len(data_chunk)
+
+        failed = threading.Event()
+
+        def send(chunk_headers, data_chunk, digest):
+            try:
+                self._send_chunk(chunk_headers, data_chunk, digest)
+            except Exception:
+                failed.set()
+                raise
+
+        pending = []
+        pool = WorkerPool(workers)
+        try:
+            for data_chunk, digest in chunks:
+                chunk_headers = dict(headers)
+                chunk_headers['X-HOLVI-STORE-MODE'] = 'patch'
+                chunk_headers['X-HOLVI-OFFSET'] = base + position
+                pending.append(pool.submit(send, chunk_headers, data_chunk, digest))
+                position += len(data_chunk)
+                if failed.is_set():
+                    break
+        finally:
+            pool.shutdown()
+
+        for future in pending:
+            future.result()
+
+        self._info_retrieved = False
+        self._get_item_info()
+        if int(self.key_length or 0) < base + position:
+            raise HolviDataItemException(701, "Stored size mismatch")
+        if method in ('new', 'replace'):
+            if int(self.key_length) != position:
+                raise HolviDataItemException(701, "Stored size mismatch")
+            if self.key_hash and self.key_hash != hasher.hexdigest():
+                raise HolviDataItemException(702, "Checksum mismatch")
+        return "OK"
+
+    def _store_headers(self):
+        """Returns the headers common to all chunks of a store operation
+
+        """
+        headers = {}
+        headers['X-HOLVI-KEY'] = self.name
+        headers['X-HOLVI-PARENT'] = self.parent_id
+        headers['X-HOLVI-META'] = 'v{meta_version}:{enc}::'.format(meta_version=str(self._client.__META_VERSION__),
+                                                                       enc=self._client._encryption_mode)
+        headers['Content-Type'] = 'application/octet-stream'
+        return headers
+
+    def _send_chunk(self, headers, data_chunk, digest):
+        """Sends one data chunk to Holvi server
+
+        :param headers: Headers for the chunk, hash and length are added.
+        :param data_chunk: Data to be sent.
+        :param digest: md5 hexdigest of the data chunk.
+
+        """
+        headers['X-HOLVI-HASH'] = digest
+        headers['Content-Length'] = len(data_chunk)
+        start = time.time()
+        try:
+            response = self._client.connection.make_transaction(headers, "/store", data_chunk)
+            try:
+                response.read()
+            finally:
+                response.close()
+        except Exception:
+            self._client._record_chunk(len(data_chunk), time.time() - start, failed=True)
+            raise
+        finally:
+            self._client._invalidate_metadata(self.parent_id, self.name)
+            self._client._invalidate_listing(self.parent_id, 'dataitems')
+        self._client._record_chunk(len(data_chunk), time.time() - start)
+
     @property
     def length(self):
         """Returns DataItem length (size).
 
         """
         if not self._info_retrieved:
-            self._get_item_info()
+            self._get_item_info(cached=True)
         return self.key_length
 
     @property
@@ -116,7 +871,7 @@ class DataItem(object):
 
         """
         if not self._info_retrieved:
-            self._get_item_info()
+            self._get_item_info(cached=True)
         return self.key_hash
 
     @property
@@ -125,7 +880,7 @@ class DataItem(object):
 
         """
         if not self._info_retrieved:
-            self._get_item_info()
+            self._get_item_info(cached=True)
         return self.key_last_modified
 
     @property
@@ -134,7 +889,7 @@ class DataItem(object):
 
         """
         if not self._info_retrieved:
-            self._get_item_info()
+            self._get_item_info(cached=True)
         return self.key_meta
 
     def remove(self):
@@ -146,18 +901,33 @@ class DataItem(object):
             'cluster_id': self.parent_id,
             'key': self.name
             }
-        response = self._client.connection.make_request(method, params)
+        try:
+            response = self._client.connection.make_request(method, params)
+        finally:
+            self._client._invalidate_metadata(self.parent_id, self.name)
+            self._client._invalidate_listing(self.parent_id, 'dataitems')
 
-    def _get_item_info(self):
+    def _get_item_info(self, cached=False):
         """Queries Holvi server for DataItem information.
 
+        :param cached: Use the Client's metadata cache if it holds the item.
+
         """
-        headers = {}
-        headers['X-HOLVI-PARENT'] = self.parent_id
-        headers['X-HOLVI-KEY'] = self.name
-        response = self._client.connection.make_query(headers)
-        self.key_length = response.get('Content-Length', None)
-        self.key_last_modified = response.get('Last-Modified', None)
-        self.key_hash = response.get('X-HOLVI-HASH', None)
-        self.key_meta = response.get('X-HOLVI-META', None)
+        metadata_cache = self._client.metadata_cache
+        cache_key = None
+        info = None
+        if metadata_cache is not None:
+            cache_key = self._client._metadata_key(self.parent_id, self.name)
+            if cached:
+                info = metadata_cache.get(cache_key)
+        if info is None:
+            headers = {}
+            headers['X-HOLVI-PARENT'] = self.parent_id
+            headers['X-HOLVI-KEY'] = self.name
+            response = self._client.connection.make_query(headers)
+            info = (response.get('Content-Length', None), response.get('Last-Modified', None),
+                    response.get('X-HOLVI-HASH', None), response.get('X-HOLVI-META', None))
+            if cache_key is not None:
+                metadata_cache.put(cache_key, info)
+        self.key_length, self.key_last_modified, self.key_hash, self.key_meta = info
         self._info_retrieved = True
@@ -3,9 +3,107 @@ import os
 import random
 import struct
 import hashlib
+import hmac
+import mmap
+import stat
+import multiprocessing
 from Crypto.Cipher import AES
+from Crypto.Util import Counter
 
 from holvi.exceptions import HolviCryptException
+from holvi.workers import WorkerPool
+
+# ENC:AES256-CHUNKED stream layout:
+#   header:  'HVC1' | segment size (4 bytes, big-endian) | random nonce (8 bytes)
+#   records: AES-256-CTR ciphertext of one segment | 16 byte HMAC-SHA256 tag
+# Every segment is encrypted with its own counter block (nonce | segment index)
+# and authenticated together with its index and a flag marking the last
+# segment, so segments can be processed independently and in any order.
+CHUNKED_MAGIC = 'HVC1'
+CHUNKED_HEADER_SIZE = 16
+CHUNKED_TAG_SIZE = 16
+CHUNKED_SEGMENT_SIZE = 65536
+
+# Slice of a chunk fed to both digests of ChunkHasher at a time
+HASH_SLICE_SIZE = 65536
+
+def _chunked_keys(key):
+    """Derives the encryption and authentication keys from the client key"""
+    key = str(key)
+    return (hmac.new(key, 'holvi-chunked-enc', hashlib.sha256).digest(),
+            hmac.new(key, 'holvi-chunked-mac', hashlib.sha256).digest())
+
+def _segment_tag(mac_key, nonce, index, final, ciphertext):
+    tag = hmac.new(mac_key, nonce + struct.pack('>QB', index, final), hashlib.sha256)
+    tag.update(ciphertext)
+    return tag.digest()[:CHUNKED_TAG_SIZE]
+
+def _segment_cipher(enc_key, nonce, index):
+    counter = Counter.new(32, prefix=nonce + struct.pack('>I', index), initial_value=0)
+    return AES.new(enc_key, AES.MODE_CTR, counter=counter)
+
+def seal_segment(args):
+    """Encrypts one segment, returns ciphertext and tag.
+
+    :param args: (keys, nonce, index, final, plaintext)
+
+    Takes a single tuple so it can be mapped over a process pool.
+    """
+    (enc_key, mac_key), nonce, index, final, plaintext = args
+    ciphertext = _segment_cipher(enc_key, nonce, index).encrypt(plaintext)
+    return ciphertext + _segment_tag(mac_key, nonce, index, final, ciphertext)
+
+def open_segment(args):
+    """Verifies and decrypts one record (ciphertext and tag) of a segment.
+
+    :param args: (keys, nonce, index, final, record)
+
+    Takes a single tuple so it can be mapped over a process pool.
+    """
+    (enc_key, mac_key), nonce, index, final, record = args
+    ciphertext, tag = record[:-CHUNKED_TAG_SIZE], record[-CHUNKED_TAG_SIZE:]
+    if len(tag) != CHUNKED_TAG_SIZE:
+        raise HolviCryptException(903, 'Truncated data')
+    expected = _segment_tag(mac_key, nonce, index, final, ciphertext)
+    if not _compare_digest(tag, expected):
+        raise HolviCryptException(902, 'Authentication failed')
+    return _segment_cipher(enc_key, nonce, index).decrypt(ciphertext)
+
+def _compare_digest(a, b):
+    compare = getattr(hmac, 'compare_digest', None)
+    if compare is not None:
+        return compare(a, b)
+    return len(a) == len(b) and reduce(lambda x, y: x | y, [ord(x) ^ ord(y) for x, y in zip(a, b)], 0) == 0
+
+def cfb_decrypt_segment(args):
+    """Decrypts one segment of an ENC:AES256 (AES-CFB) stream.
+
+    :param args: (key, iv, ciphertext), iv being the 16 stream bytes
+                 preceding the segment (the initialization vector and/or
+                 the previous ciphertext)
+
+    Takes a single tuple so it can be mapped over a process pool.
+    """
+    key, iv, ciphertext = args
+    return AES.new(key, AES.MODE_CFB, iv).decrypt(ciphertext)
+
+def chunked_header(segment_size, nonce):
+    """Returns the header of an ENC:AES256-CHUNKED stream"""
+    return CHUNKED_MAGIC + struct.pack('>I', segment_size) + nonce
+
+def parse_chunked_header(header):
+    """Returns (segment size, nonce) from an ENC:AES256-CHUNKED stream header"""
+    if len(header) < CHUNKED_HEADER_SIZE or header[:4] != CHUNKED_MAGIC:
+        raise HolviCryptException(903, 'Invalid chunked encryption header')
+    segment_size = struct.unpack('>I', header[4:8])[0]
+    return segment_size, header[8:CHUNKED_HEADER_SIZE]
+
+def chunked_plaintext_length(length, segment_size):
+    """Returns the plaintext length of an ENC:AES256-CHUNKED stream of length bytes"""
+    record = segment_size + CHUNKED_TAG_SIZE
+    body = length - CHUNKED_HEADER_SIZE
+    records = (body + record - 1) // record
+    return body - records * CHUNKED_TAG_SIZE
 
 class FileCrypt(object):
     """FileCrypt provides encryption/decryption functionality"""
@@ -27,25 +125,29 @@ class FileCrypt(object):
 
         Returns CryptIterator that decrypts data in chunks
         """
-        key = self._crypt_key
-        iv = self._crypt_iv
+        return CryptIterator(data, self.decryptor(), chunksize)
 
-        if not key or len(key) != 32:
-            raise HolviCryptException(900, 'Invalid encryption key')
-        if not iv or len(iv) != 16:
-            raise HolviCryptException(901, 'Invalid initialization vector')
-
-        decryptor = AES.new(str(key), AES.MODE_CFB, iv).decrypt
-        return CryptIterator(data, decryptor, chunksize)
-
-    def encrypt(self, data, chunksize=4194304):
+    def encrypt(self, data, chunksize=4194304, hashed=True):
         """Adds encrypt function to file iterator
 
         :param data: data to be encrypted
         :param chunksize: amount of data to be handled at a time
+        :param hashed: update md5 of the plaintext
 
         Returns a CryptIterator that encrypts data in chunks
         """
+        return CryptIterator(data, self.encryptor(), chunksize, hashed)
+
+    def decryptor(self):
+        """Returns a function that decrypts consecutive chunks of a stream"""
+        return self._cipher().decrypt
+
+    def encryptor(self):
+        """Returns a function that encrypts consecutive chunks of a stream"""
+        return self._cipher().encrypt
+
+    def _cipher(self):
+        """Validates key and initialization vector and returns a new AES cipher"""
         key = self._crypt_key
         iv = self._crypt_iv
 
@@ -54,26 +156,296 @@ class FileCrypt(object):
         if not iv or len(iv) != 16:
             raise HolviCryptException(901, 'Invalid initialization vector')
 
-        encryptor = AES.new(str(key), AES.MODE_CFB, iv).encrypt
-        return CryptIterator(data, encryptor, chunksize)
+        return AES.new(str(key), AES.MODE_CFB, iv)
+
+    def parallel_decryptor(self, workers, processes=False):
+        """Returns a ParallelCFBDecryptor for decrypting ENC:AES256 streams on several cores
+
+        :param workers: number of threads or processes decrypting segments
+        :param processes: use a process pool instead of threads
+
+        """
+        self._cipher()
+        return ParallelCFBDecryptor(str(self._crypt_key), self._crypt_iv, workers, processes)
+
+    def decrypt_at(self, data, offset, preceding):
+        """Decrypts ENC:AES256 ciphertext that starts at a given stream offset
+
+        :param data: ciphertext starting at offset
+        :param offset: stream offset of data
+        :param preceding: ciphertext bytes right before offset, at least
+                          min(offset, 16) of them
+
+        Used for random access to CFB encrypted items.
+        """
+        self._cipher()
+        pre = min(offset, AES.block_size)
+        iv = self._crypt_iv[pre:] + preceding[len(preceding) - pre:]
+        return cfb_decrypt_segment((str(self._crypt_key), iv, data))
+
+    def decryptor_at(self, offset, preceding):
+        """Returns a function that decrypts consecutive chunks of an ENC:AES256
+        stream starting at a given offset
+
+        :param offset: stream offset of the first chunk
+        :param preceding: ciphertext bytes right before offset, at least
+                          min(offset, 16) of them
+
+        Used for continuing an interrupted fetch.
+        """
+        self._cipher()
+        pre = min(offset, AES.block_size)
+        iv = self._crypt_iv[pre:] + preceding[len(preceding) - pre:]
+        return AES.new(str(self._crypt_key), AES.MODE_CFB, iv).decrypt
+
+    def encryptor_at(self, offset, preceding):
+        """Returns a function that encrypts consecutive chunks of an ENC:AES256
+        stream starting at a given offset
+
+        :param offset: stream offset of the first chunk
+        :param preceding: ciphertext bytes right before offset, at least
+                          min(offset, 16) of them
+
+        Used for appending to an encrypted item.
+        """
+        self._cipher()
+        pre = min(offset, AES.block_size)
+        iv = self._crypt_iv[pre:] + preceding[len(preceding) - pre:]
+        return AES.new(str(self._crypt_key), AES.MODE_CFB, iv).encrypt
+
+    def chunked_encryptor(self, workers=None, processes=False, segment_size=CHUNKED_SEGMENT_SIZE, nonce=None):
+        """Returns a SegmentCipher that encrypts a stream in ENC:AES256-CHUNKED format
+
+        :param workers: number of threads or processes sealing segments in parallel
+        :param processes: use a process pool instead of threads
+        :param segment_size: size of independently encrypted segments
+        :param nonce: 8 byte stream nonce, a random one is used by default.
+                      Only pass a nonce again to re-create the same stream.
+
+        """
+        return SegmentCipher(self._chunked_keys(), True, workers, processes, segment_size, nonce)
+
+    def chunked_decryptor(self, workers=None, processes=False):
+        """Returns a SegmentCipher that decrypts an ENC:AES256-CHUNKED stream
+
+        :param workers: number of threads or processes opening segments in parallel
+        :param processes: use a process pool instead of threads
+
+        """
+        return SegmentCipher(self._chunked_keys(), False, workers, processes)
+
+    def open_chunked_records(self, data, nonce, segment_size, first_index, final):
+        """Decrypts consecutive records of an ENC:AES256-CHUNKED stream
+
+        :param data: ciphertext of whole records, starting at a record boundary
+        :param nonce: stream nonce from the header
+        :param segment_size: stream segment size from the header
+        :param first_index: index of the first record in data
+        :param final: True if data ends with the last record of the stream
+
+        Used for random access, returns the plaintext of the records.
+        """
+        keys = self._chunked_keys()
+        record = segment_size + CHUNKED_TAG_SIZE
+        count = max(1, (len(data) + record - 1) // record)
+        plaintext = []
+        for i in range(count):
+            is_final = final and i == count - 1
+            plaintext.append(open_segment((keys, nonce, first_index + i, is_final, data[i * record:(i + 1) * record])))
+        return ''.join(plaintext)
+
+    def _chunked_keys(self):
+        key = self._crypt_key
+        if not key or len(key) != 32:
+            raise HolviCryptException(900, 'Invalid encryption key')
+        return _chunked_keys(key)
+
+class ParallelCFBDecryptor(object):
+    """ParallelCFBDecryptor decrypts an ENC:AES256 (AES-CFB) stream on several cores.
+
+    CFB decryption of a byte only needs the 16 ciphertext bytes before it,
+    so every chunk it is called with is split in segments that are
+    decrypted in parallel, each seeded from the ciphertext preceding it.
+    Only one chunk is held in memory at a time.
+
+    """
+    MIN_SEGMENT_SIZE = 65536
+
+    def __init__(self, key, iv, workers, processes=False):
+        """ParallelCFBDecryptor initializer
+
+        :param key: encryption key
+        :param iv: initialization vector of the stream
+        :param workers: number of threads or processes used
+        :param processes: use a process pool instead of threads
+
+        """
+        self._key = key
+        self._register = iv
+        self._workers = workers
+        self._processes = processes
+        self._pool = None
+
+    def __call__(self, chunk):
+        """Decrypts the next chunk of the stream"""
+        segment_size = max(self.MIN_SEGMENT_SIZE, -(-len(chunk) // self._workers))
+        tasks = []
+        register = self._register
+        for start in range(0, len(chunk), segment_size):
+            segment = chunk[start:start + segment_size]
+            tasks.append((self._key, register, segment))
+            register = (register + segment)[-AES.block_size:]
+        self._register = register
+        if len(tasks) < 2:
+            return ''.join(cfb_decrypt_segment(task) for task in tasks)
+        if self._pool is None:
+            if self._processes:
+                self._pool = multiprocessing.Pool(self._workers)
+            else:
+                self._pool = WorkerPool(self._workers)
+        if self._processes:
+            return ''.join(self._pool.map(cfb_decrypt_segment, tasks))
+        return ''.join(self._pool.map(cfb_decrypt_segment, tasks, len(tasks)))
+
+    def final(self):
+        """Stops the worker pool at the end of the stream"""
+        self.close()
+        return ''
+
+    def close(self):
+        """Stops the worker pool"""
+        if self._pool is not None:
+            if self._processes:
+                self._pool.terminate()
+            else:
+                self._pool.shutdown()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+class SegmentCipher(object):
+    """SegmentCipher encrypts/decrypts a stream in ENC:AES256-CHUNKED format.
+
+    It is called with consecutive chunks of any size and returns the output
+    for all complete segments, keeping the last segment back until final()
+    tells it is the end of the stream. Segments of a chunk are processed in
+    parallel when workers are given.
+
+    """
+    def __init__(self, keys, encrypt, workers=None, processes=False, segment_size=CHUNKED_SEGMENT_SIZE, nonce=None):
+        """SegmentCipher initializer
+
+        :param keys: (encryption key, authentication key)
+        :param encrypt: True to encrypt, False to decrypt
+        :param workers: number of threads or processes used
+        :param processes: use a process pool instead of threads
+        :param segment_size: segment size when encrypting
+        :param nonce: stream nonce when encrypting, random by default
+
+        """
+        self._keys = keys
+        self._encrypt = encrypt
+        self._workers = workers
+        self._processes = processes
+        self._pool = None
+        self._buffer = ''
+        self._index = 0
+        if encrypt:
+            self._segment_size = segment_size
+            self._nonce = nonce or os.urandom(8)
+            self._header = chunked_header(segment_size, self._nonce)
+        else:
+            self._segment_size = None
+            self._nonce = None
+            self._header = ''
+
+    def __call__(self, chunk):
+        """Returns the output for the complete segments buffered so far"""
+        self._buffer += str(chunk)
+        if not self._encrypt and self._segment_size is None:
+            if len(self._buffer) < CHUNKED_HEADER_SIZE:
+                return ''
+            self._segment_size, self._nonce = parse_chunked_header(self._buffer)
+            self._buffer = self._buffer[CHUNKED_HEADER_SIZE:]
+        unit = self._segment_size if self._encrypt else self._segment_size + CHUNKED_TAG_SIZE
+        count = (len(self._buffer) - 1) // unit
+        if count <= 0:
+            return self._take_header()
+        pieces = [self._buffer[i * unit:(i + 1) * unit] for i in range(count)]
+        self._buffer = self._buffer[count * unit:]
+        return self._take_header() + self._process(pieces, False)
+
+    @property
+    def nonce(self):
+        """Returns the stream nonce, None until a decrypted header is read"""
+        return self._nonce
+
+    def final(self):
+        """Returns the output for the last segment of the stream"""
+        try:
+            if not self._encrypt and self._segment_size is None:
+                raise HolviCryptException(903, 'Truncated data')
+            output = self._take_header() + self._process([self._buffer], True)
+            self._buffer = ''
+            return output
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the worker pool"""
+        if self._pool is not None:
+            if self._processes:
+                self._pool.terminate()
+            else:
+                self._pool.shutdown()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def _take_header(self):
+        header, self._header = self._header, ''
+        return header
+
+    def _process(self, pieces, final):
+        func = seal_segment if self._encrypt else open_segment
+        tasks = []
+        for i, piece in enumerate(pieces):
+            tasks.append((self._keys, self._nonce, self._index, final and i == len(pieces) - 1, piece))
+            self._index += 1
+        if not self._workers or self._workers < 2 or len(tasks) < 2:
+            return ''.join(func(task) for task in tasks)
+        if self._pool is None:
+            if self._processes:
+                self._pool = multiprocessing.Pool(self._workers)
+            else:
+                self._pool = WorkerPool(self._workers)
+        if self._processes:
+            return ''.join(self._pool.map(func, tasks))
+        return ''.join(self._pool.map(func, tasks, self._workers * 2))
 
 class CryptIterator(object):
     """CryptIterator iterates over a file and uses given function to decrypt/encrypt data
     in chunks
 
     """
-    def __init__(self, file, func, chunksize=4194304):
+    def __init__(self, file, func, chunksize=4194304, hashed=True):
         """CryptIterator initializer
 
         :param file: file-like object to be iterated
         :param func: function to be used on datachunk
         :param chunksize: amount of data to be handled at a time
+        :param hashed: update md5 of the data read, uploads hash the encrypted
+                       chunks later and can skip it
 
         """
         self.fileobj = file
         self.func = func
         self.chunksize = chunksize
+        self._hashed = hashed
         self._md5 = hashlib.md5()
+        self._finished = False
 
     def __iter__(self):
         return self
@@ -81,28 +453,40 @@ class CryptIterator(object):
     def next(self):
         """Read a chunk of data, updates md5 and returns encrypted/decrypted chunk
 
+        If func has a final method, it is called once at the end of the data
+        for the output func has held back.
         """
-        chunk = self.fileobj.read(self.chunksize)
-        if not chunk:
-            raise StopIteration
-        if len(chunk) == 0:
-            raise StopIteration
-        self._md5.update(chunk)
-        return self.func(chunk)
+        while True:
+            chunk = self.fileobj.read(self.chunksize)
+            if not chunk:
+                final = getattr(self.func, 'final', None)
+                if final is None or self._finished:
+                    raise StopIteration
+                self._finished = True
+                result = final()
+            else:
+                if self._hashed:
+                    self._md5.update(chunk)
+                result = self.func(chunk)
+            if result:
+                return result
 
 class FileIterator(object):
     """FileIterator
 
     """
-    def __init__(self, file, chunksize=4194304):
+    def __init__(self, file, chunksize=4194304, hashed=True):
         """FileIterator initializer
 
         :param file: file-like object to be iterated
         :param chunksize: amount of data to be handled at a time
+        :param hashed: update md5 of the data read, uploads hash the chunks
+                       later and can skip it
 
         """
         self.fileobj = file
         self.chunksize = chunksize
+        self._hashed = hashed
         self._md5 = hashlib.md5()
 
     def __iter__(self):
@@ -116,5 +500,132 @@ class FileIterator(object):
             raise StopIteration
         if len(chunk) == 0:
             raise StopIteration
-        self._md5.update(chunk)
+        if self._hashed:
+            self._md5.update(chunk)
         return chunk
+
+class MmapFile(object):
+    """MmapFile reads a regular file through a read-only memory map.
+
+    read returns buffer objects pointing into the map instead of copying
+    the data into new strings, md5, AES and socket sends consume them as
+    they are. The map is released when the file and the last slice are
+    gone, so slices stay valid after close.
+
+    """
+    def __init__(self, fileobj):
+        """MmapFile initializer
+
+        :param fileobj: regular file opened for reading, read from its current position
+
+        """
+        self.name = getattr(fileobj, 'name', None)
+        self._fileobj = fileobj
+        self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self._position = fileobj.tell()
+
+    def read(self, size=-1):
+        """Returns a buffer over the next size bytes of the file"""
+        end = len(self._map) if size is None or size < 0 else min(len(self._map), self._position + size)
+        start = min(self._position, end)
+        self._position = end
+        return buffer(self._map, start, end - start)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._map)
+        self._position = max(0, offset)
+
+    def tell(self):
+        return self._position
+
+    def fileno(self):
+        return self._fileobj.fileno()
+
+    def close(self):
+        """Drops the map, it is unmapped once no slice refers to it"""
+        self._map = None
+
+
+def mmap_source(fileobj):
+    """Returns an MmapFile for a non-empty regular file, None for other data
+
+    :param fileobj: data given for an upload
+
+    """
+    try:
+        info = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(info.st_mode) or info.st_size <= fileobj.tell():
+            return None
+        return MmapFile(fileobj)
+    except (AttributeError, ValueError, IOError, OSError, EnvironmentError, mmap.error):
+        return None
+
+
+class ChunkIterator(object):
+    """ChunkIterator iterates over data that is already split in chunks,
+    optionally using given function to decrypt/encrypt them
+
+    """
+    def __init__(self, chunks, func=None):
+        """ChunkIterator initializer
+
+        :param chunks: iterable yielding data chunks
+        :param func: function to be used on datachunk, None returns chunks as is
+
+        """
+        self._chunks = iter(chunks)
+        self.func = func
+        self._md5 = hashlib.md5()
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Takes the next chunk, updates md5 and returns the (decrypted/encrypted) chunk
+
+        If func has a final method, it is called once at the end of the chunks
+        for the output func has held back.
+        """
+        while True:
+            try:
+                chunk = self._chunks.next()
+            except StopIteration:
+                final = getattr(self.func, 'final', None)
+                if final is None or self._finished:
+                    raise
+                self._finished = True
+                result = final()
+            else:
+                self._md5.update(chunk)
+                if self.func is None:
+                    return chunk
+                result = self.func(chunk)
+            if result:
+                return result
+
+class ChunkHasher(object):
+    """ChunkHasher computes the md5 of each chunk and of the whole object
+    in one pass over every chunk. Both digests are fed from the same slice
+    of HASH_SLICE_SIZE bytes while it is still in the CPU cache.
+
+    """
+    def __init__(self):
+        """ChunkHasher initializer"""
+        self._md5 = hashlib.md5()
+
+    def __call__(self, chunk):
+        """Updates the object md5 and returns (chunk, chunk md5 hexdigest)"""
+        md5 = hashlib.md5()
+        for start in xrange(0, len(chunk), HASH_SLICE_SIZE):
+            piece = buffer(chunk, start, HASH_SLICE_SIZE)
+            md5.update(piece)
+            self._md5.update(piece)
+        return chunk, md5.hexdigest()
+
+    def hexdigest(self):
+        """Returns the md5 hexdigest of all chunks so far"""
+        return self._md5.hexdigest()
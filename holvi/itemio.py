@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""File objects reading and writing DataItems on the server."""
+import io
+import Queue
+import threading
+import collections
+
+import filecrypt
+import utils
+from holvi.exceptions import HolviDataItemException
+
+DEFAULT_BLOCK_SIZE = 262144
+DEFAULT_READAHEAD = 4
+DEFAULT_CACHE_BLOCKS = 16
+DEFAULT_MAX_PENDING = 2
+
+
+class DataItemReader(io.RawIOBase):
+    """DataItemReader is a seekable, read-only file object over a DataItem.
+
+    The content is read in blocks of block_size plaintext bytes with ranged
+    /fetch requests and the most recently used blocks are kept in a small
+    cache. When reads continue where the previous read ended, readahead
+    further blocks are fetched in the same request. Encrypted items are
+    decrypted, positions and lengths are those of the plaintext.
+
+    """
+    def __init__(self, dataitem, block_size=DEFAULT_BLOCK_SIZE, readahead=DEFAULT_READAHEAD,
+                 cache_blocks=DEFAULT_CACHE_BLOCKS):
+        """Initializer for DataItemReader
+
+        :param dataitem: DataItem to be read
+        :param block_size: plaintext bytes per cached block
+        :param readahead: blocks fetched ahead of sequential reads, 0 disables readahead
+        :param cache_blocks: number of blocks kept in the cache
+
+        """
+        super(DataItemReader, self).__init__()
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        self.dataitem = dataitem
+        self.block_size = block_size
+        self.readahead = max(0, readahead)
+        self.cache_blocks = max(1, cache_blocks)
+        self.stats = {'hits': 0, 'misses': 0, 'requests': 0}
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+        self._next_block = 0
+
+        self._stored_length, self._header, self.length = dataitem._content_layout()
+        if self._header is not None:
+            self.stats['requests'] += 1
+
+    @property
+    def name(self):
+        return self.dataitem.name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Moves the position and returns it, positions past the end read nothing"""
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError("Invalid whence ({0})".format(whence))
+        if position < 0:
+            raise IOError("Negative seek position {0}".format(position))
+        self._position = position
+        return position
+
+    def read(self, size=-1):
+        """Reads up to size bytes, or to the end of the item when size is negative"""
+        self._checkClosed()
+        if size is None or size < 0:
+            size = max(0, self.length - self._position)
+        buf = bytearray(min(size, max(0, self.length - self._position)))
+        count = self.readinto(buf)
+        return str(buf[:count])
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        """Reads into the writable buffer b and returns the number of bytes read"""
+        self._checkClosed()
+        start = self._position
+        end = min(start + len(b), self.length)
+        if end <= start:
+            return 0
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = self._load(first, last)
+        view = memoryview(b)
+        copied = 0
+        for index in range(first, last + 1):
+            block = blocks[index]
+            offset = max(start - index * self.block_size, 0)
+            count = min(len(block) - offset, end - start - copied)
+            view[copied:copied + count] = block[offset:offset + count]
+            copied += count
+        self._position = end
+        self._next_block = last + 1
+        return copied
+
+    def close(self):
+        self._blocks.clear()
+        super(DataItemReader, self).close()
+
+    def _load(self, first, last):
+        """Returns a dict of blocks first..last, fetching the blocks not cached.
+
+        Missing blocks are fetched in contiguous runs, one request per run.
+        Sequential reads extend the last run by the readahead window.
+
+        """
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            block = self._blocks.get(index)
+            if block is None:
+                self.stats['misses'] += 1
+                missing.append(index)
+            else:
+                self.stats['hits'] += 1
+                self._blocks[index] = self._blocks.pop(index)
+                blocks[index] = block
+        if not missing:
+            return blocks
+
+        if first == self._next_block and self.readahead:
+            block_count = (self.length + self.block_size - 1) // self.block_size
+            fetch_last = min(last + self.readahead, block_count - 1)
+            missing.extend(index for index in range(last + 1, fetch_last + 1) if index not in self._blocks)
+
+        run_start = missing[0]
+        for position, index in enumerate(missing):
+            if position + 1 == len(missing) or missing[position + 1] != index + 1:
+                self._fetch_blocks(run_start, index, blocks)
+                if position + 1 < len(missing):
+                    run_start = missing[position + 1]
+        return blocks
+
+    def _fetch_blocks(self, first, last, blocks):
+        """Fetches blocks first..last with one ranged request into blocks and the cache"""
+        start = first * self.block_size
+        data = self.dataitem._read_range(start, (last + 1) * self.block_size - 1,
+                                         self._stored_length, self._header)
+        self.stats['requests'] += 1
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            block = data[offset:offset + self.block_size]
+            blocks[index] = block
+            self._blocks[index] = block
+            while len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+
+
+class DataItemWriter(io.RawIOBase):
+    """DataItemWriter is a write-only file object storing a DataItem.
+
+    Writes of any size are buffered and sent as chunks of the Client's
+    request size. The first chunk is stored with 'new' (or 'append') and the
+    following chunks are appended. The rest of the buffer is sent when the
+    writer is closed, flush only waits for the chunks already handed to the
+    background thread. Data is encrypted in the Client's encryption mode,
+    appending to an ENC:AES256 item continues its stream and appending to an
+    ENC:AES256-CHUNKED item is not supported.
+    Once a chunk has failed, every later write, flush and close raises its
+    error and nothing more is sent.
+
+    """
+    def __init__(self, dataitem, append=False, background=False, max_pending=DEFAULT_MAX_PENDING):
+        """Initializer for DataItemWriter
+
+        :param dataitem: DataItem to be stored
+        :param append: append to an existing item instead of storing a new one
+        :param background: send chunks on a background thread while writes continue
+        :param max_pending: chunks queued for the background thread before write blocks
+
+        """
+        super(DataItemWriter, self).__init__()
+        self.dataitem = dataitem
+        self.append = append
+        self.bytes_written = 0
+        self._client = dataitem._client
+        if append:
+            dataitem._check_store_method('append')
+            self._encryptor = self._append_encryptor()
+        else:
+            self._encryptor = self._client._encryptor()
+        self._hasher = filecrypt.ChunkHasher()
+        self._headers = dataitem._store_headers()
+        self._headers['X-HOLVI-STORE-MODE'] = 'append' if append else 'new'
+        self._buffer = bytearray()
+        self._chunks_sent = 0
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = Queue.Queue(max(1, max_pending))
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def name(self):
+        return self.dataitem.name
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        """Buffers b, sending every full chunk, and returns the number of bytes written"""
+        self._checkClosed()
+        self._raise_error()
+        self._buffer += b
+        count = len(b) if not isinstance(b, memoryview) else b.itemsize * len(b)
+        self.bytes_written += count
+        size = self._client._request_size
+        while len(self._buffer) >= size:
+            chunk = str(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit(chunk)
+        return count
+
+    def flush(self):
+        """Waits for the chunks queued for the background thread to be sent"""
+        if self._queue is not None and self._thread.is_alive():
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Sends the buffered data and closes the writer"""
+        if self.closed:
+            return
+        try:
+            try:
+                if self._error is None:
+                    if self._buffer:
+                        chunk = str(self._buffer)
+                        self._buffer = bytearray()
+                        self._submit(chunk)
+                    final = getattr(self._encryptor, 'final', None)
+                    if final is not None:
+                        self._queue_or_send(final())
+            finally:
+                if self._thread is not None:
+                    self._queue.put(None)
+                    self._thread.join()
+            self._raise_error()
+            if not self._chunks_sent and not self.append:
+                raise HolviDataItemException(700, "Empty content")
+        finally:
+            self._client._close_encryptor(self._encryptor)
+            super(DataItemWriter, self).close()
+
+    def _append_encryptor(self):
+        """Returns the encryptor continuing the stream of the item at its end"""
+        if self._client.encryption_mode != utils.ENC_AES256:
+            return self._client._encryptor()
+        length = self.dataitem._content_layout()[0]
+        preceding = self.dataitem._fetch_range(length - min(length, 16), length - 1) if length else ''
+        return self._client.crypt.encryptor_at(length, preceding)
+
+    def _submit(self, chunk):
+        if self._encryptor is not None:
+            chunk = self._encryptor(chunk)
+        self._queue_or_send(chunk)
+
+    def _queue_or_send(self, chunk):
+        self._raise_error()
+        if not chunk:
+            return
+        chunk, digest = self._hasher(chunk)
+        if self._queue is None:
+            self._send(chunk, digest)
+        else:
+            self._queue.put((chunk, digest))
+
+    def _send(self, chunk, digest):
+        try:
+            self.dataitem._send_chunk(self._headers, chunk, digest)
+        except Exception as e:
+            self._error = e
+            raise
+        self._headers['X-HOLVI-STORE-MODE'] = 'append'
+        self._chunks_sent += 1
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    self._send(*item)
+            except Exception:
+                # _send keeps the error, the writer raises it
+                pass
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import threading
+
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.holvi', 'journal')
+
+
+def source_identity(fileobj):
+    """Returns a string identifying the contents of a regular file.
+
+    :param fileobj: file object opened for reading
+
+    The identity is built from the file's real path, size and modification
+    time. Returns None for pipes, sockets and in-memory objects which can
+    not be read again.
+
+    """
+    name = getattr(fileobj, 'name', None)
+    if not isinstance(name, basestring) or not os.path.isfile(name):
+        return None
+    try:
+        stat = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return '{0}:{1}:{2}'.format(os.path.realpath(name), stat.st_size, stat.st_mtime)
+
+
+class UploadJournal(object):
+    """UploadJournal records the acknowledged chunks of an upload.
+
+    The journal is a small append-only file: a JSON header describing the
+    upload followed by one line per chunk, written as pending before the
+    chunk is sent and as acknowledged after the server has stored it.
+
+    """
+    def __init__(self, directory, server_url, parent_id, key, identity):
+        """Initializer for UploadJournal
+
+        :param directory: directory the journal files are kept in
+        :param server_url: server the data is uploaded to
+        :param parent_id: id of the parent Cluster/Vault
+        :param key: name of the dataitem
+        :param identity: source identity from source_identity
+
+        """
+        name = json.dumps([server_url, parent_id, key, identity])
+        self.path = os.path.join(directory, hashlib.sha1(name).hexdigest() + '.journal')
+        self.identity = identity
+        self.header = None
+        self.acknowledged = 0
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def start(self, **header):
+        """Starts a new journal with given header values, dropping old entries"""
+        header['identity'] = self.identity
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        with self._lock:
+            with open(self.path, 'w') as journal_file:
+                journal_file.write(json.dumps(header) + '\n')
+            self.header = header
+            self.acknowledged = 0
+            self.pending = 0
+
+    def matches(self, **header):
+        """Returns True if the journal was started with given header values"""
+        if self.header is None:
+            return False
+        return all(self.header.get(key) == value for key, value in header.items())
+
+    def record_pending(self, position, length, digest):
+        """Records a chunk at position that is about to be sent"""
+        self._append('P', position, length, digest)
+        self.pending = length
+
+    def record_acknowledged(self, position, length, digest):
+        """Records a chunk at position that the server has stored"""
+        self._append('A', position, length, digest)
+        if position == self.acknowledged:
+            self.acknowledged += length
+        self.pending = 0
+
+    def remove(self):
+        """Removes the journal of a finished upload"""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.header = None
+            self.acknowledged = 0
+            self.pending = 0
+
+    def _append(self, state, position, length, digest):
+        with self._lock:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write('{0} {1} {2} {3}\n'.format(state, position, length, digest))
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def _load(self):
+        try:
+            with open(self.path) as journal_file:
+                lines = journal_file.read().splitlines()
+        except IOError:
+            return
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if not isinstance(header, dict) or header.get('identity') != self.identity:
+            return
+        self.header = header
+        for line in lines[1:]:
+            try:
+                state, position, length, digest = line.split(' ')
+                position, length = int(position), int(length)
+            except ValueError:
+                break
+            if state == 'P' and position == self.acknowledged:
+                self.pending = length
+            elif state == 'A' and position == self.acknowledged:
+                self.acknowledged += length
+                self.pending = 0
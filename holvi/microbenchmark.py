@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks and profiling for FileIterator and CryptIterator.
+
+Measures bytes per second of read+hash (FileIterator) and read+hash+AES
+(CryptIterator with ENC:AES256 and ENC:AES256-CHUNKED encryptors) over
+chunk sizes and source types: a regular file read normally or through
+filecrypt.MmapFile, a pipe fed by a thread and an in-memory StringIO.
+Every case runs in a forked process and the peak growth of its anonymous
+memory is reported as the peak allocation, see PeakMemory. Reports use
+the same JSON format as holvi.benchmark:
+
+    python -m holvi.microbenchmark --output micro.json --profile profiles/
+
+With --profile, a cProfile file (.prof, for pstats, snakeviz or
+gprof2dot) and sampled stacks in folded format (.folded, for
+flamegraph.pl or speedscope) are written for every case.
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import cProfile
+import resource
+import threading
+import collections
+import multiprocessing
+import StringIO
+
+from .filecrypt import FileCrypt, FileIterator, CryptIterator, MmapFile
+from .benchmark import compare, DEFAULT_THRESHOLD, BENCH_KEY
+import utils
+
+SOURCES = ('file', 'mmap', 'pipe', 'memory')
+OPERATIONS = ('hash', 'hash+aes', 'hash+aes-chunked')
+DEFAULT_CHUNK_SIZES = [65536, 1048576, 4194304]
+DEFAULT_TOTAL = 33554432
+SAMPLE_INTERVAL = 0.001
+
+
+class StackSampler(object):
+    """StackSampler records the stack of a thread at fixed intervals.
+
+    The counts are written in the folded format used by flame graph tools,
+    one line per distinct stack: frames from the outermost, separated by
+    semicolons, followed by the number of samples.
+
+    """
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, root=None):
+        """Initializer for StackSampler
+
+        :param thread_id: ident of the thread to be sampled
+        :param interval: seconds between samples
+        :param root: code object of the outermost frame recorded, None records whole stacks
+
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Writes the sampled stacks in folded format to path"""
+        with open(path, 'w') as folded:
+            for stack, count in sorted(self.counts.items()):
+                folded.write('{0} {1}\n'.format(stack, count))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                    code.co_firstlineno))
+                if code is self.root:
+                    break
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+
+class PeakMemory(object):
+    """PeakMemory tracks the peak growth of anonymous memory while running.
+
+    Anonymous resident memory (RssAnon in /proc/self/status) is sampled at
+    fixed intervals, it leaves out mapped file pages, which are not
+    allocations. Where it is not available the growth of the maximum
+    resident set size is used, which is only meaningful in a fresh process.
+
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+
+    def start(self):
+        self._start = _anonymous_rss()
+        if self._start is None:
+            self._start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the peak growth in bytes"""
+        if self._thread is None:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - self._start
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return self.peak
+
+    def _sample(self):
+        self.peak = max(self.peak, (_anonymous_rss() or 0) - self._start)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+
+def _anonymous_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def open_source(kind, data, directory):
+    """Returns (file object, cleanup function) reading data from given source kind
+
+    :param kind: 'file', 'mmap', 'pipe' or 'memory'
+    :param data: the data to be read
+    :param directory: directory for the temporary file of a 'file' source
+
+    """
+    if kind == 'memory':
+        fileobj = StringIO.StringIO(data)
+        return fileobj, fileobj.close
+    if kind in ('file', 'mmap'):
+        path = os.path.join(directory, 'source')
+        with open(path, 'wb') as source:
+            source.write(data)
+        regular = open(path, 'rb')
+        fileobj = MmapFile(regular) if kind == 'mmap' else regular
+
+        def cleanup():
+            fileobj.close()
+            regular.close()
+            os.remove(path)
+        return fileobj, cleanup
+    if kind == 'pipe':
+        read_fd, write_fd = os.pipe()
+        fileobj = os.fdopen(read_fd, 'rb')
+
+        def feed():
+            with os.fdopen(write_fd, 'wb') as pipe:
+                pipe.write(data)
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+
+        def cleanup():
+            fileobj.close()
+            writer.join()
+        return fileobj, cleanup
+    raise ValueError("Unknown source '{0}'".format(kind))
+
+
+def make_iterator(operation, fileobj, chunksize):
+    """Returns the iterator measured by an operation
+
+    :param operation: 'hash', 'hash+aes' or 'hash+aes-chunked'
+    :param fileobj: source file object
+    :param chunksize: chunk size of the iterator
+
+    """
+    if operation == 'hash':
+        return FileIterator(fileobj, chunksize)
+    crypt = FileCrypt(BENCH_KEY, utils.IV_DEFAULT)
+    if operation == 'hash+aes':
+        return CryptIterator(fileobj, crypt.encryptor(), chunksize)
+    if operation == 'hash+aes-chunked':
+        return CryptIterator(fileobj, crypt.chunked_encryptor(), chunksize)
+    raise ValueError("Unknown operation '{0}'".format(operation))
+
+
+def run_case(operation, source, chunksize, total, profile_dir=None):
+    """Runs one case in the calling process and returns its result dict
+
+    :param operation: iterator operation, see OPERATIONS
+    :param source: source kind, see SOURCES
+    :param chunksize: chunk size of the iterator
+    :param total: number of bytes read
+    :param profile_dir: directory for .prof and .folded output, None skips profiling
+
+    """
+    data = os.urandom(total)
+    directory = tempfile.mkdtemp()
+    try:
+        fileobj, cleanup = open_source(source, data, directory)
+        name = '{0}-{1}-{2}'.format(operation, source, chunksize).replace('+', '_')
+        profiler = sampler = None
+        if profile_dir is not None:
+            profiler = cProfile.Profile()
+            sampler = StackSampler(threading.current_thread().ident, root=run_case.func_code)
+            sampler.start()
+            profiler.enable()
+        memory = PeakMemory()
+        memory.start()
+        start = time.time()
+        nbytes = 0
+        for chunk in make_iterator(operation, fileobj, chunksize):
+            nbytes += len(chunk)
+        seconds = time.time() - start
+        peak = memory.stop()
+        if profiler is not None:
+            profiler.disable()
+            sampler.stop()
+            profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+            sampler.write(os.path.join(profile_dir, name + '.folded'))
+        cleanup()
+    finally:
+        shutil.rmtree(directory)
+
+    params = {'operation': operation, 'source': source, 'chunksize': chunksize}
+    label = ' '.join('{0}={1}'.format(key, params[key]) for key in sorted(params))
+    return {'id': 'iterate ' + label,
+            'name': 'iterate',
+            'params': params,
+            'unit': 'MB/s',
+            'value': total / 1048576.0 / max(seconds, 1e-9),
+            'higher_is_better': True,
+            'bytes': nbytes,
+            'seconds': seconds,
+            'peak_memory_growth': peak}
+
+
+def _run_child(queue, args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:
+        queue.put(e)
+
+
+def run_isolated(operation, source, chunksize, total, profile_dir=None):
+    """Runs one case in a forked process, see run_case"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_child,
+                                      args=(queue, (operation, source, chunksize, total, profile_dir)))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def run_suite(total=DEFAULT_TOTAL, chunk_sizes=DEFAULT_CHUNK_SIZES, sources=SOURCES, operations=OPERATIONS,
+              profile_dir=None, isolate=True, progress=None):
+    """Runs every combination of operation, source and chunk size, returns the report dict
+
+    :param isolate: run each case in a forked process, needed for peak allocation
+    :param progress: function called with each result as it is ready
+
+    """
+    runner = run_isolated if isolate else run_case
+    if profile_dir is not None and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    results = []
+    for operation in operations:
+        for source in sources:
+            for chunksize in chunk_sizes:
+                result = runner(operation, source, chunksize, total, profile_dir)
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    return {'meta': {'time': time.time(), 'total': total}, 'results': results}
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FileIterator and CryptIterator microbenchmarks")
+    parser.add_argument('--total', type=int, default=DEFAULT_TOTAL, help="bytes read per case")
+    parser.add_argument('--chunk-sizes', type=_int_list, default=DEFAULT_CHUNK_SIZES, help="comma separated chunk sizes")
+    parser.add_argument('--sources', default=','.join(SOURCES), help="comma separated sources: file, mmap, pipe, memory")
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help="comma separated operations: hash, hash+aes, hash+aes-chunked")
+    parser.add_argument('--profile', default=None, metavar='DIR', help="write .prof and .folded profiles into DIR")
+    parser.add_argument('--output', '-o', default=None, help="write the JSON report to this file")
+    parser.add_argument('--baseline', '-b', default=None, help="compare against this JSON report")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="relative change reported as better/worse")
+    args = parser.parse_args()
+
+    def progress(result):
+        print >> sys.stderr, "{0}: {1:.2f} MB/s, peak +{2} bytes".format(result['id'], result['value'],
+                                                                          result['peak_memory_growth'])
+
+    report = run_suite(args.total, args.chunk_sizes, args.sources.split(','), args.operations.split(','),
+                       args.profile, progress=progress)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print >> sys.stdout
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare(report, json.load(baseline_file), args.threshold)
+        for entry in comparison:
+            print >> sys.stderr, "{0}: {1:+.1%} {2}".format(entry['id'], entry['change'], entry['status'])
+        if any(entry['status'] == 'worse' for entry in comparison):
+            sys.exit(1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import threading
+import Queue
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class Pipeline(object):
+    """Pipeline runs the stages of a transfer on their own threads.
+
+    The source is iterated on one thread and every stage function on
+    another, connected by bounded queues, so reading, encrypting and sending
+    of consecutive chunks overlap. Iterating the pipeline yields the output
+    of the last stage in order. A stage function may hold data back by
+    returning an empty string, if it has a final method that is called at
+    the end of the data for the rest.
+
+    Busy time, item and byte counts of every stage, including the consumer
+    of the pipeline, are collected into stats.
+
+    """
+    def __init__(self, source, stages=(), depth=2, source_name='read', sink_name='sink'):
+        """Initializer for Pipeline
+
+        :param source: iterable producing the data chunks
+        :param stages: list of (name, function) applied to every chunk in order
+        :param depth: maximum number of chunks waiting between two stages
+        :param source_name: name of the source stage in stats
+        :param sink_name: name of the consumer in stats
+
+        """
+        self._stop = threading.Event()
+        self._stages = dict(stages)
+        self._sink_name = sink_name
+        self._last_return = None
+        self._finished = False
+        self.stats = {}
+        self._order = [source_name] + [name for name, func in stages] + [sink_name]
+        for name in self._order:
+            self.stats[name] = {'seconds': 0.0, 'items': 0, 'bytes': 0}
+
+        queue = Queue.Queue(depth)
+        self._threads = [threading.Thread(target=self._run_source, args=(source, source_name, queue))]
+        for name, func in stages:
+            out_queue = Queue.Queue(depth)
+            self._threads.append(threading.Thread(target=self._run_stage, args=(func, name, queue, out_queue)))
+            queue = out_queue
+        self._output = queue
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Returns the next chunk out of the last stage
+
+        Once the data has ended or a stage has failed, later calls raise
+        StopIteration.
+
+        """
+        if self._finished:
+            raise StopIteration
+        now = time.time()
+        if self._last_return is not None:
+            self.stats[self._sink_name]['seconds'] += now - self._last_return
+        item = self._output.get()
+        if item is _END:
+            self._last_return = None
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._finished = True
+            self.close()
+            raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+        self._count(self._sink_name, item, 0)
+        self._last_return = time.time()
+        return item
+
+    def close(self):
+        """Stops the stage threads"""
+        self._stop.set()
+
+    def has_stage(self, name):
+        """Returns True if the pipeline has a stage with given name"""
+        return name in self._stages
+
+    def stage(self, name):
+        """Returns the function of the stage with given name"""
+        return self._stages[name]
+
+    @property
+    def bottleneck(self):
+        """Returns the name of the stage with the largest busy time"""
+        return max(self._order, key=lambda name: self.stats[name]['seconds'])
+
+    def _count(self, name, item, seconds):
+        stats = self.stats[name]
+        stats['seconds'] += seconds
+        stats['items'] += 1
+        if isinstance(item, tuple):
+            item = item[0]
+        try:
+            stats['bytes'] += len(item)
+        except TypeError:
+            pass
+
+    def _put(self, queue, item):
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run_source(self, source, name, out_queue):
+        try:
+            iterator = iter(source)
+            while True:
+                start = time.time()
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    break
+                self._count(name, item, time.time() - start)
+                if not self._put(out_queue, item):
+                    return
+        except Exception:
+            self._put(out_queue, _Failure(sys.exc_info()))
+            return
+        self._put(out_queue, _END)
+
+    def _run_stage(self, func, name, in_queue, out_queue):
+        while not self._stop.is_set():
+            try:
+                item = in_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if item is _END and hasattr(func, 'final'):
+                try:
+                    start = time.time()
+                    result = func.final()
+                    self._count(name, result, time.time() - start)
+                except Exception:
+                    item = _Failure(sys.exc_info())
+                else:
+                    if result and not self._put(out_queue, result):
+                        return
+            if item is _END or isinstance(item, _Failure):
+                self._put(out_queue, item)
+                return
+            try:
+                start = time.time()
+                result = func(item)
+                self._count(name, result, time.time() - start)
+            except Exception:
+                self._put(out_queue, _Failure(sys.exc_info()))
+                return
+            if result == '':
+                continue
+            if not self._put(out_queue, result):
+                return
@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Holvi server.
+
+Implements the JSON RPC methods used by Connection.make_request, batches
+of them sent as a JSON list by Connection.make_batch_request, and the
+/store and /fetch endpoints with the X-HOLVI-* header protocol, keeping
+data in memory or in a directory. Used for tests and benchmarks without
+a live service, either in-process with LocalServer or as a subprocess
+with ServerProcess (python -m holvi.server).
+
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import hashlib
+import argparse
+import signal
+import socket
+import threading
+import subprocess
+import Cookie
+import BaseHTTPServer
+import SocketServer
+import email.utils
+
+from holvi.exceptions import HolviException, HolviAuthException, HolviAPIException, \
+    HolviClusterException, HolviDataItemException
+
+API_PREFIX = '/api/1.0'
+SESSION_COOKIE = 'holvi_session'
+READ_SIZE = 1048576
+
+ERR_CHECKSUM = 1001
+ERR_EXISTS = 1002
+ERR_STORE_MODE = 1003
+ERR_NOT_FOUND = 1004
+ERR_NO_PARENT = 1005
+ERR_METHOD = 1006
+
+
+class MemoryStorage(object):
+    """MemoryStorage keeps containers and data items in memory.
+
+    containers maps container ids to vault/cluster attribute dicts and items
+    maps (parent_id, key) to item information (meta, modified, md5).
+
+    """
+    def __init__(self):
+        self.containers = {}
+        self.items = {}
+        self.next_id = 1
+        self._data = {}
+
+    def size(self, item):
+        """Returns the stored length of item"""
+        return len(self._data[item])
+
+    def read(self, item, start, length):
+        """Returns length bytes of item starting at start"""
+        return str(self._data[item][start:start + length])
+
+    def write(self, item, data, offset):
+        """Writes data at offset, extending item with zero bytes when needed"""
+        buf = self._data.setdefault(item, bytearray())
+        if offset > len(buf):
+            buf.extend('\0' * (offset - len(buf)))
+        buf[offset:offset + len(data)] = data
+
+    def truncate(self, item):
+        """Empties item"""
+        self._data[item] = bytearray()
+
+    def remove(self, item):
+        """Removes the data of item"""
+        self._data.pop(item, None)
+
+    def save(self):
+        """Persists containers and item information, nothing to do in memory"""
+        pass
+
+
+class DiskStorage(MemoryStorage):
+    """DiskStorage keeps data items as files in a directory.
+
+    Containers and item information are saved to index.json in the same
+    directory, so a server restarted on the directory sees the same data.
+
+    """
+    def __init__(self, directory):
+        """Initializer for DiskStorage
+
+        :param directory: directory for data files, created when missing
+
+        """
+        MemoryStorage.__init__(self)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self._index_path) as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError):
+            return
+        self.containers = dict((int(id_), container) for id_, container in index['containers'].items())
+        self.items = dict(((parent_id, key), info) for parent_id, key, info in index['items'])
+        self.next_id = index['next_id']
+
+    def size(self, item):
+        return os.path.getsize(self._path(item))
+
+    def read(self, item, start, length):
+        with open(self._path(item), 'rb') as data_file:
+            data_file.seek(start)
+            return data_file.read(length)
+
+    def write(self, item, data, offset):
+        path = self._path(item)
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as data_file:
+            data_file.seek(offset)
+            data_file.write(data)
+
+    def truncate(self, item):
+        open(self._path(item), 'wb').close()
+
+    def remove(self, item):
+        path = self._path(item)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save(self):
+        index = {'containers': self.containers,
+                 'items': [[parent_id, key, info] for (parent_id, key), info in self.items.items()],
+                 'next_id': self.next_id}
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(temp_path, self._index_path)
+
+    def _path(self, item):
+        return os.path.join(self.directory, hashlib.sha1(json.dumps(list(item))).hexdigest() + '.data')
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self._requests = {}
+        self._requests_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self._requests_lock:
+            self._requests[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        with self._requests_lock:
+            self._requests.pop(request, None)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_requests(self):
+        """Closes the keep-alive connections still open and waits for their threads"""
+        with self._requests_lock:
+            requests = self._requests.items()
+        for request, thread in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for request, thread in requests:
+            thread.join(1.0)
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer the status line and headers into one send and disable Nagle,
+    # small writes would otherwise wait for delayed ACKs on keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.holvi._count('bytes_in', len(body))
+        if self.path == API_PREFIX + '/json':
+            self._rpc(body)
+        elif self.path == API_PREFIX + '/store':
+            self._transaction(self.server.holvi.store, body)
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self._fetch(True)
+
+    def do_HEAD(self):
+        self._fetch(False)
+
+    def _session(self):
+        cookie = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        if SESSION_COOKIE in cookie:
+            return cookie[SESSION_COOKIE].value
+        return None
+
+    def _rpc(self, body):
+        holvi = self.server.holvi
+        cookie = None
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            request = None
+            response = self._rpc_error(HolviAPIException(ERR_METHOD, str(e)))
+        if isinstance(request, list):
+            response = [self._rpc_call(call, batched=True)[0] for call in request]
+        elif request is not None:
+            response, cookie = self._rpc_call(request)
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        if cookie:
+            self.send_header('Set-Cookie', '{0}={1}; Path=/'.format(SESSION_COOKIE, cookie))
+        self.end_headers()
+        self.wfile.write(body)
+        holvi._count('bytes_out', len(body))
+
+    def _rpc_call(self, request, batched=False):
+        """Runs one request object, returns (response dict, new session cookie)
+
+        Authentication is not allowed inside a batch.
+
+        """
+        holvi = self.server.holvi
+        cookie = None
+        try:
+            method, params = request['method'], request.get('params') or {}
+            if method == 'auth' and not batched:
+                cookie = holvi.auth(**params)
+                response = {}
+            else:
+                holvi.check_session(self._session())
+                response = holvi.call(method, params)
+            response['result'] = 'success'
+        except HolviException as e:
+            response = self._rpc_error(e)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            response = self._rpc_error(HolviAPIException(ERR_METHOD, str(e)))
+        return response, cookie
+
+    def _rpc_error(self, e):
+        return {'result': 'error', 'exception': {'type': type(e).__name__, 'id': e.id, 'message': e.message}}
+
+    def _transaction(self, func, *args):
+        try:
+            self.server.holvi.check_session(self._session())
+        except HolviAuthException:
+            self._send_headers(401, {'Content-Length': 0})
+            return
+        try:
+            headers = func(self.headers, *args)
+        except HolviException as e:
+            headers = {'X-HOLVI-RESULT': 'ERROR: {0} {1}'.format(e.id, e.message)}
+        headers.setdefault('X-HOLVI-RESULT', 'OK')
+        headers.setdefault('Content-Length', 0)
+        self._send_headers(200, headers)
+
+    def _send_headers(self, status, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def _fetch(self, send_body):
+        if self.path != API_PREFIX + '/fetch':
+            self.send_error(404)
+            return
+        holvi = self.server.holvi
+        try:
+            holvi.check_session(self._session())
+        except HolviAuthException:
+            self._send_headers(401, {'Content-Length': 0})
+            return
+        try:
+            item, headers, start, end = holvi.fetch(self.headers)
+        except HolviException as e:
+            self._send_headers(200, {'X-HOLVI-RESULT': 'ERROR: {0} {1}'.format(e.id, e.message),
+                                     'Content-Length': 0})
+            return
+        if start is None:
+            status = 200
+            start, end = 0, int(headers['Content-Length']) - 1
+        elif start > end:
+            status = 416
+            headers['Content-Length'] = 0
+        else:
+            status = 206
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, headers['Content-Length'])
+            headers['Content-Length'] = end - start + 1
+        self._send_headers(status, headers)
+        if not send_body or status == 416:
+            return
+        position = start
+        while position <= end:
+            chunk = holvi.read(item, position, min(READ_SIZE, end - position + 1))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            holvi._count('bytes_out', len(chunk))
+            position += len(chunk)
+
+
+class LocalServer(object):
+    """LocalServer serves the Holvi API on localhost from a thread.
+
+    Any credentials are accepted unless users is given. Request and byte
+    counters are collected into stats.
+
+    Chunks sent to /store are written under a lock of their item, the
+    server-wide lock is only held to check and update the index. The index
+    is saved when a store adds an item and when the server is stopped.
+
+    """
+    def __init__(self, directory=None, users=None, host='127.0.0.1', port=0):
+        """Initializer for LocalServer
+
+        :param directory: directory for on-disk storage, None keeps data in memory
+        :param users: dict of accepted usernames and passwords, None accepts anyone
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free port
+
+        """
+        if directory is None:
+            self.storage = MemoryStorage()
+        else:
+            self.storage = DiskStorage(directory)
+        self.users = users
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._sessions = set()
+        self._lock = threading.RLock()
+        self._item_locks = {}
+        self._index_changed = False
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.holvi = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        """Returns the server url to be given to Client"""
+        host, port = self._httpd.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        """Starts serving on a daemon thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serves on the calling thread until stopped"""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """Stops serving and closes the listening socket"""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+        self._httpd.close_requests()
+        with self._lock:
+            if self._index_changed:
+                self.storage.save()
+                self._index_changed = False
+
+    def auth(self, username=None, auth_data=None, auth_method=None, apikey=None):
+        """Checks credentials and returns a new session token"""
+        self._count('requests')
+        if self.users is not None and self.users.get(username) != auth_data:
+            raise HolviAuthException(902, "Authentication failed")
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._sessions.add(token)
+        return token
+
+    def check_session(self, token):
+        """Raises HolviAuthException unless token is a session given by auth"""
+        with self._lock:
+            if token not in self._sessions:
+                raise HolviAuthException(902, "Not authenticated")
+
+    def call(self, method, params):
+        """Runs JSON RPC method with params and returns the response dict"""
+        self._count('requests')
+        func = getattr(self, 'rpc_' + method, None)
+        if func is None:
+            raise HolviAPIException(ERR_METHOD, "Unknown method '{0}'".format(method))
+        with self._lock:
+            return func(**params)
+
+    def rpc_list_vaults(self, vault_type=None, id_=None, role=None):
+        vaults = []
+        for container in self._containers():
+            if container['parent_id'] is not None:
+                continue
+            if vault_type is not None and container['vault_type'] != vault_type:
+                continue
+            if id_ is not None and str(container['id']) != str(id_):
+                continue
+            if role is not None and role != 'own':
+                continue
+            vaults.append(self._describe(container))
+        return {'vaults': vaults}
+
+    def rpc_list_clusters(self, parent_id):
+        self._container(parent_id)
+        clusters = [self._describe(container) for container in self._containers()
+                    if str(container['parent_id']) == str(parent_id)]
+        return {'clusters': clusters}
+
+    def rpc_list_dataitems(self, cluster_id):
+        self._container(cluster_id)
+        keys = sorted(key for parent_id, key in self.storage.items if parent_id == str(cluster_id))
+        return {'dataitems': keys}
+
+    def rpc_add_vault(self, vault_type, name):
+        container = self._add_container(name, None)
+        container['vault_type'] = vault_type
+        self.storage.save()
+        return {'vault': self._describe(container)}
+
+    def rpc_add_cluster(self, parent_id, name):
+        parent = self._container(parent_id)
+        container = self._add_container(name, parent['id'])
+        self.storage.save()
+        return {'cluster': self._describe(container)}
+
+    def rpc_remove_cluster(self, cluster_id):
+        self._remove_container(self._container(cluster_id))
+        self.storage.save()
+        return {}
+
+    def rpc_remove_vault(self, vault_id):
+        return self.rpc_remove_cluster(vault_id)
+
+    def rpc_remove_dataitem(self, cluster_id, key):
+        item = (str(cluster_id), key)
+        if item not in self.storage.items:
+            raise HolviDataItemException(ERR_NOT_FOUND, "Data item not found")
+        del self.storage.items[item]
+        self.storage.remove(item)
+        self.storage.save()
+        return {}
+
+    def store(self, headers, data):
+        """Stores one chunk sent to /store, returns the response headers"""
+        self._count('requests')
+        item = (str(headers.get('X-HOLVI-PARENT')), headers.get('X-HOLVI-KEY'))
+        mode = headers.get('X-HOLVI-STORE-MODE', 'new')
+        digest = headers.get('X-HOLVI-HASH')
+        if digest and hashlib.md5(data).hexdigest() != digest:
+            raise HolviDataItemException(ERR_CHECKSUM, "Checksum mismatch")
+        with self._item_lock(item):
+            with self._lock:
+                self._container(item[0])
+                exists = item in self.storage.items
+            if mode == 'new' and exists:
+                raise HolviDataItemException(ERR_EXISTS, "Data item exists")
+            if mode not in ('new', 'replace', 'append', 'patch'):
+                raise HolviDataItemException(ERR_STORE_MODE, "Invalid store mode '{0}'".format(mode))
+            if mode in ('new', 'replace') or not exists:
+                self.storage.truncate(item)
+            if mode in ('new', 'replace'):
+                offset = 0
+            elif mode == 'append':
+                offset = self.storage.size(item)
+            else:
+                offset = int(headers.get('X-HOLVI-OFFSET', 0))
+            self.storage.write(item, data, offset)
+            with self._lock:
+                added = item not in self.storage.items
+                self.storage.items[item] = {'meta': headers.get('X-HOLVI-META', ''),
+                                            'modified': time.time(),
+                                            'md5': None}
+                if added:
+                    self.storage.save()
+                else:
+                    self._index_changed = True
+        return {}
+
+    def fetch(self, headers):
+        """Returns (item, response headers, start, end) of a /fetch request.
+
+        start and end are the requested inclusive byte range, start is None
+        when the whole item was requested.
+
+        """
+        self._count('requests')
+        item = (str(headers.get('X-HOLVI-PARENT')), headers.get('X-HOLVI-KEY'))
+        with self._lock:
+            info = self.storage.items.get(item)
+            if info is None:
+                raise HolviDataItemException(ERR_NOT_FOUND, "Data item not found")
+            length = self.storage.size(item)
+            if info['md5'] is None:
+                md5 = hashlib.md5()
+                for position in range(0, length, READ_SIZE):
+                    md5.update(self.storage.read(item, position, READ_SIZE))
+                info['md5'] = md5.hexdigest()
+            response = {'X-HOLVI-RESULT': 'OK',
+                        'X-HOLVI-HASH': info['md5'],
+                        'X-HOLVI-META': info['meta'],
+                        'Last-Modified': email.utils.formatdate(info['modified'], usegmt=True),
+                        'Content-Type': 'application/octet-stream',
+                        'Content-Length': length}
+        start = end = None
+        ranges = headers.get('Range')
+        if ranges and ranges.startswith('bytes='):
+            first, last = ranges[6:].split('-', 1)
+            start = int(first)
+            end = min(int(last), length - 1) if last else length - 1
+        return item, response, start, end
+
+    def read(self, item, start, length):
+        """Returns length bytes of a stored item starting at start"""
+        with self._lock:
+            return self.storage.read(item, start, length)
+
+    def _item_lock(self, item):
+        with self._lock:
+            return self._item_locks.setdefault(item, threading.Lock())
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _containers(self):
+        return [self.storage.containers[id_] for id_ in sorted(self.storage.containers)]
+
+    def _container(self, id_):
+        try:
+            return self.storage.containers[int(id_)]
+        except (KeyError, ValueError, TypeError):
+            raise HolviClusterException(ERR_NO_PARENT, "Cluster not found")
+
+    def _add_container(self, name, parent_id):
+        container = {'id': self.storage.next_id, 'name': name, 'parent_id': parent_id}
+        self.storage.containers[container['id']] = container
+        self.storage.next_id += 1
+        return container
+
+    def _remove_container(self, container):
+        for child in self._containers():
+            if child['parent_id'] == container['id']:
+                self._remove_container(child)
+        for item in [item for item in self.storage.items if item[0] == str(container['id'])]:
+            del self.storage.items[item]
+            self.storage.remove(item)
+        del self.storage.containers[container['id']]
+
+    def _describe(self, container):
+        description = dict(container)
+        description['descendants'] = self._descendants(container['id'])
+        description['dataitems'] = len([item for item in self.storage.items if item[0] == str(container['id'])])
+        return description
+
+    def _descendants(self, id_):
+        children = [child['id'] for child in self.storage.containers.values() if child['parent_id'] == id_]
+        return len(children) + sum(self._descendants(child) for child in children)
+
+
+class ServerProcess(object):
+    """ServerProcess runs a LocalServer in a subprocess on localhost"""
+    def __init__(self, directory=None, users=None):
+        """Initializer for ServerProcess
+
+        :param directory: directory for on-disk storage, None keeps data in memory
+        :param users: dict of accepted usernames and passwords, None accepts anyone
+
+        """
+        self.directory = directory
+        self.users = users
+        self.url = None
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Starts the subprocess and waits for its url"""
+        command = [sys.executable, '-m', 'holvi.server']
+        if self.directory is not None:
+            command += ['--directory', self.directory]
+        for username, password in (self.users or {}).items():
+            command += ['--user', '{0}:{1}'.format(username, password)]
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        self.url = self._process.stdout.readline().strip()
+        if not self.url:
+            self._process.wait()
+            raise RuntimeError("Local Holvi server did not start")
+
+    def stop(self):
+        """Terminates the subprocess"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in Holvi server")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=0, help="port to listen on, 0 picks a free port")
+    parser.add_argument('--directory', '-d', default=None, help="keep data in this directory instead of memory")
+    parser.add_argument('--user', action='append', default=None, help="accepted username:password, repeatable")
+    args = parser.parse_args()
+
+    users = None
+    if args.user:
+        users = dict(user.split(':', 1) for user in args.user)
+    server = LocalServer(args.directory, users, args.host, args.port)
+    print >> sys.stdout, server.url
+    sys.stdout.flush()
+    # ServerProcess.stop terminates the process, stop the server to save the index
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == '__main__': main()
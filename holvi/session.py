@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import cookielib
+import threading
+
+DEFAULT_SESSION_PATH = os.path.join(os.path.expanduser('~'), '.holvi', 'sessions.json')
+DEFAULT_MAX_AGE = 86400
+
+COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified', 'domain', 'domain_specified',
+                 'domain_initial_dot', 'path', 'path_specified', 'secure', 'expires', 'discard',
+                 'comment', 'comment_url', 'rfc2109')
+
+
+def cookie_to_dict(cookie):
+    """Returns a JSON serializable dict of a cookielib.Cookie"""
+    values = dict((field, getattr(cookie, field)) for field in COOKIE_FIELDS)
+    values['rest'] = cookie._rest
+    return values
+
+
+def cookie_from_dict(values):
+    """Returns the cookielib.Cookie of a dict from cookie_to_dict"""
+    values = dict(values)
+    values['rest'] = values.get('rest') or {}
+    return cookielib.Cookie(**values)
+
+
+class SessionStore(object):
+    """SessionStore keeps authenticated session cookies in a JSON file.
+
+    Sessions are keyed by server url and username and are dropped max_age
+    seconds after they were saved, or earlier if all their cookies have
+    expired. The file and its directory are only readable by the owner, as
+    the cookies give access to the account.
+
+    """
+    def __init__(self, path=DEFAULT_SESSION_PATH, max_age=DEFAULT_MAX_AGE):
+        """Initializer for SessionStore
+
+        :param path: path of the JSON file
+        :param max_age: seconds a saved session is used
+
+        """
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    def load(self, server_url, username):
+        """Returns the saved cookies of a session as cookielib.Cookies, None if
+        there is no valid session"""
+        entry = self._load().get(self._key(server_url, username))
+        if not isinstance(entry, dict) or entry.get('saved', 0) + self.max_age <= time.time():
+            return None
+        try:
+            cookies = [cookie_from_dict(values) for values in entry.get('cookies', [])]
+        except TypeError:
+            return None
+        cookies = [cookie for cookie in cookies if not cookie.is_expired()]
+        return cookies or None
+
+    def save(self, server_url, username, cookies):
+        """Saves the cookies of an authenticated session"""
+        self._update(self._key(server_url, username),
+                     {'saved': time.time(), 'cookies': [cookie_to_dict(cookie) for cookie in cookies]})
+
+    def remove(self, server_url, username):
+        """Drops the saved session"""
+        self._update(self._key(server_url, username), None)
+
+    def _key(self, server_url, username):
+        return json.dumps([server_url, username])
+
+    def _update(self, key, entry):
+        with self._lock:
+            sessions = self._load()
+            now = time.time()
+            for old_key in sessions.keys():
+                old = sessions[old_key]
+                if not isinstance(old, dict) or old.get('saved', 0) + self.max_age <= now:
+                    del sessions[old_key]
+            if entry is None:
+                if key not in sessions:
+                    return
+                del sessions[key]
+            else:
+                sessions[key] = entry
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as session_file:
+                json.dump(sessions, session_file)
+            os.chmod(temp_path, 0600)
+            os.rename(temp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as session_file:
+                sessions = json.load(session_file)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(sessions, dict):
+            return {}
+        return sessions
@@ -2,14 +2,51 @@ import unittest
 import mock
 import StringIO
 import hashlib
+import httplib
+import threading
+import tempfile
+import shutil
+import os
+import socket
+import time
+import urllib2
+import BaseHTTPServer
+import SocketServer
 
 import holvi.client as client
-from holvi.exceptions import HolviCryptException, HolviAPIException, HolviDataItemException, HolviAuthException
+from holvi.exceptions import HolviCryptException, HolviAPIException, HolviDataItemException, HolviAuthException, \
+    HolviClusterException
 from holvi.container import Cluster, Vault
 from holvi.dataitem import DataItem
-from holvi.filecrypt import FileIterator, CryptIterator, FileCrypt
-from holvi.connection import Connection
-
+from holvi.filecrypt import FileIterator, CryptIterator, FileCrypt, ChunkHasher, chunked_plaintext_length, \
+    mmap_source
+from holvi.connection import Connection, ConnectionPool
+from holvi.pipeline import Pipeline
+from holvi import utils
+from holvi.tuning import ChunkSizeTuner, TuningStore
+from holvi.journal import UploadJournal, source_identity
+from holvi.cache import MetadataCache
+from holvi.session import SessionStore
+from holvi.asyncclient import AsyncClient
+from holvi.server import LocalServer, ServerProcess
+from holvi import benchmark, microbenchmark
+
+
+def make_response(headers, body='', status=200):
+    """Returns a mock pooled response with given headers and body"""
+    lines = ''.join('{0}: {1}\r\n'.format(key, value) for key, value in headers.items())
+    message = httplib.HTTPMessage(StringIO.StringIO(lines + '\r\n'))
+    response = mock.Mock(status=status, reason='OK', headers=message)
+    response.info.return_value = message
+    stream = StringIO.StringIO(body)
+    response.read.side_effect = stream.read
+
+    def readinto(buf):
+        data = stream.read(len(buf))
+        memoryview(buf)[:len(data)] = data
+        return len(data)
+    response.readinto.side_effect = readinto
+    return response
 
 class TestClientFunctions(unittest.TestCase):
     def setUp(self):
@@ -166,6 +203,33 @@ class TestClientFunctions(unittest.TestCase):
         result = self.client.store_data("1", "key", "test_data")
 
 
+    def test_store_data_pipelined(self):
+        content = "Some test data to be sent to server" * 10
+        sent = []
+        conn = mock.Mock()
+
+        def store(headers, url_suffix, data):
+            sent.append(data)
+            return make_response({'X-HOLVI-RESULT': 'OK'})
+
+        conn.make_transaction.side_effect = store
+        self.client.connection = conn
+        self.client.set_request_size(16)
+
+        result = self.client.store_data("1", "key", StringIO.StringIO(content), pipelined=True)
+        self.assertEquals(result, "OK")
+        self.assertEquals(''.join(sent), content)
+        self.assertEquals(self.client.pipeline_stats['read']['bytes'], len(content))
+        self.assertEquals(self.client.pipeline_stats['send']['items'], len(sent))
+
+        del sent[:]
+        self.client.set_encryption_key('12345678901234561234567890123456')
+        self.client.encryption_mode = 'ENC:AES256'
+        self.client.store_data("1", "key", StringIO.StringIO(content), pipelined=True)
+        self.assertEquals(''.join(sent), ''.join(self.client.crypt.encrypt(StringIO.StringIO(content))))
+        self.assertEquals(self.client.pipeline_stats['encrypt']['items'], len(sent))
+        self.assertEquals(self.client.pipeline_stats['hash']['bytes'], len(content))
+
     def test_change_encryption_mode(self):
         client = self.client
 
@@ -257,6 +321,50 @@ class TestClientFunctions(unittest.TestCase):
         conn.make_query.assert_called_once_with(headers)
 
 
+    def test_metadata_cache(self):
+        conn = mock.Mock(_server_url='https://server/', _is_authed=True)
+        conn.make_query.return_value = {'Content-Length': '10', 'X-HOLVI-HASH': 'hash'}
+        self.client.connection = conn
+        self.client.set_metadata_cache(ttl=60, max_entries=2)
+        self.assertEquals(self.client.get_dataitem("1", "key").length, '10')
+        self.assertEquals(self.client.get_dataitem("1", "key").checksum, 'hash')
+        self.assertEquals(DataItem(self.client, "1", "key").length, '10')
+        self.assertEquals(conn.make_query.call_count, 1)
+        self.assertEquals(self.client.metadata_cache.stats['hits'], 2)
+
+        self.client.store_data("1", "key", StringIO.StringIO("data"), method="replace")
+        self.client.get_dataitem("1", "key")
+        self.assertEquals(conn.make_query.call_count, 2)
+        self.client.remove_dataitem("1", "key")
+        self.client.get_dataitem("1", "key")
+        self.assertEquals(conn.make_query.call_count, 3)
+
+        self.client.set_metadata_cache(None)
+        self.client.get_dataitem("1", "key")
+        self.assertEquals(conn.make_query.call_count, 4)
+        self.assertRaises(HolviAPIException, self.client.set_metadata_cache, 0)
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_ttl_and_eviction(self):
+        metadata_cache = MetadataCache(ttl=10, max_entries=2)
+        with mock.patch('time.time', return_value=100.0):
+            metadata_cache.put('a', 1)
+            metadata_cache.put('b', 2)
+            self.assertEquals(metadata_cache.get('a'), 1)
+            metadata_cache.put('c', 3)
+            self.assertEquals(metadata_cache.get('b'), None)
+            self.assertEquals(metadata_cache.get('c'), 3)
+        with mock.patch('time.time', return_value=110.0):
+            self.assertEquals(metadata_cache.get('a'), None)
+        self.assertEquals(metadata_cache.stats, {'hits': 2, 'misses': 2, 'evictions': 1})
+        metadata_cache.put('d', 4)
+        metadata_cache.invalidate('d')
+        self.assertEquals(metadata_cache.get('d'), None)
+        metadata_cache.clear()
+        self.assertEquals(len(metadata_cache), 0)
+
 class TestCluster(unittest.TestCase):
     def setUp(self):
         self.client = client.Client('username', 'password')
@@ -489,12 +597,14 @@ class TestDataItem(unittest.TestCase):
         test_data.seek(0)
 
         conn = mock.Mock()
-        conn.make_transaction.return_value = "OK"
+        conn.make_transaction.return_value = make_response({'X-HOLVI-RESULT': 'OK'})
         self.client.connection = conn
 
         dataitem = DataItem(self.client, self.parent_id, self.keyname)
-        response = dataitem.store_data(test_data, "new", offset=None)
+        with mock.patch('holvi.pipeline.Pipeline.__init__', side_effect=AssertionError) as pipeline_init:
+            response = dataitem.store_data(test_data, "new", offset=None)
         self.assertEquals(response, "OK")
+        self.assertFalse(pipeline_init.called)
         conn.make_transaction.assert_called_with(headers, '/store', 'Some test data to be sent to server')
 
         conn.reset_mock()
@@ -523,7 +633,7 @@ class TestDataItem(unittest.TestCase):
         headers['X-HOLVI-STORE-MODE'] = "append"
         response = dataitem.store_data(file_iter, "new", offset=None)
         self.assertEquals(response, "OK")
-        self.assertEquals(conn.make_transaction.mock_calls[8], mock.call(headers, '/store', 'ver'))
+        self.assertEquals(conn.make_transaction.call_args_list[8], mock.call(headers, '/store', 'ver'))
 
     def test_store_with_patch(self):
         test_data = StringIO.StringIO("Some test data to be sent to server")
@@ -542,7 +652,7 @@ class TestDataItem(unittest.TestCase):
         test_data.seek(0)
 
         conn = mock.Mock()
-        conn.make_transaction.return_value = "OK"
+        conn.make_transaction.return_value = make_response({'X-HOLVI-RESULT': 'OK'})
         self.client.connection = conn
 
         dataitem = DataItem(self.client, self.parent_id, self.keyname)
@@ -560,7 +670,376 @@ class TestDataItem(unittest.TestCase):
         file_iter = FileIterator(test_data, 4)
         response = dataitem.store_data(file_iter, "patch", offset=13)
         self.assertEquals(response, "OK")
-        self.assertEquals(conn.make_transaction.mock_calls[8], mock.call(headers, '/store', 'ver'))
+        self.assertEquals(conn.make_transaction.call_args_list[8], mock.call(headers, '/store', 'ver'))
+
+    def test_store_parallel(self):
+        content = "Some test data to be sent to server"
+        md5 = hashlib.md5()
+        md5.update(content)
+        stored = {}
+
+        def store(headers, url_suffix, data):
+            stored[headers['X-HOLVI-OFFSET'] if 'X-HOLVI-OFFSET' in headers else 0] = (headers['X-HOLVI-STORE-MODE'], data)
+            return make_response({'X-HOLVI-RESULT': 'OK'})
+
+        conn = mock.Mock()
+        conn.make_transaction.side_effect = store
+        conn.make_query.return_value = {'Content-Length': str(len(content)), 'X-HOLVI-HASH': md5.hexdigest()}
+        self.client.connection = conn
+
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        response = dataitem.store_data(FileIterator(StringIO.StringIO(content), 4), "new", offset=None, workers=3)
+        self.assertEquals(response, "OK")
+        self.assertEquals(stored[0], ('new', 'Some'))
+        self.assertEquals(sorted(stored), range(0, len(content), 4))
+        for offset in sorted(stored)[1:]:
+            self.assertEquals(stored[offset], ('patch', content[offset:offset + 4]))
+
+        conn.make_query.return_value = {'Content-Length': str(len(content)), 'X-HOLVI-HASH': 'invalid'}
+        with self.assertRaises(HolviDataItemException) as cm:
+            dataitem.store_data(FileIterator(StringIO.StringIO(content), 4), "replace", offset=None, workers=3)
+        self.assertEquals(cm.exception.id, 702)
+
+        stored.clear()
+        conn.make_query.return_value = {'Content-Length': str(len(content)), 'X-HOLVI-HASH': md5.hexdigest()}
+        response = dataitem.store_data(FileIterator(StringIO.StringIO(content), 64), "replace", offset=None, workers=3)
+        self.assertEquals(response, "OK")
+        self.assertEquals(stored, {0: ('replace', content)})
+
+    def test_store_parallel_error_order(self):
+        def store(headers, url_suffix, data):
+            offset = headers.get('X-HOLVI-OFFSET', 0)
+            if offset >= 8:
+                raise HolviDataItemException(offset, "Failed")
+            return make_response({'X-HOLVI-RESULT': 'OK'})
+
+        conn = mock.Mock()
+        conn.make_transaction.side_effect = store
+        self.client.connection = conn
+
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        with self.assertRaises(HolviDataItemException) as cm:
+            dataitem.store_data(FileIterator(StringIO.StringIO("x" * 64), 4), "new", offset=None, workers=4)
+        self.assertEquals(cm.exception.id, 8)
+
+    def _ranged_connection(self, content):
+        md5 = hashlib.md5()
+        md5.update(content)
+
+        def fetch(headers, url_suffix):
+            if 'Range' not in headers:
+                return make_response({'X-HOLVI-RESULT': 'OK'}, content)
+            start, end = [int(x) for x in headers['Range'][len('bytes='):].split('-')]
+            response = make_response({'X-HOLVI-RESULT': 'OK'}, content[start:end + 1], status=206)
+            return response
+
+        conn = mock.Mock()
+        conn.make_query.return_value = {'Content-Length': str(len(content)), 'X-HOLVI-HASH': md5.hexdigest()}
+        conn.make_transaction.side_effect = fetch
+        return conn
+
+    def test_fetch_parallel(self):
+        content = "Some test data to be fetched from server"
+        self.client.connection = self._ranged_connection(content)
+        self.client.set_request_size(3)
+
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        response = dataitem.fetch_parallel(workers=4)
+        self.assertEquals(''.join(response['data']), content)
+        self.assertEquals(response['data']._md5.hexdigest(), response['checksum'])
+
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256"
+        encrypted = ''.join(self.client.crypt.encrypt(StringIO.StringIO(content)))
+        self.client.connection = self._ranged_connection(encrypted)
+        response = dataitem.fetch_parallel(workers=4)
+        self.assertEquals(''.join(response['data']), content)
+        self.assertEquals(response['data']._md5.hexdigest(), response['checksum'])
+
+    def test_fetch_parallel_to_file(self):
+        content = "Some test data to be fetched from server"
+        self.client.connection = self._ranged_connection(content)
+        self.client.set_request_size(5)
+        path = tempfile.mktemp()
+        try:
+            dataitem = DataItem(self.client, self.parent_id, self.keyname)
+            dataitem.fetch_parallel_to_file(path, workers=3)
+            self.assertEquals(open(path, 'rb').read(), content)
+
+            self.client.connection.make_query.return_value['X-HOLVI-HASH'] = 'invalid'
+            with self.assertRaises(HolviDataItemException):
+                dataitem.fetch_parallel_to_file(path, workers=3)
+        finally:
+            os.remove(path)
+
+    def test_fetch_to_path(self):
+        content = "Some test data to be fetched from server"
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.set_request_size(5)
+        encrypted = self.client.crypt.encryptor()(content)
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        path = tempfile.mktemp()
+        try:
+            for workers in (None, 3):
+                self.client.encryption_mode = "ENC:NONE"
+                self.client.connection = self._ranged_connection(content)
+                dataitem.fetch_to_path(path, workers=workers)
+                self.assertEquals(open(path, 'rb').read(), content)
+
+                self.client.encryption_mode = "ENC:AES256"
+                self.client.connection = self._ranged_connection(encrypted)
+                dataitem.fetch_to_path(path, workers=workers)
+                self.assertEquals(open(path, 'rb').read(), content)
+
+            self.client.set_crypt_workers(2)
+            self.client.connection = self._ranged_connection(encrypted)
+            with mock.patch.object(self.client.crypt, 'parallel_decryptor',
+                                   wraps=self.client.crypt.parallel_decryptor) as parallel_decryptor:
+                dataitem.fetch_to_path(path)
+            self.assertTrue(parallel_decryptor.called)
+            self.assertEquals(open(path, 'rb').read(), content)
+
+            self.client.connection.make_query.return_value['X-HOLVI-HASH'] = 'invalid'
+            with self.assertRaises(HolviDataItemException):
+                dataitem.fetch_to_path(path, workers=3)
+        finally:
+            os.remove(path)
+
+    def test_preallocate(self):
+        fd = os.open(os.devnull, os.O_WRONLY)
+        try:
+            utils.preallocate(fd, 1000)
+        finally:
+            os.close(fd)
+        with tempfile.NamedTemporaryFile() as target:
+            utils.preallocate(target.fileno(), 1000)
+            self.assertEquals(os.fstat(target.fileno()).st_size, 1000)
+
+    def test_read_range(self):
+        content = "Some test data to be fetched from server" * 10
+        self.client.connection = self._ranged_connection(content)
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        self.assertEquals(dataitem.read_range(5, 13), content[5:14])
+        self.assertEquals(dataitem.read_range(390, 500), content[390:])
+
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256-CHUNKED"
+        encryptor = self.client.crypt.chunked_encryptor(segment_size=32)
+        encrypted = ''.join(CryptIterator(StringIO.StringIO(content), encryptor, 50))
+        self.client.connection = self._ranged_connection(encrypted)
+        for start, end in [(0, 0), (30, 70), (64, 95), (100, 399), (390, 500), (5, 13)]:
+            self.assertEquals(dataitem.read_range(start, end), content[start:end + 1])
+        self.assertEquals(self.client.connection.make_transaction.call_args[0][0]['Range'], 'bytes=16-63')
+
+        self.client.encryption_mode = "ENC:AES256"
+        encrypted = ''.join(self.client.crypt.encrypt(StringIO.StringIO(content)))
+        self.client.connection = self._ranged_connection(encrypted)
+        for start, end in [(0, 0), (5, 13), (16, 40), (100, 399), (390, 500)]:
+            self.assertEquals(dataitem.read_range(start, end), content[start:end + 1])
+
+    def test_open_read(self):
+        content = "Some test data to be fetched from server" * 10
+        self.client.connection = self._ranged_connection(content)
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        with dataitem.open(block_size=32, readahead=2, cache_blocks=4) as reader:
+            self.assertTrue(reader.seekable())
+            self.assertEquals(reader.read(10), content[:10])
+            self.assertEquals(reader.stats['requests'], 1)
+            self.assertEquals(self.client.connection.make_transaction.call_args[0][0]['Range'], 'bytes=0-95')
+            self.assertEquals(reader.read(80), content[10:90])
+            self.assertEquals(reader.stats['requests'], 1)
+            self.assertEquals(reader.tell(), 90)
+            self.assertEquals(reader.seek(-5, os.SEEK_END), 395)
+            self.assertEquals(reader.read(), content[395:])
+            self.assertEquals(reader.read(), '')
+            buf = bytearray(20)
+            reader.seek(100)
+            self.assertEquals(reader.readinto(buf), 20)
+            self.assertEquals(str(buf), content[100:120])
+            reader.seek(0)
+            self.assertEquals(reader.read(), content)
+        with self.assertRaises(ValueError):
+            reader.read()
+        with self.assertRaises(ValueError):
+            dataitem.open('r+b')
+
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256-CHUNKED"
+        encryptor = self.client.crypt.chunked_encryptor(segment_size=48)
+        encrypted = ''.join(CryptIterator(StringIO.StringIO(content), encryptor, 50))
+        self.client.connection = self._ranged_connection(encrypted)
+        reader = dataitem.open(block_size=64, readahead=0)
+        self.assertEquals(reader.length, len(content))
+        reader.seek(150)
+        self.assertEquals(reader.read(100), content[150:250])
+        self.assertEquals(reader.read(), content[250:])
+        reader.seek(140)
+        self.assertEquals(reader.read(30), content[140:170])
+        self.assertTrue(reader.stats['hits'] > 0)
+
+        self.client.encryption_mode = "ENC:AES256"
+        encrypted = ''.join(self.client.crypt.encrypt(StringIO.StringIO(content)))
+        self.client.connection = self._ranged_connection(encrypted)
+        reader = dataitem.open(block_size=50)
+        reader.seek(33)
+        self.assertEquals(reader.read(200), content[33:233])
+
+    def test_store_chunked(self):
+        content = "Some test data to be sent to server" * 10
+        sent = []
+        conn = mock.Mock()
+
+        def store(headers, url_suffix, data):
+            sent.append((headers['X-HOLVI-META'], data))
+            return make_response({'X-HOLVI-RESULT': 'OK'})
+
+        conn.make_transaction.side_effect = store
+        self.client.connection = conn
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256-CHUNKED"
+        self.client.set_request_size(100)
+        self.client.set_crypt_workers(2)
+
+        self.client.store_data(self.parent_id, self.keyname, StringIO.StringIO(content))
+        self.assertEquals(set(meta for meta, data in sent), set(['v1:ENC:AES256-CHUNKED::']))
+        encrypted = ''.join(data for meta, data in sent)
+        decrypted = CryptIterator(StringIO.StringIO(encrypted), self.client.crypt.chunked_decryptor(), 64)
+        self.assertEquals(''.join(decrypted), content)
+
+        del sent[:]
+        for method, offset in (('append', None), ('patch', 10)):
+            with self.assertRaises(HolviCryptException) as cm:
+                self.client.store_data(self.parent_id, self.keyname, StringIO.StringIO(content), method, offset)
+            self.assertEquals(cm.exception.id, 905)
+        self.assertEquals(sent, [])
+
+        conn.make_transaction.side_effect = IOError("connection lost")
+        self.client.set_crypt_workers(2, processes=True)
+        self.client.set_request_size(262144)
+        with mock.patch('multiprocessing.Pool') as MockPool:
+            MockPool.return_value.map.side_effect = map
+            with self.assertRaises(IOError):
+                self.client.store_data(self.parent_id, self.keyname, StringIO.StringIO(content * 10000))
+        MockPool.return_value.terminate.assert_called_once_with()
+
+    def _resumable_upload(self, content, stored_after_failure):
+        """Fails an upload at the third chunk and resumes it.
+
+        stored_after_failure tells whether the server kept the failed chunk.
+        Returns the store modes of the resumed chunks and the stored data.
+
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'source')
+            with open(path, 'wb') as source:
+                source.write(content)
+            self.client.journal_dir = os.path.join(directory, 'journal')
+            self.client.set_request_size(10)
+            stored = []
+            modes = []
+
+            def transaction(headers, url_suffix, data):
+                if len(stored) == 2 and not modes:
+                    modes.append(None)
+                    if stored_after_failure:
+                        stored.append(data)
+                    raise IOError("connection lost")
+                if modes:
+                    modes.append(headers['X-HOLVI-STORE-MODE'])
+                stored.append(data)
+                return make_response({'X-HOLVI-RESULT': 'OK'})
+            conn = mock.Mock(_server_url='https://server/')
+            conn.make_transaction.side_effect = transaction
+            conn.make_query.side_effect = lambda headers: {
+                'Content-Length': str(len(''.join(stored))),
+                'X-HOLVI-HASH': hashlib.md5(''.join(stored)).hexdigest()}
+            self.client.connection = conn
+
+            with open(path, 'rb') as source:
+                self.assertRaises(IOError, self.client.store_data, self.parent_id, self.keyname,
+                                  source, resume=True)
+            self.assertEquals(len(os.listdir(self.client.journal_dir)), 1)
+            with open(path, 'rb') as source:
+                self.client.store_data(self.parent_id, self.keyname, source, resume=True)
+            self.assertEquals(os.listdir(self.client.journal_dir), [])
+            return modes[1:], ''.join(stored)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_store_resume(self):
+        content = "Some test data to be sent to server" * 2
+        modes, stored = self._resumable_upload(content, False)
+        self.assertEquals(stored, content)
+        self.assertEquals(modes, ['append'] * 5)
+
+        modes, stored = self._resumable_upload(content, True)
+        self.assertEquals(stored, content)
+        self.assertEquals(modes, ['append'] * 4)
+
+    def test_fetch_resumable(self):
+        content = "Some test data to be sent to server" * 4
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256"
+        self.client.set_request_size(40)
+        encrypted = self.client.crypt.encryptor()(content)
+        ranges = []
+
+        def transaction(headers, url_suffix):
+            start = int(headers.get('Range', 'bytes=0-')[6:-1])
+            ranges.append(start)
+            response = make_response({'X-HOLVI-HASH': hashlib.md5(encrypted).hexdigest()},
+                                     status=206 if start else 200)
+            if len(ranges) == 1:
+                response.read.side_effect = [encrypted[:40], encrypted[40:80], IOError("connection lost")]
+            else:
+                response.read.side_effect = StringIO.StringIO(encrypted[start:]).read
+            return response
+        conn = mock.Mock()
+        conn.make_transaction.side_effect = transaction
+        conn.make_query.return_value = {'Content-Length': str(len(encrypted)),
+                                        'X-HOLVI-HASH': hashlib.md5(encrypted).hexdigest()}
+        self.client.connection = conn
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'target')
+            dataitem = DataItem(self.client, self.parent_id, self.keyname)
+            self.assertRaises(IOError, dataitem.fetch_resumable, path)
+            self.assertTrue(os.path.exists(path + '.holvi-fetch'))
+
+            result = dataitem.fetch_resumable(path)
+            self.assertEquals(ranges, [0, 80])
+            self.assertEquals(result['resumed_from'], 80)
+            with open(path, 'rb') as target:
+                self.assertEquals(target.read(), content)
+            self.assertFalse(os.path.exists(path + '.holvi-fetch'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fetch_to_file(self):
+        content = "Some test data to be fetched from server" * 10
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256"
+        self.client.set_request_size(16)
+        encrypted = ''.join(self.client.crypt.encrypt(StringIO.StringIO(content)))
+        md5 = hashlib.md5()
+        md5.update(encrypted)
+
+        conn = mock.Mock()
+        conn.make_transaction.side_effect = lambda headers, url_suffix: make_response({'X-HOLVI-HASH': md5.hexdigest()}, encrypted)
+        self.client.connection = conn
+
+        output = StringIO.StringIO()
+        dataitem = DataItem(self.client, self.parent_id, self.keyname)
+        stats = dataitem.fetch_to_file(output)
+        self.assertEquals(output.getvalue(), content)
+        self.assertEquals(stats['receive']['bytes'], len(encrypted))
+        self.assertEquals(stats['decrypt']['items'], stats['write']['items'])
+
+        conn.make_transaction.side_effect = lambda headers, url_suffix: make_response({'X-HOLVI-HASH': 'invalid'}, encrypted)
+        with self.assertRaises(HolviDataItemException):
+            dataitem.fetch_to_file(StringIO.StringIO())
 
     def test_dataitem_length(self):
         conn = mock.Mock()
@@ -664,7 +1143,7 @@ class TestConnection(unittest.TestCase):
         self.password = "password"
         self.auth_method = "password"
         self.apikey = "apikey"
-        self.server = "server"
+        self.server = "http://server"
 
     def test_connection_init(self):
         connection = Connection(self.server)
@@ -699,12 +1178,10 @@ class TestConnection(unittest.TestCase):
         connection.make_request.assert_called_once_with("auth", params)
         self.assertFalse(connection._is_authed)
 
-    @mock.patch('urllib2.build_opener')
+    @mock.patch('holvi.connection.ConnectionPool.urlopen')
     @mock.patch('json.JSONDecoder')
-    def test_connection_make_request(self, MockJSONDecoder, MockUrllib):
-        mock_instance1 = mock.Mock()
-        mock_instance1.open.return_value = StringIO.StringIO("Test response")
-        MockUrllib.return_value = mock_instance1
+    def test_connection_make_request(self, MockJSONDecoder, MockUrlopen):
+        MockUrlopen.return_value = make_response({}, "Test response")
 
         mock_instance2 = mock.Mock()
         mock_instance2.decode.return_value = {'result': 'success'}
@@ -713,44 +1190,670 @@ class TestConnection(unittest.TestCase):
         connection = Connection(self.server)
         response = connection.make_request('method', 'params')
         self.assertEquals({'result': 'success'}, response)
-        mock_instance1.open.assert_called_once_with(self.server + '/api/1.0/json', '{"params": "params", "method": "method"}')
+        method, path, body, headers = MockUrlopen.call_args[0]
+        self.assertEquals((method, path, body), ('POST', '/api/1.0/json', '{"params": "params", "method": "method"}'))
         mock_instance2.decode.assert_called_once_with("Test response")
 
-    @mock.patch('urllib2.urlopen')
-    def test_connection_make_transaction(self, MockUrllib):
-        mock_instance1 = mock.Mock()
-        mock_instance1.headers = {'X-HOLVI-RESULT': 'OK'}
-        MockUrllib.return_value = mock_instance1
+    @mock.patch('holvi.connection.ConnectionPool.urlopen')
+    def test_connection_make_transaction(self, MockUrlopen):
+        MockUrlopen.return_value = make_response({'X-HOLVI-RESULT': 'OK'})
         headers = {}
         headers['Test-header'] = 'value'
 
         connection = Connection(self.server)
         response = connection.make_transaction(headers, '/fetch')
-        self.assertEquals(MockUrllib.call_args[0][0].headers, headers)
+        self.assertEquals(MockUrlopen.call_args[0][0], 'GET')
+        self.assertEquals(MockUrlopen.call_args[0][1], '/api/1.0/fetch')
+        self.assertEquals(MockUrlopen.call_args[0][3], headers)
         self.assertEquals(response.headers['X-HOLVI-RESULT'], 'OK')
 
-        mock_instance1.headers = {'X-HOLVI-RESULT': 'ERROR: 404 Not found'}
+        connection.make_transaction(headers, '/store', 'chunk')
+        self.assertEquals(MockUrlopen.call_args[0][:3], ('POST', '/api/1.0/store', 'chunk'))
+
+        MockUrlopen.return_value = make_response({'X-HOLVI-RESULT': 'ERROR: 404 Not found'})
         with self.assertRaises(HolviDataItemException):
             response = connection.make_transaction(headers, '/fetch')
 
-    @mock.patch('urllib2.urlopen')
-    def test_connection_make_query(self, MockUrllib):
-        mock_instance1 = mock.Mock()
-        mock_instance1.headers = {'X-HOLVI-RESULT': 'OK'}
-        MockUrllib.return_value = mock_instance1
+    @mock.patch('holvi.connection.ConnectionPool.urlopen')
+    def test_connection_make_query(self, MockUrlopen):
+        MockUrlopen.return_value = make_response({'X-HOLVI-RESULT': 'OK'})
         headers = {}
         headers['Test-header'] = 'value'
 
         connection = Connection(self.server)
         response = connection.make_query(headers)
-        self.assertEquals(MockUrllib.call_args[0][0].headers, headers)
+        self.assertEquals(MockUrlopen.call_args[0][0], 'HEAD')
+        self.assertEquals(MockUrlopen.call_args[0][3], headers)
         self.assertEquals(response['X-HOLVI-RESULT'], 'OK')
 
-        mock_instance1.headers = {'X-HOLVI-RESULT': 'ERROR: 404 Not found'}
+        MockUrlopen.return_value = make_response({'X-HOLVI-RESULT': 'ERROR: 404 Not found'})
         with self.assertRaises(HolviDataItemException):
             response = connection.make_query(headers)
 
-        mock_instance1.headers = {'X-HOLVI-RESULT': 'ERROR: 404 Not found'}
+    @mock.patch('holvi.connection.ConnectionPool.urlopen')
+    def test_connection_http_error(self, MockUrlopen):
+        MockUrlopen.return_value = make_response({}, status=500)
+
+        connection = Connection(self.server)
+        with self.assertRaises(urllib2.HTTPError):
+            connection.make_transaction({}, '/fetch')
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'x' * 100
+        self.send_response(200)
+        self.send_header('X-HOLVI-RESULT', 'OK')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('X-HOLVI-RESULT', 'OK')
+        self.send_header('Content-Length', '100')
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class ShortTimeoutHandler(KeepAliveHandler):
+    timeout = 0.2
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        connection = Connection(self.url)
+        for i in range(3):
+            response = connection.make_transaction({}, '/fetch')
+            self.assertEquals(response.read(), 'x' * 100)
+            connection.make_query({})
+        self.assertEquals(connection.pool_stats['created'], 1)
+        self.assertEquals(connection.pool_stats['reused'], 5)
+        connection.close()
+
+    def test_readinto(self):
+        connection = Connection(self.url)
+        for i in range(2):
+            response = connection.make_transaction({}, '/fetch')
+            receive = bytearray(64)
+            self.assertEquals(response.readinto(receive), 64)
+            self.assertEquals(response.readinto(memoryview(receive)[:50]), 36)
+            self.assertEquals(response.readinto(receive), 0)
+            self.assertEquals(str(receive[:36]), 'x' * 36)
+        self.assertEquals(connection.pool_stats['created'], 1)
+        connection.close()
+
+    def test_unread_response_is_discarded(self):
+        connection = Connection(self.url)
+        response = connection.make_transaction({}, '/fetch')
+        response.read(10)
+        response.close()
+        response = connection.make_transaction({}, '/fetch')
+        self.assertEquals(response.read(), 'x' * 100)
+        self.assertEquals(connection.pool_stats['created'], 2)
+        self.assertEquals(connection.pool_stats['discarded'], 1)
+
+    def test_server_closed_idle_connection(self):
+        self.server.RequestHandlerClass = ShortTimeoutHandler
+        connection = Connection(self.url)
+        self.assertEquals(connection.make_transaction({}, '/fetch').read(), 'x' * 100)
+        time.sleep(0.5)
+        self.assertEquals(connection.make_transaction({}, '/store', 'data').read(), 'x' * 100)
+        self.assertEquals(connection.pool_stats['created'], 2)
+        self.assertEquals(connection.pool_stats['discarded'], 1)
+        connection.close()
+
+    def test_retry_on_reused_connection(self):
+        pool = ConnectionPool('http', self.url[len('http://'):])
+        unanswered = httplib.BadStatusLine("''")
+
+        def urlopen(method, body, error, sent=True):
+            conn = mock.MagicMock()
+            conn.getresponse.side_effect = error if sent else None
+            pool._idle.append(conn)
+            fresh = mock.MagicMock()
+            with mock.patch.object(pool, '_is_dropped', return_value=False), \
+                    mock.patch.object(pool, '_new_conn', return_value=fresh), \
+                    mock.patch.object(pool, '_request', side_effect=[None] * 2 if sent else [error, None]):
+                try:
+                    pool.urlopen(method, '/store', body)
+                except (socket.error, httplib.HTTPException):
+                    pass
+            return fresh.getresponse.called
+
+        self.assertTrue(urlopen('GET', None, socket.error))
+        self.assertTrue(urlopen('POST', 'data', unanswered))
+        self.assertTrue(urlopen('POST', 'data', socket.error, sent=False))
+        self.assertFalse(urlopen('POST', 'data', socket.error))
+        self.assertFalse(urlopen('POST', 'data', httplib.BadStatusLine('HTTP/1.1 99')))
+        self.assertFalse(urlopen('POST', StringIO.StringIO('data'), unanswered))
+
+
+class TestTuning(unittest.TestCase):
+
+    def test_chunk_size_tuner(self):
+        tuner = ChunkSizeTuner(2097152, 262144, 16777216)
+        iterator = FileIterator(StringIO.StringIO(), 1)
+        tuner.attach(iterator)
+        self.assertEquals(iterator.chunksize, 2097152)
+
+        self.assertEquals(tuner.record(2097152, 0.01), 4194304)
+        self.assertEquals(iterator.chunksize, 4194304)
+        for i in range(10):
+            tuner.record(tuner.size, 0.01)
+        self.assertEquals(tuner.size, 16777216)
+
+        self.assertEquals(tuner.record(tuner.size, 0, failed=True), 8388608)
+        for i in range(20):
+            tuner.record(tuner.size, 30.0)
+        self.assertEquals(tuner.size, 262144)
+
+        tuner.detach(iterator)
+        tuner.record(262144, 0.001)
+        self.assertEquals(iterator.chunksize, 262144)
+        self.assertEquals(tuner.size % 65536, 0)
+
+    def test_tuning_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'state', 'sizes.json')
+            store = TuningStore(path)
+            self.assertEquals(store.get('https://server/'), None)
+            store.put('https://server/', 4194304)
+            store.put('https://other/', 262144)
+            self.assertEquals(TuningStore(path).get('https://server/'), 4194304)
+            self.assertEquals(TuningStore(path).get('https://other/'), 262144)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_client_auto_request_size(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'sizes.json')
+            test_client = client.Client('username', 'password', server_url='https://server/')
+            test_client.connection = mock.Mock(_server_url='https://server/')
+            test_client.set_request_size(65536)
+            test_client.set_auto_request_size(minimum=65536, maximum=1048576, state_path=path)
+
+            sizes = []
+            def store(headers, url_suffix, data):
+                sizes.append(len(data))
+                return make_response({'X-HOLVI-RESULT': 'OK'})
+
+            test_client.connection.make_transaction.side_effect = store
+            with mock.patch.object(TuningStore, 'put', autospec=True, side_effect=TuningStore.put) as put:
+                test_client.store_data("1", "key", StringIO.StringIO("x" * 4000000))
+            self.assertEquals(put.call_count, 1)
+            self.assertEquals(sizes[0], 65536)
+            self.assertEquals(max(sizes), 1048576)
+            self.assertEquals(TuningStore(path).get('https://server/'), 1048576)
+
+            test_client = client.Client('username', 'password', server_url='https://server/')
+            test_client.set_auto_request_size(minimum=65536, maximum=1048576, state_path=path)
+            self.assertEquals(test_client._request_size, 1048576)
+            test_client.set_request_size(1024)
+            self.assertEquals(test_client._tuner, None)
+
+            test_client = client.Client('username', 'password', server_url='https://other/')
+            test_client.connection = mock.Mock(_server_url='https://other/')
+            test_client.connection.make_transaction.return_value = make_response({}, "x" * 4000000)
+            test_client.set_request_size(65536)
+            test_client.set_auto_request_size(minimum=65536, maximum=1048576, state_path=path)
+            data = test_client.fetch_data("1", "key")['data']
+            self.assertEquals(TuningStore(path).get('https://other/'), None)
+            self.assertEquals(len(''.join(data)), 4000000)
+            self.assertEquals(TuningStore(path).get('https://other/'), 1048576)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestJournal(unittest.TestCase):
+
+    def test_upload_journal(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal = UploadJournal(directory, 'https://server/', 1, 'key', 'identity')
+            self.assertFalse(journal.matches(method='new'))
+            journal.start(method='new', base=0)
+            journal.record_pending(0, 10, 'a')
+            journal.record_acknowledged(0, 10, 'a')
+            journal.record_pending(10, 5, 'b')
+
+            journal = UploadJournal(directory, 'https://server/', 1, 'key', 'identity')
+            self.assertTrue(journal.matches(method='new'))
+            self.assertFalse(journal.matches(method='append'))
+            self.assertEquals((journal.acknowledged, journal.pending), (10, 5))
+            self.assertEquals(UploadJournal(directory, 'https://server/', 1, 'key', 'other').header, None)
+
+            journal.remove()
+            self.assertEquals(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_source_identity(self):
+        self.assertEquals(source_identity(StringIO.StringIO("data")), None)
+        with tempfile.NamedTemporaryFile() as source:
+            self.assertTrue(source_identity(source).startswith(os.path.realpath(source.name)))
+
+
+class TestLocalServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer(users={'username': 'password'})
+        self.server.start()
+        self.client = client.Client('username', 'password', server_url=self.server.url)
+
+    def tearDown(self):
+        self.client.connection.close()
+        self.server.stop()
+
+    def test_containers(self):
+        vault = self.client.add_vault('private', 'vault')
+        cluster = self.client.add_cluster('cluster', vault.id)
+        self.client.add_cluster('child', cluster.id)
+        self.assertEquals([item.to_text for item in self.client.list_vaults()], ['1:vault:private:2:0'])
+        self.assertEquals([item.name for item in self.client.list_clusters(vault.id)], ['cluster'])
+        self.client.remove_cluster(cluster.id)
+        self.assertEquals(self.client.list_clusters(vault.id), [])
+        self.assertRaises(HolviAPIException, self.client.connection.make_request, 'no_such_method', {})
+
+    def test_authentication(self):
+        other = client.Client('username', 'wrong', server_url=self.server.url)
+        self.assertRaises(HolviAuthException, other.list_vaults)
+
+    def test_store_and_fetch(self):
+        vault = self.client.add_vault('private', 'vault')
+        content = os.urandom(100000)
+        self.client.set_request_size(16384)
+        self.client.store_data(vault.id, 'plain', StringIO.StringIO(content))
+        self.client.store_data(vault.id, 'parallel', StringIO.StringIO(content), workers=3)
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        self.client.encryption_mode = "ENC:AES256"
+        self.client.store_data(vault.id, 'encrypted', StringIO.StringIO(content), pipelined=True)
+
+        self.assertEquals([item.name for item in self.client.list_dataitems(vault.id)],
+                          ['encrypted', 'parallel', 'plain'])
+        response = self.client.fetch_data(vault.id, 'encrypted', workers=2)
+        self.assertEquals(''.join(response['data']), content)
+        self.client.encryption_mode = "ENC:NONE"
+        response = self.client.fetch_data(vault.id, 'parallel')
+        self.assertEquals(''.join(response['data']), content)
+        self.assertEquals(response['checksum'], hashlib.md5(content).hexdigest())
+        dataitem = self.client.get_dataitem(vault.id, 'plain')
+        self.assertEquals(int(dataitem.length), len(content))
+        self.assertEquals(dataitem.meta, 'v1:ENC:NONE::')
+        self.assertEquals(dataitem.read_range(100, 199), content[100:200])
+
+        self.assertRaises(HolviDataItemException, self.client.store_data, vault.id, 'plain',
+                          StringIO.StringIO(content))
+        self.client.remove_dataitem(vault.id, 'plain')
+        self.assertRaises(HolviDataItemException, self.client.get_dataitem, vault.id, 'plain')
+
+    def test_open_write(self):
+        vault = self.client.add_vault('private', 'vault')
+        content = os.urandom(100000)
+        self.client.set_request_size(16384)
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        for mode, background in (("ENC:NONE", False), ("ENC:AES256", True), ("ENC:AES256-CHUNKED", True)):
+            self.client.encryption_mode = mode
+            dataitem = DataItem(self.client, vault.id, mode)
+            stores = self.server.stats['requests']
+            with dataitem.open('wb', background=background) as writer:
+                for start in range(0, len(content), 1000):
+                    writer.write(content[start:start + 1000])
+                writer.flush()
+            self.assertEquals(writer.bytes_written, len(content))
+            self.assertTrue(self.server.stats['requests'] - stores <= 7)
+            self.assertEquals(''.join(self.client.fetch_data(vault.id, mode)['data']), content)
+            with dataitem.open() as reader:
+                reader.seek(50000)
+                self.assertEquals(reader.read(1000), content[50000:51000])
+
+        for mode in ("ENC:NONE", "ENC:AES256"):
+            self.client.encryption_mode = mode
+            with DataItem(self.client, vault.id, mode).open('ab') as writer:
+                writer.write(bytearray('tail'))
+            self.assertEquals(''.join(self.client.fetch_data(vault.id, mode)['data']), content + 'tail')
+        self.client.encryption_mode = "ENC:AES256-CHUNKED"
+        requests = self.server.stats['requests']
+        with self.assertRaises(HolviCryptException) as cm:
+            DataItem(self.client, vault.id, "ENC:AES256-CHUNKED").open('ab')
+        self.assertEquals(cm.exception.id, 905)
+        self.assertEquals(self.server.stats['requests'], requests)
+        self.assertEquals(''.join(self.client.fetch_data(vault.id, "ENC:AES256-CHUNKED")['data']), content)
+
+        self.client.encryption_mode = "ENC:NONE"
+        dataitem = DataItem(self.client, vault.id, 'ENC:NONE')
+        writer = dataitem.open('wb')
+        writer.write('exists')
+        self.assertRaises(HolviDataItemException, writer.close)
+        self.assertTrue(writer.closed)
+        self.assertRaises(HolviDataItemException, DataItem(self.client, vault.id, 'empty').open('wb').close)
+
+        for background in (False, True):
+            writer = DataItem(self.client, vault.id, 'ENC:NONE').open('wb', background=background)
+            if background:
+                writer.write('x' * 20000)
+                self.assertRaises(HolviDataItemException, writer.flush)
+            else:
+                self.assertRaises(HolviDataItemException, writer.write, 'x' * 20000)
+            requests = self.server.stats['requests']
+            self.assertRaises(HolviDataItemException, writer.write, 'x' * 20000)
+            self.assertRaises(HolviDataItemException, writer.close)
+            self.assertEquals(self.server.stats['requests'], requests)
+            self.assertTrue(writer.closed)
+
+    def test_listing_cache(self):
+        vault = self.client.add_vault('private', 'vault')
+        self.client.set_listing_cache(ttl=60, max_entries=10, max_items=100)
+        cluster = self.client.add_cluster('cluster', vault.id)
+        self.client.store_data(vault.id, 'item', StringIO.StringIO('x'))
+        requests = self.server.stats['requests']
+        for run in range(3):
+            self.assertEquals([item.name for item in self.client.list_clusters(vault.id)], ['cluster'])
+            self.assertEquals([item.name for item in self.client.list_dataitems(vault.id)], ['item'])
+            self.assertEquals(cluster.children, [])
+        self.assertEquals(self.server.stats['requests'] - requests, 3)
+        self.assertEquals(self.client.listing_cache.stats['hits'], 6)
+
+        self.assertEquals([item.name for item in self.client.list_clusters(str(vault.id))], ['cluster'])
+        self.assertEquals(self.client.list_clusters(vault.id)[0].descendants, 0)
+        child = self.client.add_cluster('child', cluster.id)
+        self.assertEquals(self.client.list_clusters(str(vault.id))[0].descendants, 1)
+        self.assertEquals([item.name for item in cluster.children], ['child'])
+        self.assertEquals(self.client.list_clusters(child.id), [])
+        self.client.store_data(vault.id, 'other', StringIO.StringIO('x'))
+        self.assertEquals([item.name for item in self.client.list_dataitems(vault.id)], ['item', 'other'])
+        self.client.remove_dataitem(vault.id, 'item')
+        self.assertEquals([item.name for item in self.client.list_dataitems(vault.id)], ['other'])
+        self.client.remove_cluster(cluster.id)
+        self.assertEquals(self.client.list_clusters(vault.id), [])
+        self.assertRaises(HolviClusterException, self.client.list_clusters, child.id)
+
+        self.client.set_listing_cache(ttl=60, max_entries=10, max_items=2)
+        self.client.list_dataitems(vault.id)
+        self.client.list_clusters(vault.id)
+        self.assertEquals(len(self.client.listing_cache), 1)
+        self.client.set_listing_cache(None)
+        self.assertEquals(self.client.listing_cache, None)
+
+    def test_walk(self):
+        vault = self.client.add_vault('private', 'vault')
+        first = self.client.add_cluster('a', vault.id)
+        second = self.client.add_cluster('b', vault.id)
+        child = self.client.add_cluster('a1', first.id)
+        self.client.add_cluster('deep', child.id)
+        self.client.add_cluster('b1', second.id)
+        self.client.store_data(vault.id, 'root-item', StringIO.StringIO('x'))
+        self.client.store_data(child.id, 'child-item', StringIO.StringIO('x'))
+
+        walked = dict((cluster.id, (getattr(cluster, 'name', None), [item.name for item in dataitems]))
+                      for cluster, dataitems in self.client.walk(vault.id, workers=3))
+        self.assertEquals(sorted(name for name, items in walked.values() if name), ['a', 'a1', 'b', 'b1', 'deep'])
+        self.assertEquals(walked[vault.id][1], ['root-item'])
+        self.assertEquals(walked[child.id][1], ['child-item'])
+
+        names = [getattr(cluster, 'name', None) for cluster, dataitems in
+                 self.client.walk(vault.id, order='breadth', max_depth=2)]
+        self.assertEquals(names, [None, 'a', 'b', 'a1', 'b1'])
+        names = [getattr(cluster, 'name', None) for cluster, dataitems in
+                 self.client.walk(vault.id, prune=lambda cluster: cluster.name == 'a')]
+        self.assertEquals(sorted(names[1:]), ['b', 'b1'])
+        self.assertRaises(HolviAPIException, list, self.client.walk(vault.id, order='random'))
+        self.assertRaises(HolviClusterException, list, self.client.walk(12345))
+
+    def test_batch(self):
+        vault = self.client.add_vault('private', 'vault')
+        self.client.store_data(vault.id, 'item', StringIO.StringIO('x'))
+        self.client.set_listing_cache()
+        self.assertEquals(len(self.client.list_dataitems(vault.id)), 1)
+
+        def http_requests():
+            stats = self.client.connection.pool_stats
+            return stats['created'] + stats['reused']
+        before = http_requests()
+        with self.client.batch(max_batch=2) as calls:
+            added = [calls.add_cluster('cluster-{0}'.format(index), vault.id) for index in range(3)]
+            removed = calls.remove_dataitem(vault.id, 'item')
+            missing = calls.remove_dataitem(vault.id, 'missing')
+            self.assertEquals(len(calls), 5)
+        self.assertEquals(http_requests() - before, 3)
+        self.assertEquals([future.result().name for future in added], ['cluster-0', 'cluster-1', 'cluster-2'])
+        self.assertEquals(removed.result(), None)
+        self.assertRaises(HolviDataItemException, missing.result)
+        self.assertEquals(self.client.list_dataitems(vault.id), [])
+        self.assertEquals(len(self.client.list_clusters(vault.id)), 3)
+
+        calls = self.client.batch()
+        listing = calls.list_clusters(vault.id)
+        calls.call('auth', {})
+        results = calls.execute()
+        self.assertEquals(len(results[0]), 3)
+        self.assertTrue(isinstance(results[1], HolviAPIException))
+        self.assertEquals(listing.result()[0].parent_id, vault.id)
+        self.assertEquals(calls.execute(), [])
+
+    def test_async_client(self):
+        content = os.urandom(50000)
+        self.client.set_encryption_key("12345678901234561234567890123456")
+        with AsyncClient(self.client, max_concurrency=3) as async_client:
+            async_client.auth().result()
+            vault = self.client.add_vault('private', 'vault')
+            stored = [async_client.store_data(vault.id, 'item-{0}'.format(index), StringIO.StringIO(content))
+                      for index in range(6)]
+            self.assertEquals([future.result() for future in stored], ['OK'] * 6)
+            names = async_client.list_dataitems(vault.id)
+            self.assertEquals(len(names.result()), 6)
+            self.assertEquals(async_client.list_clusters(vault.id).result(), [])
+            self.assertEquals(len(async_client.list_vaults().result()), 1)
+            self.assertEquals(int(async_client.get_dataitem(vault.id, 'item-0').result().length), len(content))
+            self.assertEquals(async_client.fetch_data(vault.id, 'item-1').result()['data'], content)
+
+            done = threading.Event()
+            missing = async_client.get_dataitem(vault.id, 'missing')
+            missing.add_done_callback(lambda future: done.set())
+            self.assertTrue(done.wait(5))
+            self.assertTrue(missing.failed())
+            self.assertRaises(HolviDataItemException, missing.result)
+
+            self.client.encryption_mode = "ENC:AES256-CHUNKED"
+            self.client.store_data(vault.id, 'chunked', StringIO.StringIO(content))
+            chunks = [future.result() for future in async_client.iter_chunks(vault.id, 'chunked', chunk_size=7000)]
+            self.assertEquals(len(chunks), 8)
+            self.assertEquals(''.join(chunks), content)
+
+    def test_shared_client(self):
+        vault = client.Client('username', 'password', server_url=self.server.url).add_vault('private', 'vault')
+        keys = ["12345678901234561234567890123456", "65432109876543216543210987654321"]
+        contents = [os.urandom(30000) for index in range(8)]
+        self.client.set_request_size(8192)
+        errors = []
+
+        def work(index):
+            try:
+                encrypted = self.client.with_encryption("ENC:AES256", keys[index % 2])
+                encrypted.store_data(vault.id, str(index), StringIO.StringIO(contents[index]))
+                self.assertEquals(''.join(encrypted.fetch_data(vault.id, str(index))['data']), contents[index])
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(self.server, 'auth', wraps=self.server.auth) as auth:
+            threads = [threading.Thread(target=work, args=(index,)) for index in range(len(contents))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(auth.call_count, 1)
+        self.assertEquals(self.client.encryption_mode, "ENC:NONE")
+        self.assertEquals(self.client.crypt._crypt_key, None)
+
+    def test_session_store(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'sessions', 'sessions.json')
+        try:
+            def new_client():
+                other = client.Client('username', 'password', server_url=self.server.url)
+                other.set_session_store(path)
+                return other
+
+            with mock.patch.object(self.server, 'auth', wraps=self.server.auth) as auth:
+                first = new_client()
+                vault = first.add_vault('private', 'vault')
+                first.store_data(vault.id, 'key', StringIO.StringIO('data'))
+                self.assertEquals(os.stat(path).st_mode & 0777, 0600)
+                # Every request but auth checks the session, rejected ones too
+                with mock.patch.object(self.server, 'check_session', wraps=self.server.check_session) as checks:
+                    self.assertEquals(new_client().list_vaults()[0].id, vault.id)
+                    self.assertEquals(auth.call_count, 1)
+                    self.assertEquals(checks.call_count, 1)
+
+                    self.server._sessions.clear()
+                    self.assertEquals(new_client().list_vaults()[0].id, vault.id)
+                    self.assertEquals(auth.call_count, 2)
+                    self.assertEquals(checks.call_count, 3)
+                self.server._sessions.clear()
+                self.assertEquals(''.join(new_client().fetch_data(vault.id, 'key')['data']), 'data')
+                self.assertEquals(auth.call_count, 3)
+
+                self.server._sessions.clear()
+                other = new_client()
+                other.set_request_size(1024)
+                other.store_data(vault.id, 'large', StringIO.StringIO('x' * 10000))
+                self.assertEquals(auth.call_count, 4)
+                self.assertEquals(len(''.join(other.fetch_data(vault.id, 'large')['data'])), 10000)
+
+                self.server._sessions.clear()
+                other = new_client()
+                read_fd, write_fd = os.pipe()
+                os.write(write_fd, 'data')
+                os.close(write_fd)
+                with os.fdopen(read_fd, 'rb') as pipe:
+                    self.assertRaises(urllib2.HTTPError, other.store_data, vault.id, 'pipe', pipe)
+                self.assertEquals(auth.call_count, 5)
+                self.assertEquals(other.list_vaults()[0].id, vault.id)
+                self.assertEquals(auth.call_count, 5)
+
+            with mock.patch('time.time', return_value=time.time() + 86400):
+                self.assertEquals(SessionStore(path).load(self.server.url, 'username'), None)
+            self.assertEquals(len(SessionStore(path).load(self.server.url, 'username')), 1)
+            self.assertEquals(SessionStore(path).load(self.server.url, 'other'), None)
+            SessionStore(path).remove(self.server.url, 'username')
+            self.assertEquals(SessionStore(path).load(self.server.url, 'username'), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_storage(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with LocalServer(directory) as server:
+                local = client.Client('username', 'password', server_url=server.url)
+                vault = local.add_vault('private', 'vault')
+                local.store_data(vault.id, 'key', StringIO.StringIO("Some test data"))
+                local.connection.close()
+
+            with ServerProcess(directory) as process:
+                other = client.Client('username', 'password', server_url=process.url)
+                self.assertEquals(''.join(other.fetch_data(vault.id, 'key')['data']), "Some test data")
+                other.set_request_size(4)
+                other.store_data(vault.id, 'chunks', StringIO.StringIO("More test data"))
+                other.connection.close()
+
+            with LocalServer(directory) as server:
+                local = client.Client('username', 'password', server_url=server.url)
+                self.assertEquals(''.join(local.fetch_data(vault.id, 'chunks')['data']), "More test data")
+                local.connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_suite(self):
+        with LocalServer(users={'user': 'secret'}) as server:
+            report = benchmark.run_suite(server.url, sizes=[4096], request_sizes=[1024],
+                                         modes=["ENC:NONE", "ENC:AES256"], workers=[1, 2],
+                                         widths=[3], head_count=2, repeat=1, user='user', password='secret')
+        ids = [result['id'] for result in report['results']]
+        self.assertEquals(len(ids), 11)
+        self.assertTrue('store mode=ENC:AES256 request_size=1024 size=4096 workers=2' in ids)
+        self.assertTrue('list_dataitems width=3' in ids)
+        self.assertTrue(all(result['value'] > 0 for result in report['results']))
+
+    def test_compare(self):
+        def report(store, listing):
+            return {'results': [{'id': 'store', 'value': store, 'higher_is_better': True},
+                                {'id': 'list', 'value': listing, 'higher_is_better': False}]}
+        comparison = benchmark.compare(report(80.0, 1.0), report(100.0, 2.0), threshold=0.1)
+        self.assertEquals([(entry['id'], entry['status']) for entry in comparison],
+                          [('store', 'worse'), ('list', 'better')])
+        comparison = benchmark.compare(report(105.0, 2.1), report(100.0, 2.0), threshold=0.1)
+        self.assertEquals([entry['status'] for entry in comparison], ['same', 'same'])
+
+
+class TestMicrobenchmark(unittest.TestCase):
+
+    def test_run_suite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            report = microbenchmark.run_suite(65536, [4096, 65536], profile_dir=directory, isolate=False)
+            self.assertEquals(len(report['results']), 24)
+            self.assertTrue(all(result['bytes'] >= 65536 for result in report['results']))
+            self.assertTrue(os.path.exists(os.path.join(directory, 'hash_aes-pipe-4096.prof')))
+            self.assertTrue(os.path.exists(os.path.join(directory, 'hash-memory-65536.folded')))
+
+            result = microbenchmark.run_isolated('hash', 'file', 4096, 65536)
+            self.assertEquals(result['bytes'], 65536)
+            self.assertTrue(result['peak_memory_growth'] >= 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_pipeline_order(self):
+        pipeline = Pipeline(iter(range(100)), [('double', lambda x: x * 2), ('str', str)], depth=1)
+        self.assertEquals(list(pipeline), [str(x * 2) for x in range(100)])
+        self.assertEquals(pipeline.stats['double']['items'], 100)
+        self.assertIn(pipeline.bottleneck, ['read', 'double', 'str', 'sink'])
+        self.assertRaises(StopIteration, pipeline.next)
+
+    def test_pipeline_error(self):
+        def fail(x):
+            if x == 5:
+                raise HolviDataItemException(1, "Failed")
+            return x
+
+        pipeline = Pipeline(iter(range(100)), [('fail', fail)])
+        with self.assertRaises(HolviDataItemException):
+            list(pipeline)
+        self.assertRaises(StopIteration, pipeline.next)
 
 
 class TestFileHandling(unittest.TestCase):
@@ -804,6 +1907,85 @@ class TestFileHandling(unittest.TestCase):
         original_data.seek(0), data_dec_out.seek(0)
         self.assertEquals(original_data.read(), data_dec_out.read())
 
+    def _chunked_roundtrip(self, content, feed, **kwargs):
+        crypt = FileCrypt('12345678901234561234567890123456', '1234567890123456')
+        encryptor = crypt.chunked_encryptor(segment_size=16, **kwargs)
+        encrypted = ''.join(CryptIterator(StringIO.StringIO(content), encryptor, feed))
+        decryptor = crypt.chunked_decryptor(**kwargs)
+        return encrypted, ''.join(CryptIterator(StringIO.StringIO(encrypted), decryptor, feed + 3))
+
+    def test_chunked_crypt(self):
+        for length in [0, 1, 15, 16, 17, 48, 100]:
+            content = os.urandom(length)
+            encrypted, decrypted = self._chunked_roundtrip(content, 7)
+            self.assertEquals(decrypted, content)
+            records = max(1, (length + 15) // 16)
+            self.assertEquals(len(encrypted), 16 + length + records * 16)
+            self.assertEquals(chunked_plaintext_length(len(encrypted), 16), length)
+
+        content = os.urandom(1000)
+        encrypted, decrypted = self._chunked_roundtrip(content, 100, workers=3)
+        self.assertEquals(decrypted, content)
+        encrypted, decrypted = self._chunked_roundtrip(content, 500, workers=2, processes=True)
+        self.assertEquals(decrypted, content)
+
+        crypt = FileCrypt('12345678901234561234567890123456', '1234567890123456')
+        tampered = encrypted[:40] + chr(ord(encrypted[40]) ^ 1) + encrypted[41:]
+        with self.assertRaises(HolviCryptException) as cm:
+            ''.join(CryptIterator(StringIO.StringIO(tampered), crypt.chunked_decryptor(), 64))
+        self.assertEquals(cm.exception.id, 902)
+
+        truncated = encrypted[:16 + 32 * 10]
+        with self.assertRaises(HolviCryptException):
+            ''.join(CryptIterator(StringIO.StringIO(truncated), crypt.chunked_decryptor(), 64))
+
+    def test_parallel_cfb_decrypt(self):
+        crypt = FileCrypt('12345678901234561234567890123456', '1234567890123456')
+        content = os.urandom(500000)
+        encrypted = ''.join(crypt.encrypt(StringIO.StringIO(content), 70000))
+
+        for workers, processes, chunksize in [(4, False, 300000), (3, False, 70001), (2, True, 200000)]:
+            decryptor = crypt.parallel_decryptor(workers, processes)
+            decrypted = CryptIterator(StringIO.StringIO(encrypted), decryptor, chunksize)
+            self.assertEquals(''.join(decrypted), content)
+
+        self.assertEquals(crypt.decrypt_at(encrypted[1000:1100], 1000, encrypted[984:1000]), content[1000:1100])
+        self.assertEquals(crypt.decrypt_at(encrypted[5:20], 5, encrypted[:5]), content[5:20])
+
+    def test_chunk_hasher(self):
+        hasher = ChunkHasher()
+        chunks = [hasher(chunk) for chunk in ["test ", "data ", "to be hashed"]]
+
+        for chunk, digest in chunks:
+            self.assertEquals(digest, hashlib.md5(chunk).hexdigest())
+        self.assertEquals(hasher.hexdigest(), hashlib.md5("test data to be hashed").hexdigest())
+
+        large = os.urandom(200000)
+        self.assertEquals(ChunkHasher()(large), (large, hashlib.md5(large).hexdigest()))
+
+        file_iterator = FileIterator(StringIO.StringIO("test data"), 4, hashed=False)
+        self.assertEquals(''.join(file_iterator), "test data")
+        self.assertEquals(file_iterator._md5.hexdigest(), hashlib.md5().hexdigest())
+
+    def test_mmap_source(self):
+        self.assertEquals(mmap_source(StringIO.StringIO("data")), None)
+        with tempfile.NamedTemporaryFile() as source:
+            self.assertEquals(mmap_source(source), None)
+            source.write("Some test data to be sent to server")
+            source.flush()
+            source.seek(5)
+            mapped = mmap_source(source)
+            chunks = list(FileIterator(mapped, 8))
+            self.assertTrue(all(isinstance(chunk, buffer) for chunk in chunks))
+            self.assertEquals(''.join(str(chunk) for chunk in chunks), "test data to be sent to server")
+            mapped.close()
+            self.assertEquals(str(chunks[0]), "test dat")
+
+            crypt = FileCrypt("12345678901234561234567890123456", "1234567890123456")
+            encrypted = ''.join(CryptIterator(mmap_source(source), crypt.chunked_encryptor(), 8))
+            decrypted = CryptIterator(StringIO.StringIO(encrypted), crypt.chunked_decryptor(), 8)
+            self.assertEquals(''.join(decrypted), "test data to be sent to server")
+
     def test_file_iterator(self):
         original_data = StringIO.StringIO("test data to be iterated")
 
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+import weakref
+
+SIZE_GRANULARITY = 65536
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser('~'), '.holvi', 'request_sizes.json')
+
+
+class ChunkSizeTuner(object):
+    """ChunkSizeTuner adjusts the request size from measured chunk transfers.
+
+    The transfer rate is tracked as a moving average and the size is moved
+    towards the amount of data that takes target_seconds to transfer, at most
+    doubling or halving it per chunk. Failed chunks halve the size and a chunk
+    stalling for more than twice the target time resets the average. Sizes
+    are kept between minimum and maximum.
+
+    """
+    def __init__(self, size, minimum, maximum, target_seconds=1.0, smoothing=0.3):
+        """Initializer for ChunkSizeTuner
+
+        :param size: initial request size
+        :param minimum: smallest request size used
+        :param maximum: largest request size used
+        :param target_seconds: preferred transfer time of one chunk
+        :param smoothing: weight of the latest measurement in the moving average
+
+        """
+        if minimum <= 0 or maximum < minimum:
+            raise ValueError("Invalid request size bounds")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self.size = self._clamp(size)
+        self._rate = None
+        self._lock = threading.Lock()
+        self._targets = weakref.WeakSet()
+
+    def attach(self, iterator):
+        """Makes record update the chunksize of given iterator"""
+        with self._lock:
+            self._targets.add(iterator)
+            iterator.chunksize = self.size
+
+    def detach(self, iterator):
+        """Stops updating the chunksize of given iterator"""
+        with self._lock:
+            self._targets.discard(iterator)
+
+    def record(self, nbytes, seconds, failed=False):
+        """Records one chunk transfer and returns the new request size
+
+        :param nbytes: size of the transferred chunk
+        :param seconds: time the transfer took
+        :param failed: True if the transfer failed
+
+        """
+        with self._lock:
+            if failed:
+                size = self.size // 2
+            elif nbytes <= 0:
+                return self.size
+            else:
+                rate = nbytes / max(seconds, 1e-6)
+                if self._rate is None or seconds > 2 * self.target_seconds:
+                    self._rate = rate
+                else:
+                    self._rate = self.smoothing * rate + (1 - self.smoothing) * self._rate
+                size = max(self.size // 2, min(self.size * 2, int(self._rate * self.target_seconds)))
+            self.size = self._clamp(size)
+            for iterator in self._targets:
+                iterator.chunksize = self.size
+            return self.size
+
+    def _clamp(self, size):
+        size = max(self.minimum, min(self.maximum, int(size)))
+        if size >= SIZE_GRANULARITY:
+            size -= size % SIZE_GRANULARITY
+        return max(size, self.minimum)
+
+
+class TuningStore(object):
+    """TuningStore persists tuned request sizes per server url in a JSON file"""
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        """Initializer for TuningStore
+
+        :param path: path of the JSON file
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, server_url):
+        """Returns the stored request size for server_url, None if not known"""
+        return self._load().get(server_url)
+
+    def put(self, server_url, size):
+        """Stores the request size for server_url"""
+        with self._lock:
+            sizes = self._load()
+            if sizes.get(server_url) == size:
+                return
+            sizes[server_url] = size
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as state_file:
+                json.dump(sizes, state_file)
+            os.rename(temp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as state_file:
+                sizes = json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(sizes, dict):
+            return {}
+        return sizes
+
+
+class MeasuredReader(object):
+    """MeasuredReader reports the time of every read of a response to a callback"""
+    def __init__(self, fileobj, record, done=None):
+        """Initializer for MeasuredReader
+
+        :param fileobj: file-like object to be read
+        :param record: function(nbytes, seconds) called after each read
+        :param done: function called once when the end of fileobj is read
+
+        """
+        self.fileobj = fileobj
+        self.headers = getattr(fileobj, 'headers', None)
+        self._record = record
+        self._done = done
+
+    def read(self, size=None):
+        """Reads from the wrapped object and records the time it took"""
+        start = time.time()
+        if size is None:
+            data = self.fileobj.read()
+        else:
+            data = self.fileobj.read(size)
+        if data:
+            self._record(len(data), time.time() - start)
+        elif self._done is not None and size != 0:
+            done, self._done = self._done, None
+            done()
+        return data
+
+    def close(self):
+        self.fileobj.close()
@@ -1,14 +1,116 @@
 # -*- coding: utf-8 -*-
+import os
+import stat
+import ctypes
+import ctypes.util
+import threading
 from .exceptions import HolviCryptException
 
 ENC_NONE = "ENC:NONE"
 ENC_AES256 = "ENC:AES256"
+ENC_AES256_CHUNKED = "ENC:AES256-CHUNKED"
 IV_DEFAULT = "1234567890123456"
 SERVER_DEFAULT = "https://my.holvi.org/"
 
 def validate_encryption_mode(level, throw_exception=True):
-    if level in [ENC_NONE, ENC_AES256]:
+    if level in [ENC_NONE, ENC_AES256, ENC_AES256_CHUNKED]:
         return True
     if throw_exception:
         raise HolviCryptException(901, 'Invalid encryption mode')
     return False
+
+def split_ranges(length, size):
+    """Splits length bytes into (start, end) ranges of at most size bytes.
+
+    End offsets are inclusive, as in HTTP Range headers.
+
+    """
+    return [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+
+def _load_libc(name, argtypes, restype):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = restype
+    return func
+
+_libc_pwrite = None if hasattr(os, 'pwrite') else \
+    _load_libc('pwrite', [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_longlong], ctypes.c_ssize_t)
+_libc_fallocate = None if hasattr(os, 'posix_fallocate') else \
+    _load_libc('posix_fallocate', [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong], ctypes.c_int)
+_seek_lock = threading.Lock()
+
+def pwrite(fd, data, offset, size=None):
+    """Writes data to file descriptor fd at offset.
+
+    :param fd: file descriptor opened for writing
+    :param data: str, bytearray, buffer or memoryview to be written
+    :param offset: file offset of the first byte
+    :param size: number of bytes of data to write, all of it by default
+
+    The file position of fd is not used, so several threads can write
+    different parts of the same file through one descriptor. A str or
+    bytearray is written without copying where pwrite is available, so
+    a reused receive buffer can be written with size.
+
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif isinstance(data, buffer):
+        data = str(data)
+    if size is None:
+        size = len(data)
+    if size <= 0:
+        return
+    if hasattr(os, 'pwrite'):
+        data = memoryview(data)[:size]
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data, offset = data[written:], offset + written
+    elif _libc_pwrite is not None:
+        if isinstance(data, bytearray):
+            source = (ctypes.c_char * len(data)).from_buffer(data)
+            address = ctypes.addressof(source)
+        else:
+            source = ctypes.c_char_p(data)
+            address = ctypes.cast(source, ctypes.c_void_p).value
+        done = 0
+        while done < size:
+            written = _libc_pwrite(fd, address + done, size - done, offset + done)
+            if written < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            done += written
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            done = 0
+            while done < size:
+                done += os.write(fd, buffer(data, done, size - done))
+
+def preallocate(fd, length):
+    """Reserves length bytes of disk space for the file of fd.
+
+    Uses posix_fallocate, so the blocks of a large file are allocated at
+    once instead of piece by piece as it is written. Where the platform or
+    file system does not support it, the file is only extended to length.
+    Only regular files are preallocated and failures are ignored, the
+    space is then allocated as the file is written.
+
+    """
+    if length <= 0:
+        return
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, length)
+            return
+        if _libc_fallocate is not None and _libc_fallocate(fd, 0, length) == 0:
+            return
+        os.ftruncate(fd, length)
+    except OSError:
+        pass
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import sys
+import traceback
+import threading
+import collections
+import Queue
+
+
+class Future(object):
+    """Future holds the result of a task run by a WorkerPool"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Returns True when the task has finished"""
+        return self._done.is_set()
+
+    def failed(self):
+        """Returns True when the task has finished with an exception"""
+        return self._done.is_set() and self._exc_info is not None
+
+    def result(self):
+        """Waits for the task and returns its result.
+
+        Re-raises the exception the task raised, with its original traceback.
+
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) when the task has finished.
+
+        The callback runs in the thread finishing the task, or right away
+        if the task has already finished. Exceptions raised by callbacks
+        are printed and ignored.
+
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+
+class WorkerPool(object):
+    """WorkerPool runs tasks on a fixed number of daemon threads.
+
+    At most max_pending tasks are queued or running at a time, submit blocks
+    until a slot is free. This keeps memory bounded when tasks carry data
+    chunks.
+
+    """
+    def __init__(self, workers, max_pending=None):
+        """Initializer for WorkerPool
+
+        :param workers: number of worker threads
+        :param max_pending: maximum number of unfinished tasks, defaults to workers
+
+        """
+        if workers < 1:
+            raise ValueError("WorkerPool needs at least one worker")
+        self.workers = workers
+        self._tasks = Queue.Queue()
+        self._slots = threading.Semaphore(max_pending or workers)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) and returns its Future"""
+        self._slots.acquire()
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def map(self, fn, iterable, window=None):
+        """Runs fn over iterable and yields the results in input order.
+
+        :param fn: function to be called for each item
+        :param iterable: items to be processed
+        :param window: maximum number of results computed ahead of the consumer
+
+        """
+        window = window or self.workers
+        futures = collections.deque()
+        for item in iterable:
+            if len(futures) >= window:
+                yield futures.popleft().result()
+            futures.append(self.submit(fn, item))
+        while futures:
+            yield futures.popleft().result()
+
+    def shutdown(self):
+        """Lets queued tasks finish and stops the worker threads"""
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            try:
+                future._set_result(fn(*args, **kwargs))
+            except BaseException:
+                future._set_exc_info(sys.exc_info())
+            finally:
+                self._slots.release()